@@ -0,0 +1,309 @@
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Callable
+
+from configuration_bot import BotConfig
+
+import metrics
+
+from pyrustools.client_plus import MyPyrus
+
+import requests
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+# Ответы, после которых запрос повторяется с задержкой
+STATUS_TOO_MANY_REQUESTS = 429
+STATUS_SERVER_ERROR = 500
+
+# Общий планировщик процесса
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class RetryLater(Exception):
+    """
+
+    Запрос к API можно повторить не раньше, чем через delay секунд.
+
+    Ожидание дольше max_wait не занимает обработчик: задача отчета
+    прерывается и ставится в очередь повторно с этой задержкой.
+    """
+
+    def __init__(self, delay: float, reason: str):
+        super().__init__(f'{reason}, повтор через {delay:.1f} с')
+        self.delay = delay
+        self.reason = reason
+
+
+class TokenBucket:
+    """Ограничение частоты запросов: rate в секунду, всплеск до burst."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self, now: float) -> float:
+        """
+
+        Резервирование токена.
+
+        :param now: текущее время time.monotonic()
+        :return: сколько секунд ждать до использования токена
+        """
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        return max(wait, self.blocked_until - now)
+
+    def cancel(self) -> None:
+        """Возврат зарезервированного, но не использованного токена."""
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class ApiScheduler:
+    """
+
+    Общий для потоков процесса планировщик запросов к API pyrus.
+
+    Частота запросов ограничивается отдельно для каждого аккаунта.
+    Ответ 429 с Retry-After приостанавливает запросы всего аккаунта,
+    ошибки 5xx повторяются с экспоненциальной задержкой и разбросом.
+    Короткие ожидания выполняются в вызывающем потоке, длинные
+    прерывают задачу исключением RetryLater.
+    """
+
+    def __init__(
+            self,
+            rate: float = 8,
+            burst: int = 20,
+            max_retries: int = 5,
+            backoff: float = 1,
+            max_backoff: float = 60,
+            max_wait: float = 10
+    ):
+        """
+
+        Настройка планировщика.
+
+        :param rate: запросов в секунду на аккаунт
+        :param burst: сколько запросов можно сделать подряд без ожидания
+        :param max_retries: сколько раз повторять запрос с ошибкой
+        :param backoff: задержка перед первым повтором в секундах
+        :param max_backoff: наибольшая задержка перед повтором в секундах
+        :param max_wait: наибольшее ожидание в потоке обработчика
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, account) -> None:
+        """
+
+        Ожидание разрешения на запрос.
+
+        :param account: аккаунт, к которому относится лимит
+        :return:
+        """
+        with self._lock:
+            bucket = self._bucket(account)
+            wait = bucket.reserve(time.monotonic())
+            if wait > self.max_wait:
+                bucket.cancel()
+        if wait > self.max_wait:
+            metrics.inc('pyrus_api_deferred_total', reason='rate_limit',
+                        help_text='Задачи, отложенные из-за лимитов API')
+            raise RetryLater(wait, 'Превышен лимит запросов к API')
+        if wait > 0:
+            metrics.observe('pyrus_api_wait_seconds', wait,
+                            help_text='Ожидание лимита запросов к API')
+            time.sleep(wait)
+
+    def retry_delay(self, account, attempt: int, status: int,
+                    retry_after: (float, None)) -> float:
+        """
+
+        Задержка перед повтором запроса с ошибкой.
+
+        :param account: аккаунт, к которому относится лимит
+        :param attempt: номер неудачной попытки, начиная с 1
+        :param status: код ответа
+        :param retry_after: значение Retry-After в секундах или None
+        :return: задержка в секундах
+        :raises RetryLater: если повторы исчерпаны или ждать слишком долго
+        """
+        if retry_after is None:
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            delay = random.uniform(delay / 2, delay)
+        else:
+            delay = retry_after
+        limited = status == STATUS_TOO_MANY_REQUESTS
+        reason = 'rate_limit' if limited else 'server_error'
+        if limited:
+            # Остальные запросы аккаунта тоже ждут, а не получают 429
+            with self._lock:
+                bucket = self._bucket(account)
+                bucket.blocked_until = max(
+                    bucket.blocked_until, time.monotonic() + delay
+                )
+        metrics.inc('pyrus_api_retries_total', reason=reason,
+                    help_text='Повторы запросов к API pyrus')
+        if attempt > self.max_retries or delay > self.max_wait:
+            metrics.inc('pyrus_api_deferred_total', reason=reason,
+                        help_text='Задачи, отложенные из-за лимитов API')
+            raise RetryLater(
+                delay, f'API pyrus ответило {status} на попытку {attempt}'
+            )
+        return delay
+
+    def _bucket(self, account) -> TokenBucket:
+        bucket = self._buckets.get(account)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[account] = bucket
+        return bucket
+
+
+class ScheduledPyrus(MyPyrus):
+    """
+
+    Клиент pyrus, запросы которого проходят через ApiScheduler.
+
+    Заменяет повторы MyPyrus с фиксированной паузой 5 секунд.
+    """
+
+    def __init__(self, scheduler: ApiScheduler, **kwargs):
+        """
+
+        Создание клиента.
+
+        :param scheduler: планировщик запросов
+        :param kwargs: параметры MyPyrus
+        """
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+        # Аккаунт для лимитов, по умолчанию логин или хост
+        self.account = None
+
+    def send(self, perform: Callable[[], requests.Response]):
+        """
+
+        Выполнение запроса с лимитом, повторной авторизацией и повторами.
+
+        :param perform: функция, выполняющая HTTP-запрос
+        :return: ответ requests
+        :raises RetryLater: если запрос нужно повторить позже
+        """
+        account = self.account or self.login or self._host
+        attempt = 0
+        authorized = False
+        while True:
+            self.scheduler.acquire(account)
+            response = perform()
+            status = response.status_code
+            if status == 401 and not authorized:
+                authorized = True
+                response.close()
+                self._auth()
+                if not self.access_token:
+                    return response
+                continue
+            if is_retryable(status):
+                attempt += 1
+                delay = self.scheduler.retry_delay(
+                    account, attempt, status, get_retry_after(response)
+                )
+                response.close()
+                logger.debug(f'Попытка: {attempt}, Статус ответа: {status}, '
+                             f'повтор через {delay:.1f} с')
+                time.sleep(delay)
+                continue
+            return response
+
+    def _perform_request_with_retry(
+            self,
+            url: str,
+            method: MyPyrus.HTTPMethod,
+            body: object = None,
+            file_path: str = None,
+            get_file: bool = False
+    ):
+        if not self.access_token:
+            response = self._auth()
+            if not self.access_token:
+                return response
+        response = self.send(lambda: self._perform_request(
+            url, method, body, file_path, get_file
+        ))
+        return self._get_response(response, get_file, body)
+
+
+def is_retryable(status: int) -> bool:
+    """
+
+    Нужно ли повторить запрос с таким кодом ответа.
+
+    :param status: код ответа
+    :return: True для 429 и ошибок сервера
+    """
+    return status == STATUS_TOO_MANY_REQUESTS or status >= STATUS_SERVER_ERROR
+
+
+def get_retry_after(response) -> (float, None):
+    """
+
+    Значение заголовка Retry-After в секундах.
+
+    :param response: ответ requests
+    :return: секунды или None, если заголовка нет
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def get_scheduler(config: BotConfig) -> ApiScheduler:
+    """
+
+    Общий планировщик запросов процесса.
+
+    :param config: конфигурационный файл
+    :return: планировщик
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ApiScheduler(
+                config.api_rate,
+                config.api_burst,
+                config.api_max_retries,
+                config.api_retry_backoff,
+                config.api_max_backoff,
+                config.api_max_wait
+            )
+        return _scheduler
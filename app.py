@@ -8,14 +8,18 @@ All changes must occur in other modules
 import hashlib
 import hmac
 import json
+import time
 import uuid
 
 from flask import Flask, request
 
+import metrics
+
 import process_request
 
 app = Flask(__name__)
 app.config.from_json('config.json')
+secret = str.encode(app.config['SECRET_KEY'])
 
 
 @app.route("/diagnostics/check", methods=['GET'])
@@ -29,6 +33,25 @@ def diagnostic():
     return '', 204
 
 
+@app.route("/diagnostics/metrics", methods=['GET'])
+def diagnostic_metrics():
+    """
+
+    Метрики обработки отчетов в текстовом формате Prometheus.
+
+    Процессы gunicorn и report_worker.py сбрасывают метрики в папку
+    METRICS_DIRECTORY, поэтому любой процесс отвечает суммой по всем:
+    счетчики и гистограммы складываются, текущие значения очередей
+    и кэшей идут с меткой pid. Значения других процессов отстают
+    не больше чем на METRICS_FLUSH_INTERVAL секунд.
+
+    :return:
+    """
+    return metrics.render(), 200, {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+    }
+
+
 @app.route("/", methods=['GET', 'POST'])
 def index():
     """
@@ -37,10 +60,10 @@ def index():
 
     :return:
     """
-    body = request.data
+    start = time.perf_counter()
+    body = request.get_data()
     signature = request.headers.get('x-pyrus-sig')
     retry = request.headers.get('x-pyrus-retry')
-    secret = str.encode(app.config['SECRET_KEY'])
     # Unique session id is generated, useful for log usage
     session_id = str(uuid.uuid4().fields[-1])[:5]
 
@@ -49,13 +72,23 @@ def index():
 
     # This setting means that we are creating public
     # bot which can be called from several accounts
-    if signature:
-        is_correct = _is_signature_correct(body, secret, signature)
-        if app.config['SKIP_SIGNATURE'] or is_correct:
-            body_jsn = json.loads(body.decode('utf-8'))
-            return _prepare_response(body_jsn, retry, session_id)
-    else:
+    if not signature:
         return ''
+    skip_signature = app.config['SKIP_SIGNATURE']
+    if not skip_signature and not _is_signature_correct(
+            body, secret, signature
+    ):
+        return '', 403
+    # Acknowledgment path: only signature check and enqueue,
+    # the report itself runs in the worker pool
+    body_jsn = json.loads(body)
+    response = _prepare_response(body_jsn, retry, session_id)
+    metrics.observe(
+        'webhook_ack_seconds', time.perf_counter() - start,
+        metrics.FAST_SECONDS_BUCKETS,
+        help_text='Время ответа pyrus на вебхук'
+    )
+    return response
 
 
 def _is_signature_correct(message, secret, signature):
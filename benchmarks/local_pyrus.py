@@ -0,0 +1,142 @@
+import json
+import time
+from typing import Iterator
+
+from pyrus.models import requests as req
+from pyrus.models import responses as resp
+
+from pyrustools.client_plus import MyPyrus
+from pyrustools.objects_plus import FormResponsePlus, TaskResponsePlus
+
+import registry_stream
+
+
+class LocalPyrus(MyPyrus):
+    """
+
+    Локальная подмена MyPyrus для замеров без обращений к pyrus.
+
+    Ответы хранятся сериализованными в JSON, поэтому каждый вызов,
+    как и настоящий клиент, тратит время на разбор ответа.
+    Запрос реестра с полями и фильтрами применяется так же, как на сервере.
+    """
+
+    _host = 'local'
+
+    def __init__(
+            self,
+            forms: dict,
+            registries: dict,
+            contacts: dict,
+            catalogs: dict,
+            latency: float = 0
+    ):
+        """
+
+        Подготовка ответов.
+
+        :param forms: шаблоны форм вида {id формы: ответ API}
+        :param registries: реестры вида {id формы: ответ API}
+        :param contacts: контакты в виде ответа API
+        :param catalogs: справочники вида {id справочника: ответ API}
+        :param latency: задержка каждого вызова в секундах
+        """
+        super().__init__(login='local', security_key='local')
+        self.access_token = 'local'
+        self.latency = latency
+        self.calls = []
+        self.comments = []
+        self._forms = {key: _dump(value) for key, value in forms.items()}
+        self._registries = registries
+        self._contacts = _dump(contacts)
+        self._catalogs = {
+            key: _dump(value) for key, value in catalogs.items()
+        }
+
+    def get_form(self, form_id: int) -> FormResponsePlus:
+        """Шаблон формы."""
+        self._call('get_form')
+        return FormResponsePlus(**json.loads(self._forms[form_id]))
+
+    def get_registry(
+            self,
+            form_id: int,
+            form_register_request: req.FormRegisterRequest = None
+    ) -> resp.FormRegisterResponse:
+        """Реестр формы с учетом запроса."""
+        self._call('get_registry')
+        body = json.loads(self._registry_body(form_id, form_register_request))
+        return resp.FormRegisterResponse(**body)
+
+    def get_registry_chunks(
+            self,
+            form_id: int,
+            request: req.FormRegisterRequest = None
+    ) -> Iterator[bytes]:
+        """Реестр с учетом запроса кусками, как при потоковой загрузке."""
+        self._call('get_registry')
+        body = self._registry_body(form_id, request)
+        size = registry_stream.CHUNK_SIZE
+        for start in range(0, len(body), size):
+            yield body[start:start + size]
+
+    def get_contacts(self) -> resp.ContactsResponse:
+        """Контакты организации."""
+        self._call('get_contacts')
+        return resp.ContactsResponse(**json.loads(self._contacts))
+
+    def get_catalog(self, catalog_id: int) -> resp.CatalogResponse:
+        """Справочник."""
+        self._call('get_catalog')
+        return resp.CatalogResponse(**json.loads(self._catalogs[catalog_id]))
+
+    def comment_task_plus(self, task_id: int, **kwargs) -> TaskResponsePlus:
+        """Запоминание комментария вместо отправки."""
+        self._call('comment_task')
+        self.comments.append((task_id, kwargs))
+        return TaskResponsePlus(task={'id': task_id})
+
+    def _call(self, method: str) -> None:
+        self.calls.append(method)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _registry_body(
+            self,
+            form_id: int,
+            request: req.FormRegisterRequest = None
+    ) -> bytes:
+        registry = self._registries[form_id]
+        if request is None:
+            return _dump(registry)
+        field_ids = set(getattr(request, 'field_ids', None) or [])
+        filters = {
+            int(key[3:]): value for key, value in vars(request).items()
+            if key.startswith('fld')
+        }
+        tasks = []
+        for task in registry['tasks']:
+            fields = {field['id']: field for field in task['fields']}
+            if all(
+                    _matches(fields.get(field_id), value)
+                    for field_id, value in filters.items()
+            ):
+                if field_ids:
+                    task = dict(task, fields=[
+                        field for field in task['fields']
+                        if field['id'] in field_ids
+                    ])
+                tasks.append(task)
+        return _dump({'tasks': tasks})
+
+
+def _matches(field: dict, value) -> bool:
+    # Поддерживаются только фильтры, которые формирует отчет
+    field_value = field.get('value') if field else None
+    if isinstance(field_value, dict):
+        return value in field_value.get('choice_ids', [])
+    return field_value == value
+
+
+def _dump(value: dict) -> bytes:
+    return json.dumps(value, ensure_ascii=False).encode('utf-8')
@@ -0,0 +1,323 @@
+"""
+Замеры обработки отчетов на синтетических или записанных данных.
+
+Запуск из корня репозитория:
+    python -m benchmarks.run --sizes 1000,10000,200000 --columns 20
+
+Реестры, шаблоны, контакты и справочники отдает LocalPyrus,
+обращений к pyrus нет. С --cassette ответы берутся из записи
+test_bot.py --record:
+    python -m benchmarks.run --cassette report.jsonl.gz --latency recorded
+
+Результаты дописываются в файл (по умолчанию benchmarks/results.jsonl)
+и сравниваются с предыдущим запуском того же сценария.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import statistics
+import subprocess
+import time
+from typing import Callable
+
+from benchmarks import synthetic
+from benchmarks.local_pyrus import LocalPyrus
+
+import cassette
+
+from configuration_bot import BotConfig
+
+from forms import report_form
+
+import metrics
+
+from pyrustools.client_plus import MyPyrus
+from pyrustools.objects_plus import TaskWithCommentsPlus
+
+logger = logging.getLogger(__name__)
+
+RESULTS_PATH = os.path.join('benchmarks', 'results.jsonl')
+
+
+def get_config(args: argparse.Namespace) -> BotConfig:
+    """
+
+    Настройки бота для замеров.
+
+    Берутся из bot_config.json, кэши между запусками отключаются,
+    чтобы каждый запуск загружал и разбирал реестры заново.
+
+    :param args: аргументы командной строки
+    :return: конфигурационный файл
+    """
+    with open('bot_config.json', encoding='utf8') as config_file:
+        config = json.load(config_file)
+    config.update({
+        'CACHE_TTL': 0,
+        'FINGERPRINT_STORE': 'memory',
+        'REGISTRY_STREAMING': args.streaming,
+        'REGISTRY_SERVER_FILTERS': not args.no_server_filters,
+        'AGGREGATION_BACKEND': args.backend,
+        'AGGREGATION_PROCESSES': args.processes,
+    })
+    return BotConfig(config)
+
+
+def get_filters(args: argparse.Namespace, form_ids: list) -> tuple:
+    """
+
+    Строки таблицы фильтров для задачи отчета.
+
+    :param args: аргументы командной строки
+    :param form_ids: id форм-источников
+    :return: фильтры вида ((юкод таблицы, юкод поля, значение), ...)
+    """
+    if not args.filters:
+        return ()
+    filters = []
+    for form_id in form_ids:
+        filters.append((f'REPORT_{form_id}', 'Chk', 'checked'))
+        filters.append((f'REPORT_{form_id}_people', 'Chk', 'checked'))
+        filters.append((f'REPORT_{form_id}_people', 'City', 'Москва'))
+    return tuple(filters)
+
+
+def run_scenario(args: argparse.Namespace, size: int) -> dict:
+    """
+
+    Замер одного размера реестра.
+
+    :param args: аргументы командной строки
+    :param size: количество задач в реестре каждой формы-источника
+    :return: результат замера
+    """
+    form_ids = [1000 + n for n in range(args.forms)]
+    report = synthetic.make_report_form(
+        form_ids, args.columns, args.cardinality
+    )
+    client = LocalPyrus(
+        forms={
+            **{
+                form_id: synthetic.make_source_form(form_id, args.columns)
+                for form_id in form_ids
+            },
+            synthetic.REPORT_FORM_ID: report,
+        },
+        registries={
+            form_id: synthetic.make_registry(
+                form_id, size, args.columns, args.cardinality, args.seed
+            )
+            for form_id in form_ids
+        },
+        contacts=synthetic.make_contacts(),
+        catalogs={synthetic.CATALOG_ID: synthetic.make_catalog()},
+        latency=args.latency
+    )
+    filters = get_filters(args, form_ids)
+    result = measure(
+        args, client,
+        lambda run: synthetic.make_report_task(run, report, filters)
+    )
+    scenario = {
+        'size': size,
+        'forms': args.forms,
+        'columns': args.columns,
+        'cardinality': args.cardinality,
+        'filters': args.filters,
+        'streaming': args.streaming,
+        'server_filters': not args.no_server_filters,
+        'backend': args.backend,
+        'processes': args.processes,
+        'latency': args.latency,
+    }
+    return {'scenario': scenario, **result}
+
+
+def run_cassette(args: argparse.Namespace) -> dict:
+    """
+
+    Замер на записанных ответах pyrus (test_bot.py --record).
+
+    Параметры, от которых зависят запросы (--no-server-filters),
+    должны совпадать с настройками при записи.
+
+    :param args: аргументы командной строки
+    :return: результат замера
+    """
+    client = cassette.ReplayPyrus(args.cassette, args.latency)
+    task_id = args.task or client.task_ids()[0]
+
+    def make_task(run: int) -> TaskWithCommentsPlus:
+        task = client.get_task(task_id).task
+        # Новый id на каждый запуск, чтобы не сработал отпечаток
+        task.id = run
+        return task
+
+    result = measure(args, client, make_task)
+    scenario = {
+        'cassette': os.path.basename(args.cassette),
+        'task': task_id,
+        'streaming': args.streaming,
+        'server_filters': not args.no_server_filters,
+        'backend': args.backend,
+        'processes': args.processes,
+        'latency': args.latency,
+    }
+    return {'scenario': scenario, **result}
+
+
+def measure(
+        args: argparse.Namespace,
+        client: MyPyrus,
+        make_task: Callable[[int], TaskWithCommentsPlus]
+) -> dict:
+    """
+
+    Повторные запуски обработки отчета с замером этапов.
+
+    :param args: аргументы командной строки
+    :param client: клиент LocalPyrus или ReplayPyrus
+    :param make_task: функция, возвращающая задачу отчета по номеру запуска
+    :return: медианы общего времени и этапов, обращения к API
+    """
+    config = get_config(args)
+    totals, stages, calls = [], {}, {}
+    for run in range(1, args.repeat + 1):
+        metrics.reset()
+        task = make_task(run)
+        client.update_task_field_info(task)
+        client.calls.clear()
+        start = time.perf_counter()
+        report_form.process_reports(client, config, task)
+        totals.append(time.perf_counter() - start)
+        for name, seconds in metrics.totals(
+                'report_stage_seconds', 'stage'
+        ).items():
+            stages.setdefault(name, []).append(seconds)
+        calls = {
+            method: client.calls.count(method) for method in set(client.calls)
+        }
+    return {
+        'repeat': args.repeat,
+        'total': statistics.median(totals),
+        'stages': {
+            name: statistics.median(values)
+            for name, values in sorted(stages.items())
+        },
+        'api_calls': calls,
+    }
+
+
+def load_previous(path: str, scenario: dict) -> (dict, None):
+    """
+
+    Последний записанный результат того же сценария.
+
+    :param path: файл результатов
+    :param scenario: параметры сценария
+    :return: результат или None
+    """
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, encoding='utf8') as results_file:
+        for line in results_file:
+            record = json.loads(line)
+            if record.get('scenario') == scenario:
+                previous = record
+    return previous
+
+
+def print_result(result: dict, previous: (dict, None)) -> None:
+    """
+
+    Вывод результата со сравнением с предыдущим запуском.
+
+    :param result: результат замера
+    :param previous: предыдущий результат того же сценария
+    :return:
+    """
+    def line(name: str, value: float, old_value: (float, None)) -> str:
+        text = f'  {name:<16}{value * 1000:>12.1f} ms'
+        if old_value:
+            text += f'  {(value - old_value) / old_value * 100:+7.1f}%'
+        return text
+
+    scenario = result['scenario']
+    name = scenario.get('cassette') or f'size={scenario["size"]}'
+    print(f'{name} calls={result["api_calls"]}')
+    old_stages = previous['stages'] if previous else {}
+    print(line('total', result['total'], previous and previous['total']))
+    for name, value in result['stages'].items():
+        if name != 'total':
+            print(line(name, value, old_stages.get(name)))
+
+
+def get_revision() -> str:
+    """Текущий коммит, если замер запущен из git-репозитория."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main() -> None:
+    """Разбор аргументов и запуск замеров."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='comma separated registry sizes')
+    parser.add_argument('--forms', type=int, default=2,
+                        help='number of source forms')
+    parser.add_argument('--columns', type=int, default=10,
+                        help='number of extra text fields per form')
+    parser.add_argument('--cardinality', type=int, default=5,
+                        help='distinct values of extra text fields')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--filters', action='store_true',
+                        help='fill the additional filters table')
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--no-server-filters', action='store_true')
+    parser.add_argument('--backend', default='python',
+                        choices=('python', 'numpy'))
+    parser.add_argument('--processes', type=int, default=0)
+    parser.add_argument('--latency', type=cassette.parse_latency, default=0,
+                        help='simulated latency of each API call, seconds, '
+                             'or "recorded" with --cassette')
+    parser.add_argument('--cassette',
+                        help='replay API responses recorded with '
+                             'test_bot.py --record instead of synthetic data')
+    parser.add_argument('--task', type=int,
+                        help='report task from the cassette, '
+                             'the first recorded task by default')
+    parser.add_argument('--results', default=RESULTS_PATH,
+                        help='file to append results to')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    revision = get_revision()
+    if args.cassette:
+        runs = [lambda: run_cassette(args)]
+    else:
+        runs = [
+            lambda size=int(size): run_scenario(args, size)
+            for size in args.sizes.split(',')
+        ]
+    for run in runs:
+        result = run()
+        result['time'] = datetime.datetime.now().isoformat(timespec='seconds')
+        result['revision'] = revision
+        print_result(result, load_previous(args.results, result['scenario']))
+        if not args.no_save:
+            with open(args.results, 'a', encoding='utf8') as results_file:
+                results_file.write(json.dumps(result, ensure_ascii=False))
+                results_file.write('\n')
+
+
+if __name__ == '__main__':
+    main()
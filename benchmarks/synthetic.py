@@ -0,0 +1,306 @@
+import random
+
+from pyrustools.objects_plus import TaskWithCommentsPlus
+
+# Структура синтетической формы-источника
+STATUS_FIELD_ID = 1
+PERSON_FIELD_ID = 2
+CITY_FIELD_ID = 3
+CATALOG_FIELD_ID = 4
+CHECKMARK_FIELD_ID = 5
+# Дополнительные текстовые поля получают id начиная с этого
+EXTRA_FIELD_ID = 100
+
+CATALOG_ID = 77
+STATUSES = 6
+PERSONS = 40
+CITIES = ('Москва', 'Казань', 'Омск', 'Пермь', 'Тверь', 'Сочи')
+CATALOG_ITEMS = 30
+
+# id полей формы отчета
+REPORT_FORM_ID = 900
+FILTERS_TABLE_ID = 9000
+
+
+def make_source_form(form_id: int, extra_columns: int = 0) -> dict:
+    """
+
+    Шаблон формы-источника.
+
+    :param form_id: id формы
+    :param extra_columns: количество дополнительных текстовых полей
+    :return: шаблон формы в виде ответа API pyrus
+    """
+    fields = [
+        {
+            'id': STATUS_FIELD_ID, 'type': 'multiple_choice',
+            'name': 'Статус',
+            'info': {
+                'code': 'Status',
+                'options': [
+                    {'choice_id': i, 'choice_value': f'Статус {i}'}
+                    for i in range(1, STATUSES + 1)
+                ]
+            }
+        },
+        {
+            'id': PERSON_FIELD_ID, 'type': 'person', 'name': 'Исполнитель',
+            'info': {'code': 'Resp'}
+        },
+        {
+            'id': CITY_FIELD_ID, 'type': 'text', 'name': 'Город',
+            'info': {'code': 'City'}
+        },
+        {
+            'id': CATALOG_FIELD_ID, 'type': 'catalog', 'name': 'Объект',
+            'info': {'code': 'Cat', 'catalog_id': CATALOG_ID}
+        },
+        {
+            'id': CHECKMARK_FIELD_ID, 'type': 'checkmark', 'name': 'Срочно',
+            'info': {'code': 'Chk'}
+        },
+    ]
+    for i in range(extra_columns):
+        fields.append({
+            'id': EXTRA_FIELD_ID + i, 'type': 'text', 'name': f'Колонка {i}',
+            'info': {'code': f'Col{i}'}
+        })
+    return {'id': form_id, 'name': f'Источник {form_id}', 'fields': fields}
+
+
+def make_registry(
+        form_id: int,
+        size: int,
+        extra_columns: int = 0,
+        cardinality: int = 5,
+        seed: int = 1
+) -> dict:
+    """
+
+    Реестр формы-источника со случайными задачами.
+
+    :param form_id: id формы
+    :param size: количество задач
+    :param extra_columns: количество дополнительных текстовых полей
+    :param cardinality: количество разных значений дополнительных полей
+    :param seed: начальное значение генератора
+    :return: реестр в виде ответа API pyrus
+    """
+    rnd = random.Random(seed * 1000003 + form_id)
+    tasks = []
+    for i in range(size):
+        fields = []
+        status = rnd.randint(1, STATUSES)
+        fields.append({
+            'id': STATUS_FIELD_ID, 'type': 'multiple_choice',
+            'value': {
+                'choice_ids': [status], 'choice_names': [f'Статус {status}']
+            }
+        })
+        if rnd.random() > 0.1:
+            person = rnd.randint(1, PERSONS)
+            fields.append({
+                'id': PERSON_FIELD_ID, 'type': 'person',
+                'value': {
+                    'id': person, 'first_name': 'Имя',
+                    'last_name': f'Фамилия{person}', 'type': 'user'
+                }
+            })
+        fields.append({
+            'id': CITY_FIELD_ID, 'type': 'text', 'value': rnd.choice(CITIES)
+        })
+        if rnd.random() > 0.2:
+            item = rnd.randint(1, CATALOG_ITEMS)
+            fields.append({
+                'id': CATALOG_FIELD_ID, 'type': 'catalog',
+                'value': {
+                    'item_id': item, 'item_ids': [item],
+                    'values': [f'Объект {item}', f'Адрес {item}'],
+                    'headers': ['Название', 'Адрес']
+                }
+            })
+        fields.append({
+            'id': CHECKMARK_FIELD_ID, 'type': 'checkmark',
+            'value': rnd.choice(('checked', 'unchecked'))
+        })
+        for column in range(extra_columns):
+            fields.append({
+                'id': EXTRA_FIELD_ID + column, 'type': 'text',
+                'value': f'Значение {rnd.randint(1, cardinality)}'
+            })
+        tasks.append({
+            'id': form_id * 10000000 + i,
+            'form_id': form_id,
+            'create_date': '2024-01-01T00:00:00Z',
+            'last_modified_date': '2024-01-01T00:00:00Z',
+            'fields': fields
+        })
+    return {'tasks': tasks}
+
+
+def make_contacts() -> dict:
+    """
+
+    Контакты организации для синтетических исполнителей.
+
+    :return: контакты в виде ответа API pyrus
+    """
+    return {
+        'organizations': [{
+            'id': 1,
+            'name': 'Организация',
+            'persons': [
+                {
+                    'id': person, 'first_name': 'Имя',
+                    'last_name': f'Фамилия{person}'
+                }
+                for person in range(1, PERSONS + 1)
+            ],
+            'roles': [{'id': 100000, 'name': 'Отдел продаж'}],
+        }]
+    }
+
+
+def make_catalog() -> dict:
+    """
+
+    Справочник для синтетического поля-справочника.
+
+    :return: справочник в виде ответа API pyrus
+    """
+    return {
+        'catalog_id': CATALOG_ID,
+        'catalog_headers': [],
+        'items': [
+            {'item_id': item, 'values': [f'Объект {item}', f'Адрес {item}']}
+            for item in range(1, CATALOG_ITEMS + 1)
+        ]
+    }
+
+
+def make_report_form(
+        source_form_ids: list,
+        extra_columns: int = 0,
+        cardinality: int = 5
+) -> dict:
+    """
+
+    Шаблон формы отчета с таблицами REPORT_ и сортировками $SRT_.
+
+    На каждую форму-источник две таблицы: по статусам и по исполнителям.
+
+    :param source_form_ids: id форм-источников
+    :param extra_columns: количество дополнительных текстовых полей
+    :param cardinality: количество разных значений дополнительных полей
+    :return: шаблон формы в виде ответа API pyrus
+    """
+    fields = []
+    for n, form_id in enumerate(source_form_ids):
+        table_id = 20000 * (n + 1)
+        fields.append(_make_table(
+            table_id, f'REPORT_{form_id}', 'status',
+            _status_table_columns(extra_columns, cardinality)
+        ))
+        fields.append(_make_table(
+            table_id + 10000, f'REPORT_{form_id}_people', 'Resp',
+            [
+                (f'Статус {i}', 'Status' + ('$SRT_2_DESC' if i == 1 else ''))
+                for i in range(1, STATUSES + 1)
+            ]
+        ))
+    fields.append({
+        'id': FILTERS_TABLE_ID, 'type': 'table', 'name': 'Фильтры',
+        'info': {
+            'code': 'filters',
+            'columns': [
+                {'id': FILTERS_TABLE_ID + 1, 'type': 'text',
+                 'name': 'Таблица', 'info': {'code': 'filter_table'}},
+                {'id': FILTERS_TABLE_ID + 2, 'type': 'text',
+                 'name': 'Поле', 'info': {'code': 'filter_field'}},
+                {'id': FILTERS_TABLE_ID + 3, 'type': 'text',
+                 'name': 'Значение', 'info': {'code': 'filter_value'}},
+            ]
+        }
+    })
+    return {'id': REPORT_FORM_ID, 'name': 'Отчет', 'fields': fields}
+
+
+def make_report_task(
+        task_id: int,
+        report_form: dict,
+        filters: tuple = ()
+) -> TaskWithCommentsPlus:
+    """
+
+    Задача отчета с пустыми таблицами и таблицей фильтров.
+
+    Информацию о полях из шаблона добавляет update_task_field_info.
+
+    :param task_id: id задачи
+    :param report_form: шаблон формы отчета
+    :param filters: фильтры вида ((юкод таблицы, юкод поля, значение), ...)
+    :return: задача отчета
+    """
+    fields = [
+        {'id': field['id'], 'type': 'table', 'value': []}
+        for field in report_form['fields']
+        if field['id'] != FILTERS_TABLE_ID
+    ]
+    fields.append({
+        'id': FILTERS_TABLE_ID, 'type': 'table',
+        'value': [
+            {
+                'row_id': row_id,
+                'cells': [
+                    {'id': FILTERS_TABLE_ID + 1 + i, 'type': 'text',
+                     'value': value}
+                    for i, value in enumerate(row)
+                ]
+            }
+            for row_id, row in enumerate(filters)
+        ]
+    })
+    return TaskWithCommentsPlus(
+        id=task_id, form_id=REPORT_FORM_ID, fields=fields, comments=[]
+    )
+
+
+def _status_table_columns(extra_columns: int, cardinality: int) -> list:
+    columns = [(city, 'City') for city in CITIES]
+    columns += [
+        (f'Имя Фамилия{person}', 'Resp$SRT_2_ASC' if person == 1 else 'Resp')
+        for person in range(1, 11)
+    ]
+    columns += [(f'Объект {item}', 'Cat') for item in range(1, 11)]
+    columns += [('Нет значения', 'Cat'), ('checked', 'Chk')]
+    for column in range(extra_columns):
+        columns += [
+            (f'Значение {value}', f'Col{column}')
+            for value in range(1, cardinality + 1)
+        ]
+    return columns
+
+
+def _make_table(
+        table_id: int,
+        code: str,
+        first_code: str,
+        counted_columns: list
+) -> dict:
+    columns = [
+        {'id': table_id + 1, 'type': 'text', 'name': 'Группа',
+         'info': {'code': first_code}},
+        {'id': table_id + 2, 'type': 'number', 'name': 'Итого',
+         'info': {'code': 'total$SRT_1_DESC'}},
+        {'id': table_id + 3, 'type': 'text', 'name': 'Реестр',
+         'info': {'code': 'registry'}},
+    ]
+    for i, (name, column_code) in enumerate(counted_columns):
+        columns.append({
+            'id': table_id + 10 + i, 'type': 'number', 'name': name,
+            'info': {'code': column_code}
+        })
+    return {
+        'id': table_id, 'type': 'table', 'name': code,
+        'info': {'code': code, 'columns': columns}
+    }
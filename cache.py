@@ -0,0 +1,255 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+import metrics
+
+from pyrustools.client_plus import MyPyrus
+from pyrustools.objects_plus import FormResponsePlus
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 60
+DEFAULT_FORMS_SIZE = 64
+DEFAULT_REGISTRIES_SIZE = 8
+DEFAULT_DIRECTORY_TTL = 600
+DEFAULT_CATALOGS_SIZE = 32
+
+
+class SingleFlight:
+    """Объединение одновременных загрузок по одному ключу в одну."""
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Any, loader: Callable[[], Any]) -> Any:
+        """
+
+        Загрузка значения без повторных одновременных запросов.
+
+        Первый поток выполняет loader, остальные ждут его результат.
+
+        :param key: ключ
+        :param loader: функция загрузки значения
+        :return: значение
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event()}
+                self._calls[key] = call
+            else:
+                self.shared += 1
+        if not leader:
+            call['event'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['value']
+        try:
+            call['value'] = loader()
+        except Exception as error:
+            call['error'] = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['event'].set()
+        return call['value']
+
+
+class TTLCache:
+    """Потокобезопасный кэш с ограничением размера, TTL и вытеснением LRU."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    def configure(self, maxsize: int = None, ttl: float = None) -> None:
+        """
+
+        Изменение ограничений кэша.
+
+        :param maxsize: максимальное количество записей
+        :param ttl: время жизни записи в секундах
+        :return:
+        """
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            self._evict()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """
+
+        Получение значения из кэша.
+
+        :param key: ключ
+        :param default: значение, если ключа нет или запись устарела
+        :return: значение из кэша
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Any, value: Any) -> None:
+        """
+
+        Запись значения в кэш.
+
+        :param key: ключ
+        :param value: значение
+        :return:
+        """
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            self._evict()
+
+    def get_or_load(self, key: Any, loader: Callable[[], Any]) -> Any:
+        """
+
+        Получение значения из кэша или его загрузка.
+
+        Одновременные промахи по одному ключу ждут одну загрузку.
+
+        :param key: ключ
+        :param loader: функция загрузки значения при промахе
+        :return: значение
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = self._flight.do(key, lambda: self._load(key, loader))
+        return value
+
+    def _load(self, key: Any, loader: Callable[[], Any]) -> Any:
+        # Пока ждали очереди, значение мог загрузить другой поток
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] >= time.monotonic():
+                return item[1]
+        value = loader()
+        # Ответы pyrus с ошибкой не кэшируем
+        if getattr(value, 'error', None) is None:
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key: Any = None) -> None:
+        """
+
+        Удаление записи или очистка всего кэша.
+
+        :param key: ключ, если не передан - очищается весь кэш
+        :return:
+        """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        """
+
+        Счетчики кэша.
+
+        :return: словарь вида {название счетчика: значение}
+        """
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'shared': self._flight.shared,
+            }
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        expired = [key for key, item in self._data.items() if item[0] < now]
+        for key in expired:
+            del self._data[key]
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+
+forms = TTLCache(DEFAULT_FORMS_SIZE, DEFAULT_TTL)
+registries = TTLCache(DEFAULT_REGISTRIES_SIZE, DEFAULT_TTL)
+# Индексы контактов и справочников для разбора фильтров
+contacts = TTLCache(DEFAULT_CATALOGS_SIZE, DEFAULT_DIRECTORY_TTL)
+catalogs = TTLCache(DEFAULT_CATALOGS_SIZE, DEFAULT_DIRECTORY_TTL)
+
+
+def get_client_key(client: MyPyrus) -> tuple:
+    """
+
+    Ключ данных клиента в общих кэшах: хост и аккаунт.
+
+    Разные аккаунты одного хоста видят разные контакты и задачи,
+    поэтому данные одного аккаунта не должны попадать к другому.
+    Аккаунт - пользователь бота из вебхука (process_task задает его
+    любому клиенту) или логин бота при тестовом запуске. Токен
+    ключом не бывает: он меняется и не говорит, чей это аккаунт.
+
+    :param client: сущность клиента pyrus
+    :return: кортеж (хост, аккаунт)
+    :raises ValueError: если у клиента нет ни аккаунта, ни логина
+    """
+    account = getattr(client, 'account', None) or client.login
+    if account is None:
+        raise ValueError('Pyrus API client has neither account nor login '
+                         'to key the shared caches')
+    return client._host, account
+
+
+def get_form(client: MyPyrus, form_id: int) -> FormResponsePlus:
+    """
+
+    Получение шаблона формы через общий кэш.
+
+    :param client: сущность клиента pyrus
+    :param form_id: id формы
+    :return: шаблон формы
+    """
+    return forms.get_or_load(
+        (*get_client_key(client), form_id),
+        lambda: metrics.call_api('get_form', client.get_form, form_id)
+    )
+
+
+def stats() -> dict:
+    """
+
+    Счетчики всех общих кэшей.
+
+    :return: словарь вида {название кэша: счетчики}
+    """
+    return {
+        'forms': forms.stats(),
+        'registries': registries.stats(),
+        'contacts': contacts.stats(),
+        'catalogs': catalogs.stats(),
+    }
@@ -0,0 +1,281 @@
+import gzip
+import json
+import logging
+import threading
+import time
+from typing import IO, Iterator
+from urllib.parse import urlsplit
+
+from pyrus.models import requests as req
+
+from pyrustools.client_plus import MyPyrus
+
+import registry_stream
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+# Запросы, которые изменяют данные в pyrus и при воспроизведении не нужны
+WRITE_PATH_SUFFIXES = ('/comments',)
+# Задержка воспроизведения, равная записанной длительности запроса
+LATENCY_RECORDED = 'recorded'
+
+
+def request_key(method: str, path: str, body: (str, None)) -> tuple:
+    """
+
+    Ключ запроса к API в кассете.
+
+    :param method: HTTP-метод
+    :param path: путь запроса без хоста и версии API, например /forms/1
+    :param body: тело запроса в JSON или None
+    :return: ключ вида (метод, путь, тело)
+    """
+    return method, path, body or None
+
+
+def parse_latency(value: str) -> (float, str):
+    """
+
+    Разбор задержки воспроизведения из командной строки.
+
+    :param value: число секунд или 'recorded'
+    :return: задержка в секундах или LATENCY_RECORDED
+    """
+    if value == LATENCY_RECORDED:
+        return value
+    return float(value)
+
+
+def open_cassette(path: str, mode: str = 'r') -> IO[str]:
+    """
+
+    Открытие файла кассеты, файлы с расширением .gz сжимаются gzip.
+
+    :param path: путь к файлу кассеты
+    :param mode: 'r' для чтения или 'w' для записи
+    :return: текстовый файл
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf8')
+    return open(path, mode, encoding='utf8')
+
+
+def load_interactions(path: str) -> dict:
+    """
+
+    Чтение кассеты с записанными ответами API.
+
+    Кассета - файл JSON Lines, каждая строка - объект вида
+    {"method": "GET", "path": "/forms/1", "body": null, "seconds": 0.2,
+    "response": {...}}.
+    Ответы на один и тот же запрос отдаются в порядке записи.
+
+    :param path: путь к файлу кассеты
+    :return: словарь вида {ключ запроса: [запись, ...]},
+     ответ в записи хранится строкой JSON
+    """
+    interactions = {}
+    with open_cassette(path) as cassette_file:
+        for line in cassette_file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record['response'] = json.dumps(
+                record['response'], ensure_ascii=False
+            )
+            key = request_key(
+                record['method'], record['path'], record.get('body')
+            )
+            interactions.setdefault(key, []).append(record)
+    return interactions
+
+
+def registry_chunks(
+        client: MyPyrus,
+        form_id: int,
+        request: req.FormRegisterRequest = None
+) -> Iterator[bytes]:
+    """
+
+    Реестр, полученный обычным запросом, кусками, как при потоковой загрузке.
+
+    :param client: клиент с записью или воспроизведением запросов
+    :param form_id: id формы
+    :param request: запрос с полями и фильтрами
+    :return: куски ответа
+    """
+    url = client._create_url(f'/forms/{form_id}/register')
+    method = client.HTTPMethod.POST if request else client.HTTPMethod.GET
+    response = client._perform_request_with_retry(url, method, request)
+    body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+    size = registry_stream.CHUNK_SIZE
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+class RecordingPyrus(MyPyrus):
+    """
+
+    Клиент pyrus, который записывает запросы и ответы в кассету.
+
+    Записываются все запросы MyPyrus (задачи, формы, реестры, контакты,
+    справочники, комментарии), кроме загрузки файлов.
+    Потоковая загрузка реестра при записи идет обычным запросом.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        """
+
+        Открытие кассеты на запись.
+
+        :param path: путь к файлу кассеты, .gz - со сжатием
+        :param kwargs: параметры MyPyrus
+        """
+        super().__init__(**kwargs)
+        self.path = path
+        self._file = open_cassette(path, 'w')
+        self._lock = threading.Lock()
+
+    def get_registry_chunks(
+            self,
+            form_id: int,
+            request: req.FormRegisterRequest = None
+    ) -> Iterator[bytes]:
+        """Реестр кусками с записью в кассету."""
+        return registry_chunks(self, form_id, request)
+
+    def close(self) -> None:
+        """Закрытие кассеты."""
+        with self._lock:
+            self._file.close()
+
+    def _perform_request_with_retry(
+            self,
+            url: str,
+            method: MyPyrus.HTTPMethod,
+            body: object = None,
+            file_path: str = None,
+            get_file: bool = False
+    ):
+        start = time.perf_counter()
+        response = super()._perform_request_with_retry(
+            url, method, body, file_path, get_file
+        )
+        if file_path or get_file or not isinstance(response, dict):
+            return response
+        path, body_text = _request_parts(self, url, body)
+        line = json.dumps({
+            'method': method.name,
+            'path': path,
+            'body': body_text,
+            'seconds': round(time.perf_counter() - start, 4),
+            'response': response,
+        }, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+        return response
+
+
+class ReplayPyrus(MyPyrus):
+    """
+
+    Клиент, который вместо обращений к pyrus отдает ответы из кассеты.
+
+    Подменяется общий метод выполнения запросов, поэтому все методы
+    MyPyrus (задачи, формы, реестры, контакты, справочники) работают
+    как с настоящим сервером. Комментарии не отправляются, а запоминаются.
+    """
+
+    _host = 'replay'
+
+    def __init__(self, path: str, latency: (float, str) = 0):
+        """
+
+        Загрузка кассеты.
+
+        :param path: путь к файлу кассеты
+        :param latency: задержка каждого запроса в секундах
+         или LATENCY_RECORDED, чтобы повторить записанные длительности
+        """
+        super().__init__(access_token='replay')
+        # В кассете данные одного аккаунта, ключ общих кэшей - кассета
+        self.account = 'replay'
+        self.interactions = load_interactions(path)
+        self.latency = latency
+        self.calls = []
+        self.comments = []
+        self._served = {}
+        self._lock = threading.Lock()
+
+    def initialize_from_file(self, config_file: str = 'config.json') -> None:
+        """Учетные данные при воспроизведении не нужны."""
+        logger.debug(f'Pyrus API client replays {len(self.interactions)} '
+                     f'requests, {config_file} is not used')
+
+    def task_ids(self) -> list:
+        """
+
+        Задачи, полученные при записи.
+
+        :return: id задач в порядке записи
+        """
+        task_ids = []
+        for method, path, _ in self.interactions:
+            parts = path.split('/')
+            if method == 'GET' and len(parts) == 3 and parts[1] == 'tasks':
+                task_ids.append(int(parts[2]))
+        return task_ids
+
+    def get_registry_chunks(
+            self,
+            form_id: int,
+            request: req.FormRegisterRequest = None
+    ) -> Iterator[bytes]:
+        """Записанный реестр кусками, как при потоковой загрузке."""
+        return registry_chunks(self, form_id, request)
+
+    def _perform_request_with_retry(
+            self,
+            url: str,
+            method: MyPyrus.HTTPMethod,
+            body: object = None,
+            file_path: str = None,
+            get_file: bool = False
+    ) -> dict:
+        path, body = _request_parts(self, url, body)
+        key = request_key(method.name, path, body)
+        record = self._next_record(key)
+        if path.endswith(WRITE_PATH_SUFFIXES):
+            with self._lock:
+                self.comments.append((path, body))
+        elif record is None:
+            raise LookupError(f'В кассете нет ответа на {method.name} {path}'
+                              f'{" " + body if body else ""}')
+        delay = self.latency
+        if delay == LATENCY_RECORDED:
+            delay = record.get('seconds', 0) if record else 0
+        if delay:
+            time.sleep(delay)
+        # Каждый раз новый объект, как после разбора ответа сервера
+        return json.loads(record['response']) if record else {}
+
+    def _next_record(self, key: tuple) -> (dict, None):
+        # Повторные запросы получают следующий записанный ответ,
+        # после последнего - снова последний
+        with self._lock:
+            self.calls.append(f'{key[0]} {key[1]}')
+            records = self.interactions.get(key)
+            if not records:
+                return None
+            index = self._served.get(key, 0)
+            self._served[key] = index + 1
+        return records[min(index, len(records) - 1)]
+
+
+def _request_parts(client: MyPyrus, url: str, body: object) -> tuple:
+    path = urlsplit(url).path[len(client._base_path):]
+    if body is None:
+        return path, None
+    return path, client.serialize_request(body).decode('utf-8')
@@ -0,0 +1,250 @@
+import logging
+import threading
+
+import api_scheduler
+
+from configuration_bot import BotConfig
+
+import metrics
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+# Хост с самоподписанным сертификатом, как в MyPyrus
+UNVERIFIED_HOST = 'pyrus.abk-invest.ru'
+
+# Общий пул клиентов процесса
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class ClientPool:
+    """
+
+    Общие для процесса клиенты pyrus, HTTP-соединения и токены.
+
+    Все клиенты работают через одну requests.Session, поэтому
+    TCP/TLS-соединения переиспользуются между запусками отчетов.
+    Токен хранится в пуле: для бота - последний токен из вебхуков
+    этого бота, для входа по логину - токен, который обновляется
+    одним потоком, пока остальные ждут его результат.
+    """
+
+    def __init__(self, scheduler: api_scheduler.ApiScheduler, size: int = 16):
+        """
+
+        Создание пула.
+
+        :param scheduler: планировщик запросов к API
+        :param size: количество постоянных соединений с каждым хостом
+        """
+        self.scheduler = scheduler
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._clients = {}
+        self._tokens = {}
+        self._auth_locks = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, account=None) -> 'PooledPyrus':
+        """
+
+        Клиент для аккаунта, один на процесс.
+
+        :param account: аккаунт (id пользователя-бота) или None
+         для входа по логину из файла
+        :return: клиент pyrus
+        """
+        with self._lock:
+            client = self._clients.get(account)
+            if client is None:
+                client = PooledPyrus(self, account)
+                self._clients[account] = client
+        return client
+
+    def get_token(self, key) -> (str, None):
+        """
+
+        Текущий токен.
+
+        :param key: ключ токена: аккаунт или (хост, логин)
+        :return: токен или None
+        """
+        with self._lock:
+            return self._tokens.get(key)
+
+    def set_token(self, key, token: (str, None)) -> None:
+        """
+
+        Сохранение токена для всех клиентов пула.
+
+        :param key: ключ токена: аккаунт или (хост, логин)
+        :param token: токен или None, чтобы забыть недействительный
+        :return:
+        """
+        with self._lock:
+            if token:
+                self._tokens[key] = token
+            else:
+                self._tokens.pop(key, None)
+
+    def auth_lock(self, key) -> threading.Lock:
+        """
+
+        Блокировка обновления токена.
+
+        :param key: ключ токена
+        :return: блокировка
+        """
+        with self._lock:
+            lock = self._auth_locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self._auth_locks[key] = lock
+            return lock
+
+    def stats(self) -> dict:
+        """
+
+        Состояние пула.
+
+        :return: словарь вида {название счетчика: значение}
+        """
+        with self._lock:
+            return {
+                'clients': len(self._clients),
+                'tokens': len(self._tokens),
+            }
+
+
+class PooledPyrus(api_scheduler.ScheduledPyrus):
+    """
+
+    Клиент pyrus с соединениями и токеном из ClientPool.
+
+    Запросы идут через общую сессию, токен читается из пула при каждом
+    запросе, поэтому токен, обновленный одним запуском отчета,
+    сразу используют остальные.
+    """
+
+    def __init__(self, pool: ClientPool, account=None):
+        """
+
+        Создание клиента.
+
+        :param pool: пул клиентов
+        :param account: аккаунт (id пользователя-бота) или None
+        """
+        self.pool = pool
+        super().__init__(pool.scheduler)
+        self.account = account
+
+    @property
+    def access_token(self) -> (str, None):
+        """Токен из пула."""
+        return self.pool.get_token(self.token_key)
+
+    @access_token.setter
+    def access_token(self, token: (str, None)) -> None:
+        # MyPyrus сбрасывает токен в конструкторе, общий токен не трогаем
+        if token:
+            self.pool.set_token(self.token_key, token)
+
+    @property
+    def token_key(self):
+        """Ключ токена: аккаунт бота или хост и логин."""
+        return self.account or (self._host, self.login)
+
+    @property
+    def session(self) -> requests.Session:
+        """Общая сессия пула."""
+        return self.pool.session
+
+    def initialize(self) -> None:
+        """Вход по логину, если в пуле еще нет токена."""
+        if self.access_token:
+            logger.debug('Pyrus API client reuses the pooled token')
+            return
+        super().initialize()
+
+    def _auth(self) -> dict:
+        # Токен обновляет один поток, остальные ждут и берут его результат
+        stale = self.access_token
+        with self.pool.auth_lock(self.token_key):
+            current = self.access_token
+            if current and current != stale:
+                return {'access_token': current}
+            if self.login is None:
+                # Токен бота обновляется только новым вебхуком
+                return {
+                    'error': 'Токен бота недействителен',
+                    'error_code': 'access_token_expired'
+                }
+            metrics.inc('pyrus_auth_total', help_text='Получение токена pyrus')
+            response = self.session.post(
+                self._create_url('/auth'),
+                headers={
+                    'User-Agent': f'{self._user_agent}',
+                    'Content-Type': 'application/json'
+                },
+                json={'login': self.login, 'security_key': self.security_key},
+                verify=False
+            )
+            body = response.json()
+            if response.status_code == requests.codes.ok:
+                self.pool.set_token(self.token_key, body['access_token'])
+            else:
+                self.pool.set_token(self.token_key, None)
+            return body
+
+    def _get_request(self, url: str, verify: bool = True):
+        return self.session.get(
+            url, headers=self._create_default_headers(), proxies=self.proxy,
+            verify=self._verify(verify)
+        )
+
+    def _get_file_request(self, url: str, verify: bool = True):
+        return self.session.get(
+            url, headers=self._create_default_headers(), proxies=self.proxy,
+            stream=True, verify=self._verify(verify)
+        )
+
+    def _post_request(self, url: str, body: object, verify: bool = True):
+        return self.session.post(
+            url, headers=self._create_default_headers(),
+            data=self.serialize_request(body) if body else None,
+            proxies=self.proxy, verify=self._verify(verify)
+        )
+
+    def _put_request(self, url: str, body: object, verify: bool = True):
+        return self.session.put(
+            url, headers=self._create_default_headers(),
+            data=self.serialize_request(body) if body else None,
+            proxies=self.proxy, verify=self._verify(verify)
+        )
+
+    def _verify(self, verify: bool) -> bool:
+        return verify and self._host != UNVERIFIED_HOST
+
+
+def get_pool(config: BotConfig) -> ClientPool:
+    """
+
+    Общий пул клиентов процесса.
+
+    :param config: конфигурационный файл
+    :return: пул клиентов
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ClientPool(
+                api_scheduler.get_scheduler(config), config.http_pool_size
+            )
+        return _pool
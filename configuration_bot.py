@@ -7,3 +7,62 @@ class BotConfig:
         self.total_code = config.get('TOTAL_CODE')
         self.registry_code = config.get('REGISTRY_CODE')
         self.filters_code = config.get('CODE_ADDITIONAL_FILTERS')
+        self.cache_ttl = config.get('CACHE_TTL')
+        self.cache_forms_size = config.get('CACHE_FORMS_SIZE')
+        self.cache_registries_size = config.get('CACHE_REGISTRIES_SIZE')
+        self.cache_directory_ttl = config.get('CACHE_DIRECTORY_TTL')
+        self.workers_count = config.get('WORKERS_COUNT', 4)
+        self.queue_size = config.get('QUEUE_SIZE', 100)
+        self.queue_full_policy = config.get('QUEUE_FULL_POLICY', 'reject')
+        self.queue_put_timeout = config.get('QUEUE_PUT_TIMEOUT', 1)
+        self.fingerprint_store = config.get('FINGERPRINT_STORE', 'memory')
+        self.fingerprint_db = config.get('FINGERPRINT_DB', 'fingerprints.db')
+        self.fingerprint_memory_size = config.get(
+            'FINGERPRINT_MEMORY_SIZE', 1000
+        )
+        self.fingerprint_memory_ttl = config.get(
+            'FINGERPRINT_MEMORY_TTL', 86400
+        )
+        self.incremental_reports = config.get('INCREMENTAL_REPORTS', False)
+        self.incremental_store = config.get('INCREMENTAL_STORE', 'memory')
+        self.incremental_db = config.get(
+            'INCREMENTAL_DB', 'crosstab_state.db'
+        )
+        self.rebuild_command = config.get('REBUILD_COMMAND', '/rebuild')
+        self.fetch_workers = config.get('FETCH_WORKERS', 4)
+        self.registry_streaming = config.get('REGISTRY_STREAMING', False)
+        self.registry_server_filters = config.get(
+            'REGISTRY_SERVER_FILTERS', True
+        )
+        self.aggregation_backend = config.get(
+            'AGGREGATION_BACKEND', 'python'
+        )
+        self.aggregation_processes = config.get('AGGREGATION_PROCESSES', 0)
+        self.task_lock_directory = config.get(
+            'TASK_LOCK_DIRECTORY', 'task_locks'
+        )
+        self.metrics_directory = config.get('METRICS_DIRECTORY', '')
+        self.metrics_flush_interval = config.get(
+            'METRICS_FLUSH_INTERVAL', 5
+        )
+        self.web_port = config.get('WEB_PORT', 5000)
+        self.web_workers = config.get('WEB_WORKERS', 2)
+        self.web_threads = config.get('WEB_THREADS', 8)
+        self.web_timeout = config.get('WEB_TIMEOUT', 30)
+        self.job_queue = config.get('JOB_QUEUE', 'memory')
+        self.job_queue_db = config.get('JOB_QUEUE_DB', 'jobs.db')
+        self.job_max_attempts = config.get('JOB_MAX_ATTEMPTS', 5)
+        self.job_retry_backoff = config.get('JOB_RETRY_BACKOFF', 5)
+        self.job_max_backoff = config.get('JOB_MAX_BACKOFF', 300)
+        self.job_visibility_timeout = config.get(
+            'JOB_VISIBILITY_TIMEOUT', 120
+        )
+        self.job_poll_interval = config.get('JOB_POLL_INTERVAL', 1)
+        self.job_worker_processes = config.get('JOB_WORKER_PROCESSES', 2)
+        self.api_rate = config.get('API_RATE', 8)
+        self.api_burst = config.get('API_BURST', 20)
+        self.api_max_retries = config.get('API_MAX_RETRIES', 5)
+        self.api_retry_backoff = config.get('API_RETRY_BACKOFF', 1)
+        self.api_max_backoff = config.get('API_MAX_BACKOFF', 60)
+        self.api_max_wait = config.get('API_MAX_WAIT', 10)
+        self.http_pool_size = config.get('HTTP_POOL_SIZE', 16)
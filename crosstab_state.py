@@ -0,0 +1,726 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+from bisect import insort
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Callable
+
+from configuration_bot import BotConfig
+
+from forms import registry_snapshot, report_plan
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+BACKEND_MEMORY = 'memory'
+BACKEND_SQLITE = 'sqlite'
+# Версия формата состояния, входит в подпись: состояния старого
+# формата пересчитываются
+STATE_VERSION = 3
+
+# Созданные хранилища вида {(тип хранилища, путь к базе): хранилище}
+_stores = {}
+_lock = threading.Lock()
+
+
+class MemoryStateStore:
+    """
+
+    Хранилище состояния кросс-таблиц в памяти процесса.
+
+    Состояние хранится в виде JSON, как и в SQLite, поэтому
+    изменение полученного словаря не меняет сохраненное состояние.
+    """
+
+    def __init__(self):
+        # Отчеты вида {id задачи отчета: [подпись, состояние, ревизия]}
+        self._reports = {}
+        # Проекции задач вида {id задачи отчета: {id задачи:
+        # (проекция, ревизия, в которой задача изменилась вебхуком)}}
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def get(self, report_id: int) -> (tuple, None):
+        """
+
+        Получение состояния отчета.
+
+        :param report_id: id задачи отчета
+        :return: кортеж (подпись, состояние, ревизия) или None
+        """
+        with self._lock:
+            item = self._reports.get(report_id)
+        if item is None:
+            return None
+        return item[0], json.loads(item[1]), item[2]
+
+    def get_reports(self, form_id: int) -> list:
+        """
+
+        Отчеты, которые строятся по форме-источнику.
+
+        :param form_id: id формы-источника
+        :return: список id задач отчетов
+        """
+        with self._lock:
+            return [
+                report_id for report_id, (_, state, _) in self._reports.items()
+                if str(form_id) in json.loads(state)['forms']
+            ]
+
+    def replace(
+            self,
+            report_id: int,
+            signature: str,
+            state: dict,
+            projections: dict,
+            since: int = 0,
+            reapply: Callable[[dict, int, dict, dict], None] = None
+    ) -> int:
+        """
+
+        Сохранение состояния отчета после полного пересчета.
+
+        Задачи, измененные вебхуками после ревизии since, могли попасть
+        в реестр до изменения, поэтому их проекции из хранилища
+        применяются к новому состоянию через reapply.
+
+        :param report_id: id задачи отчета
+        :param signature: подпись входных данных, кроме реестров
+        :param state: состояние кросс-таблиц, изменяется на месте
+        :param projections: проекции задач вида {id задачи: проекция},
+         изменяются на месте
+        :param since: ревизия состояния до загрузки реестров
+        :param reapply: функция (состояние, id задачи, проекция из реестра,
+         проекция из вебхука), изменяющая состояние
+        :return: новая ревизия состояния
+        """
+        with self._lock:
+            revision = self._reports.get(report_id, (None, None, 0))[2] + 1
+            for task_id, (data, changed) in list(
+                    self._tasks.get(report_id, {}).items()):
+                if changed > since and reapply is not None:
+                    new = json.loads(data)
+                    reapply(state, task_id, projections.get(task_id), new)
+                    projections[task_id] = new
+            self._reports[report_id] = (
+                signature, json.dumps(state, ensure_ascii=False), revision
+            )
+            self._tasks[report_id] = {
+                task_id: (json.dumps(projection, ensure_ascii=False), 0)
+                for task_id, projection in projections.items()
+            }
+        return revision
+
+    def update(
+            self,
+            report_id: int,
+            task_id: int,
+            signature: str,
+            apply: Callable[[dict, dict], dict]
+    ) -> (tuple, None):
+        """
+
+        Применение изменения одной задачи к состоянию отчета.
+
+        :param report_id: id задачи отчета
+        :param task_id: id изменившейся задачи формы-источника
+        :param signature: подпись входных данных, с которой считалось
+         изменение
+        :param apply: функция (состояние, старая проекция) -> новая
+         проекция, изменяющая состояние
+        :return: кортеж (состояние, ревизия) или None, если состояния
+         нет или оно построено по другим шаблонам и фильтрам
+        """
+        with self._lock:
+            item = self._reports.get(report_id)
+            if item is None or item[0] != signature:
+                return None
+            state = json.loads(item[1])
+            tasks = self._tasks.setdefault(report_id, {})
+            old = tasks.get(task_id)
+            old = json.loads(old[0]) if old is not None else None
+            new = apply(state, old)
+            if new == old:
+                return state, item[2]
+            revision = item[2] + 1
+            self._reports[report_id] = (
+                signature, json.dumps(state, ensure_ascii=False), revision
+            )
+            tasks[task_id] = (json.dumps(new, ensure_ascii=False), revision)
+        return state, revision
+
+    def delete(self, report_id: int) -> None:
+        """
+
+        Удаление состояния отчета.
+
+        :param report_id: id задачи отчета
+        :return:
+        """
+        with self._lock:
+            self._reports.pop(report_id, None)
+            self._tasks.pop(report_id, None)
+
+
+class SqliteStateStore:
+    """
+
+    Хранилище состояния кросс-таблиц в файле SQLite.
+
+    Переживает перезапуск и общее для процессов веб-сервера
+    и обработчиков очереди: изменения одного отчета применяются
+    в транзакциях по очереди.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._transaction() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS crosstab_reports ('
+                'report_id INTEGER PRIMARY KEY, signature TEXT NOT NULL, '
+                'state TEXT NOT NULL, revision INTEGER NOT NULL)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS crosstab_forms ('
+                'form_id INTEGER, report_id INTEGER, '
+                'PRIMARY KEY (form_id, report_id))'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS crosstab_tasks ('
+                'report_id INTEGER, task_id INTEGER, '
+                'projection TEXT NOT NULL, revision INTEGER NOT NULL, '
+                'PRIMARY KEY (report_id, task_id))'
+            )
+
+    def get(self, report_id: int) -> (tuple, None):
+        """
+
+        Получение состояния отчета.
+
+        :param report_id: id задачи отчета
+        :return: кортеж (подпись, состояние, ревизия) или None
+        """
+        with self._transaction() as connection:
+            row = connection.execute(
+                'SELECT signature, state, revision FROM crosstab_reports '
+                'WHERE report_id = ?', (report_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]), row[2]
+
+    def get_reports(self, form_id: int) -> list:
+        """
+
+        Отчеты, которые строятся по форме-источнику.
+
+        :param form_id: id формы-источника
+        :return: список id задач отчетов
+        """
+        with self._transaction() as connection:
+            rows = connection.execute(
+                'SELECT report_id FROM crosstab_forms WHERE form_id = ?',
+                (form_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def replace(
+            self,
+            report_id: int,
+            signature: str,
+            state: dict,
+            projections: dict,
+            since: int = 0,
+            reapply: Callable[[dict, int, dict, dict], None] = None
+    ) -> int:
+        """
+
+        Сохранение состояния отчета после полного пересчета.
+
+        Задачи, измененные вебхуками после ревизии since, могли попасть
+        в реестр до изменения, поэтому их проекции из хранилища
+        применяются к новому состоянию через reapply.
+
+        :param report_id: id задачи отчета
+        :param signature: подпись входных данных, кроме реестров
+        :param state: состояние кросс-таблиц, изменяется на месте
+        :param projections: проекции задач вида {id задачи: проекция},
+         изменяются на месте
+        :param since: ревизия состояния до загрузки реестров
+        :param reapply: функция (состояние, id задачи, проекция из реестра,
+         проекция из вебхука), изменяющая состояние
+        :return: новая ревизия состояния
+        """
+        with self._transaction() as connection:
+            row = connection.execute(
+                'SELECT revision FROM crosstab_reports WHERE report_id = ?',
+                (report_id,)
+            ).fetchone()
+            revision = (row[0] if row else 0) + 1
+            changed = connection.execute(
+                'SELECT task_id, projection FROM crosstab_tasks '
+                'WHERE report_id = ? AND revision > ?', (report_id, since)
+            ).fetchall()
+            for task_id, projection in changed:
+                if reapply is not None:
+                    new = json.loads(projection)
+                    reapply(state, task_id, projections.get(task_id), new)
+                    projections[task_id] = new
+            data = json.dumps(state, ensure_ascii=False)
+            connection.execute(
+                'INSERT OR REPLACE INTO crosstab_reports VALUES (?, ?, ?, ?)',
+                (report_id, signature, data, revision)
+            )
+            self._delete(connection, report_id, reports=False)
+            connection.executemany(
+                'INSERT INTO crosstab_forms VALUES (?, ?)',
+                ((int(form_id), report_id) for form_id in state['forms'])
+            )
+            connection.executemany(
+                'INSERT INTO crosstab_tasks VALUES (?, ?, ?, 0)',
+                (
+                    (report_id, task_id,
+                     json.dumps(projection, ensure_ascii=False))
+                    for task_id, projection in projections.items()
+                )
+            )
+        return revision
+
+    def update(
+            self,
+            report_id: int,
+            task_id: int,
+            signature: str,
+            apply: Callable[[dict, dict], dict]
+    ) -> (tuple, None):
+        """
+
+        Применение изменения одной задачи к состоянию отчета.
+
+        :param report_id: id задачи отчета
+        :param task_id: id изменившейся задачи формы-источника
+        :param signature: подпись входных данных, с которой считалось
+         изменение
+        :param apply: функция (состояние, старая проекция) -> новая
+         проекция, изменяющая состояние
+        :return: кортеж (состояние, ревизия) или None, если состояния
+         нет или оно построено по другим шаблонам и фильтрам
+        """
+        with self._transaction() as connection:
+            row = connection.execute(
+                'SELECT signature, state, revision FROM crosstab_reports '
+                'WHERE report_id = ?', (report_id,)
+            ).fetchone()
+            if row is None or row[0] != signature:
+                return None
+            state, revision = json.loads(row[1]), row[2]
+            old = connection.execute(
+                'SELECT projection FROM crosstab_tasks '
+                'WHERE report_id = ? AND task_id = ?', (report_id, task_id)
+            ).fetchone()
+            old = json.loads(old[0]) if old is not None else None
+            new = apply(state, old)
+            if new == old:
+                return state, revision
+            revision += 1
+            connection.execute(
+                'UPDATE crosstab_reports SET state = ?, revision = ? '
+                'WHERE report_id = ?',
+                (json.dumps(state, ensure_ascii=False), revision, report_id)
+            )
+            connection.execute(
+                'INSERT OR REPLACE INTO crosstab_tasks VALUES (?, ?, ?, ?)',
+                (report_id, task_id, json.dumps(new, ensure_ascii=False),
+                 revision)
+            )
+        return state, revision
+
+    def delete(self, report_id: int) -> None:
+        """
+
+        Удаление состояния отчета.
+
+        :param report_id: id задачи отчета
+        :return:
+        """
+        with self._transaction() as connection:
+            self._delete(connection, report_id)
+
+    @staticmethod
+    def _delete(connection, report_id: int, reports: bool = True) -> None:
+        if reports:
+            connection.execute(
+                'DELETE FROM crosstab_reports WHERE report_id = ?',
+                (report_id,)
+            )
+        connection.execute(
+            'DELETE FROM crosstab_forms WHERE report_id = ?', (report_id,)
+        )
+        connection.execute(
+            'DELETE FROM crosstab_tasks WHERE report_id = ?', (report_id,)
+        )
+
+    @contextmanager
+    def _transaction(self):
+        # Чтение и запись состояния идут в одной транзакции с блокировкой
+        # записи, поэтому изменения разных задач не теряются
+        connection = sqlite3.connect(
+            self.path, timeout=30, isolation_level=None
+        )
+        try:
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+
+def get_store(config: BotConfig):
+    """
+
+    Получение хранилища состояния кросс-таблиц по настройкам.
+
+    :param config: конфигурационный файл
+    :return: хранилище состояния
+    """
+    backend = config.incremental_store
+    path = config.incremental_db
+    with _lock:
+        store = _stores.get((backend, path))
+        if store is None:
+            if backend == BACKEND_SQLITE:
+                store = SqliteStateStore(path)
+            else:
+                store = MemoryStateStore()
+            _stores[(backend, path)] = store
+    return store
+
+
+def get_signature(
+        plan: report_plan.ReportPlan,
+        filters: dict,
+        sources: dict
+) -> str:
+    """
+
+    Подпись входных данных отчета без содержимого реестров.
+
+    Пока подпись не меняется, состояние можно обновлять по изменениям
+    отдельных задач. Изменение шаблонов или фильтров требует
+    полного пересчета.
+
+    :param plan: скомпилированный план отчета
+    :param filters: дополнительные фильтры вида
+     {юкод таблицы: список фильтров}
+    :param sources: шаблоны форм-источников вида
+     {id формы: [шаблон формы, срез реестра, версия шаблона формы, ...]}
+    :return: строка-подпись
+    """
+    digest = hashlib.sha1()
+    digest.update(f'{STATE_VERSION}:{plan.form_id}:{plan.version}'.encode(
+        'utf-8'
+    ))
+    digest.update(
+        json.dumps(filters, ensure_ascii=False, sort_keys=True,
+                   default=str).encode('utf-8')
+    )
+    for form_id in sorted(sources):
+        digest.update(f'|{form_id}:{sources[form_id][2]}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def project_row(
+        snapshot: registry_snapshot.RegistrySnapshot,
+        row: int
+) -> dict:
+    """
+
+    Проекция задачи из среза реестра.
+
+    :param snapshot: срез реестра
+    :param row: номер строки среза
+    :return: проекция вида {'f': id формы, 'v': {id поля: значение},
+     'l': {id поля: кусок ссылки на реестр}}
+    """
+    return {
+        'f': snapshot.form_id,
+        'v': {
+            str(field_id): column[row]
+            for field_id, column in snapshot.values.items()
+        },
+        'l': {
+            str(field_id): column[row]
+            for field_id, column in snapshot.links.items()
+        },
+    }
+
+
+def project_task(task, field_ids: list, link_field_ids: list) -> dict:
+    """
+
+    Проекция задачи формы-источника, пришедшей в вебхуке.
+
+    Значения приводятся так же, как в RegistrySnapshot.append,
+    поэтому совпадают с проекцией той же задачи из реестра.
+    Пустые поля в реестр не приходят, а в вебхуке приходят
+    со значением None - такие поля отбрасываются.
+
+    :param task: задача формы-источника
+    :param field_ids: id полей, значения которых нужны отчету
+    :param link_field_ids: id полей, для которых нужны ссылки на реестр
+    :return: проекция задачи (см. project_row)
+    """
+    registry_task = SimpleNamespace(
+        id=task.id,
+        last_modified_date=getattr(task, 'last_modified_date', None),
+        flat_fields=[
+            field for field in task.flat_fields
+            if getattr(field, 'value', None) is not None
+        ]
+    )
+    snapshot = registry_snapshot.project_tasks(
+        task.form_id, [registry_task], tuple(field_ids),
+        tuple(link_field_ids)
+    )
+    return project_row(snapshot, 0)
+
+
+def new_table_state(filter_values: list, registry_link: str) -> dict:
+    """
+
+    Пустое состояние таблицы отчета.
+
+    :param filter_values: фильтры вида [(id поля, значение)]
+    :param registry_link: ссылка на реестр по фильтрам
+    :return: состояние таблицы
+    """
+    return {
+        'filters': [
+            [str(field_id), value] for field_id, value in filter_values
+        ],
+        'registry_link': registry_link,
+        # Группы по первому столбцу в порядке первой задачи вида
+        # [значение, ссылка, кол-во задач, {id колонки: кол-во},
+        # id задач по возрастанию]
+        'groups': [],
+        'count': 0,
+        'totals': {},
+    }
+
+
+def get_contribution(
+        table: report_plan.TablePlan,
+        field_ids: tuple,
+        table_state: dict,
+        projection: (dict, None)
+) -> (tuple, None):
+    """
+
+    Вклад одной задачи в таблицу отчета.
+
+    :param table: план таблицы
+    :param field_ids: id полей формы-источника в порядке колонок таблицы
+    :param table_state: состояние таблицы
+    :param projection: проекция задачи или None
+    :return: кортеж ((значение, ссылка), [id колонок]) или None,
+     если задача в таблицу не попадает
+    """
+    if projection is None or table.columns[0].source_code is None:
+        return None
+    values, links = projection['v'], projection['l']
+    for field_key, filter_value in table_state['filters']:
+        if values.get(field_key) != filter_value:
+            return None
+    first_key = str(field_ids[0])
+    col_ids = [
+        col.id
+        for col, field_id in zip(table.columns[1:], field_ids[1:])
+        if col.kind == report_plan.COLUMN_VALUE and (
+            values.get(str(field_id)) == col.name
+        )
+    ]
+    return (values.get(first_key), links.get(first_key)), col_ids
+
+
+def add_contribution(
+        table_state: dict,
+        contribution: (tuple, None),
+        sign: int,
+        task_id: int
+) -> None:
+    """
+
+    Добавление или вычитание вклада задачи в счетчиках таблицы.
+
+    Группы идут по возрастанию id их первых задач, поэтому порядок
+    после изменения отдельных задач совпадает с полным пересчетом,
+    а для реестра по возрастанию id - с порядком появления групп.
+
+    :param table_state: состояние таблицы
+    :param contribution: вклад задачи (см. get_contribution)
+    :param sign: 1 - добавить, -1 - вычесть
+    :param task_id: id задачи
+    :return:
+    """
+    if contribution is None:
+        return
+    (value, link), col_ids = contribution
+    groups = table_state['groups']
+    group = next(
+        (group for group in groups if group[0] == value and group[1] == link),
+        None
+    )
+    if group is None:
+        if sign < 0:
+            logger.error(f'Группа {value} не найдена в состоянии таблицы')
+            return
+        group = [value, link, 0, {}, []]
+        groups.append(group)
+    first_task = group[4][0] if group[4] else None
+    if sign > 0:
+        insort(group[4], task_id)
+    elif task_id in group[4]:
+        group[4].remove(task_id)
+    group[2] += sign
+    table_state['count'] += sign
+    for col_id in col_ids:
+        for counts in (group[3], table_state['totals']):
+            key = str(col_id)
+            counts[key] = counts.get(key, 0) + sign
+            if not counts[key]:
+                del counts[key]
+    if group[2] <= 0:
+        groups.remove(group)
+    elif group[4][0] != first_task:
+        # Первая задача группы сменилась - переставляем группу
+        groups.remove(group)
+        position = next(
+            (index for index, other in enumerate(groups)
+             if other[4] and other[4][0] > group[4][0]),
+            len(groups)
+        )
+        groups.insert(position, group)
+
+
+def build_state(jobs: list, sources: dict, needed_fields: dict) -> tuple:
+    """
+
+    Состояние кросс-таблиц и проекции задач по срезам реестров.
+
+    :param jobs: список кортежей вида (план таблицы, id полей колонок,
+     фильтры вида [(id поля, значение)], ссылка на реестр по фильтрам)
+    :param sources: шаблоны и срезы реестров форм-источников
+    :param needed_fields: поля форм вида {id формы: (id полей
+     со значениями, id полей со ссылками на реестр)}
+    :return: кортеж (состояние, {id задачи: проекция})
+    """
+    state = {
+        'forms': {
+            str(form_id): [list(values), list(links)]
+            for form_id, (values, links) in needed_fields.items()
+        },
+        'tables': {
+            str(table.id): new_table_state(filter_values, registry_link)
+            for table, _, filter_values, registry_link in jobs
+        },
+    }
+    projections = {}
+    for form_id, source in sources.items():
+        snapshot = source[1]
+        form_jobs = [job for job in jobs if job[0].source_form_id == form_id]
+        for row, task_id in enumerate(snapshot.task_ids):
+            projection = project_row(snapshot, row)
+            projections[task_id] = projection
+            for table, field_ids, _, _ in form_jobs:
+                table_state = state['tables'][str(table.id)]
+                add_contribution(
+                    table_state,
+                    get_contribution(
+                        table, field_ids, table_state, projection
+                    ),
+                    1,
+                    task_id
+                )
+    return state, projections
+
+
+def apply_task(jobs: list, state: dict, task, old: (dict, None)) -> dict:
+    """
+
+    Замена вклада старой проекции задачи на вклад новой.
+
+    :param jobs: список кортежей вида (план таблицы, id полей колонок)
+     для таблиц по форме задачи
+    :param state: состояние кросс-таблиц, изменяется на месте
+    :param task: задача формы-источника
+    :param old: сохраненная проекция задачи или None
+    :return: новая проекция задачи
+    """
+    field_ids, link_field_ids = state['forms'][str(task.form_id)]
+    new = project_task(task, field_ids, link_field_ids)
+    move_task(jobs, state, task.id, old, new)
+    return new
+
+
+def move_task(
+        jobs: list,
+        state: dict,
+        task_id: int,
+        old: (dict, None),
+        new: (dict, None)
+) -> None:
+    """
+
+    Замена вклада задачи в таблицы по форме ее проекций.
+
+    :param jobs: список кортежей вида (план таблицы, id полей колонок)
+    :param state: состояние кросс-таблиц, изменяется на месте
+    :param task_id: id задачи формы-источника
+    :param old: прежняя проекция задачи или None
+    :param new: новая проекция задачи или None
+    :return:
+    """
+    if new == old:
+        return
+    form_id = (new or old)['f']
+    for table, table_field_ids in jobs:
+        if table.source_form_id != form_id:
+            continue
+        table_state = state['tables'][str(table.id)]
+        removed = get_contribution(table, table_field_ids, table_state, old)
+        added = get_contribution(table, table_field_ids, table_state, new)
+        if removed == added:
+            continue
+        add_contribution(table_state, removed, -1, task_id)
+        add_contribution(table_state, added, 1, task_id)
+
+
+def get_groups(table_state: dict) -> list:
+    """
+
+    Группы таблицы вместе с итоговой строкой.
+
+    :param table_state: состояние таблицы
+    :return: список кортежей вида
+     (значение, ссылка, кол-во задач, {id колонки: кол-во})
+    """
+    result = [
+        (value, link, count, {int(k): v for k, v in counts.items()})
+        for value, link, count, counts, _ in table_state['groups']
+    ]
+    result.append((
+        'Всего', '', table_state['count'],
+        {int(k): v for k, v in table_state['totals'].items()}
+    ))
+    return result
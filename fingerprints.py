@@ -0,0 +1,222 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+
+import cache
+
+from configuration_bot import BotConfig
+
+from forms import report_plan
+
+import utils
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+BACKEND_MEMORY = 'memory'
+BACKEND_SQLITE = 'sqlite'
+
+# Созданные хранилища вида {(тип хранилища, путь к базе): хранилище}
+_stores = {}
+_lock = threading.Lock()
+
+
+class MemoryFingerprintStore:
+    """
+
+    Хранилище отпечатков в памяти процесса.
+
+    Размер ограничен: старые записи вытесняются по LRU и TTL,
+    вытесненный отчет просто пересчитывается при следующем запуске.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._data = cache.TTLCache(maxsize, ttl)
+
+    def get(self, key: int) -> (str, None):
+        """
+
+        Получение последнего отпечатка.
+
+        :param key: id задачи отчета
+        :return: отпечаток или None
+        """
+        item = self._data.get(key)
+        return item[0] if item else None
+
+    def get_result(self, key: int) -> (dict, None):
+        """
+
+        Получение последнего результата.
+
+        :param key: id задачи отчета
+        :return: таблицы вида {id таблицы: [[[id колонки, значение]]]} или None
+        """
+        item = self._data.get(key)
+        return item[1] if item else None
+
+    def set(self, key: int, fingerprint: str, tables: dict) -> None:
+        """
+
+        Сохранение отпечатка вместе с результатом.
+
+        :param key: id задачи отчета
+        :param fingerprint: отпечаток входных данных
+        :param tables: словарь таблиц вида {id таблицы: строки таблицы}
+        :return:
+        """
+        self._data.set(key, (fingerprint, serialize_tables(tables)))
+
+
+class SqliteFingerprintStore:
+    """Хранилище отпечатков в файле SQLite, переживает перезапуск."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS fingerprints ('
+            'key INTEGER PRIMARY KEY, fingerprint TEXT, result TEXT)'
+        )
+
+    def get(self, key: int) -> (str, None):
+        """
+
+        Получение последнего отпечатка.
+
+        :param key: id задачи отчета
+        :return: отпечаток или None
+        """
+        row = self._execute(
+            'SELECT fingerprint FROM fingerprints WHERE key = ?', (key,)
+        )
+        return row[0] if row else None
+
+    def get_result(self, key: int) -> (dict, None):
+        """
+
+        Получение последнего результата.
+
+        :param key: id задачи отчета
+        :return: таблицы вида {id таблицы: [[[id колонки, значение]]]} или None
+        """
+        row = self._execute(
+            'SELECT result FROM fingerprints WHERE key = ?', (key,)
+        )
+        if not row:
+            return None
+        return {int(k): v for k, v in json.loads(row[0]).items()}
+
+    def set(self, key: int, fingerprint: str, tables: dict) -> None:
+        """
+
+        Сохранение отпечатка вместе с результатом.
+
+        :param key: id задачи отчета
+        :param fingerprint: отпечаток входных данных
+        :param tables: словарь таблиц вида {id таблицы: строки таблицы}
+        :return:
+        """
+        result = json.dumps(serialize_tables(tables), ensure_ascii=False)
+        self._execute(
+            'INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)',
+            (key, fingerprint, result)
+        )
+
+    def _execute(self, sql: str, params: tuple = ()) -> (tuple, None):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                return connection.execute(sql, params).fetchone()
+        finally:
+            connection.close()
+
+
+def get_store(config: BotConfig):
+    """
+
+    Получение хранилища отпечатков по настройкам.
+
+    :param config: конфигурационный файл
+    :return: хранилище отпечатков
+    """
+    backend = config.fingerprint_store
+    path = config.fingerprint_db
+    with _lock:
+        store = _stores.get((backend, path))
+        if store is None:
+            if backend == BACKEND_SQLITE:
+                store = SqliteFingerprintStore(path)
+            else:
+                store = MemoryFingerprintStore(
+                    config.fingerprint_memory_size,
+                    config.fingerprint_memory_ttl
+                )
+            _stores[(backend, path)] = store
+    return store
+
+
+def get_fingerprint(
+        plan: report_plan.ReportPlan,
+        filters: dict,
+        sources: dict
+) -> str:
+    """
+
+    Отпечаток входных данных отчета.
+
+    Учитываются план отчета, фильтры и для каждой формы-источника
+    версия шаблона, id задач реестра и даты их последнего изменения.
+
+    :param plan: скомпилированный план отчета
+    :param filters: дополнительные фильтры вида
+     {юкод таблицы: список фильтров}
+    :param sources: шаблоны и срезы реестров форм-источников вида
+     {id формы: [шаблон формы, срез реестра, версия шаблона формы, ...]}
+    :return: строка-отпечаток
+    """
+    digest = hashlib.sha1()
+    digest.update(f'{plan.form_id}:{plan.version}'.encode('utf-8'))
+    digest.update(
+        json.dumps(filters, ensure_ascii=False, sort_keys=True,
+                   default=str).encode('utf-8')
+    )
+    for form_id in sorted(sources):
+        snapshot, form_version = sources[form_id][1:3]
+        digest.update(f'|{form_id}:{form_version}'.encode('utf-8'))
+        digest.update(snapshot.task_ids.tobytes())
+        digest.update(snapshot.modified.tobytes())
+    return digest.hexdigest()
+
+
+def serialize_tables(tables: dict) -> dict:
+    """
+
+    Приведение таблиц к простому виду для хранения.
+
+    :param tables: словарь таблиц вида {id таблицы: список TableRow}
+    :return: словарь вида {id таблицы: [[[id колонки, значение]]]}
+    """
+    return {
+        table_id: [
+            [[cell.id, cell.value] for cell in row.cells or []]
+            for row in rows
+        ]
+        for table_id, rows in tables.items()
+    }
+
+
+def deserialize_tables(result: dict) -> dict:
+    """
+
+    Таблицы для записи из сохраненного результата.
+
+    :param result: словарь вида {id таблицы: [[[id колонки, значение]]]}
+    :return: словарь таблиц вида {id таблицы: список TableRow}
+    """
+    return {
+        table_id: utils.get_rows([dict(cells) for cells in rows])
+        for table_id, rows in result.items()
+    }
@@ -0,0 +1,163 @@
+import logging
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+BACKEND_PYTHON = 'python'
+BACKEND_NUMPY = 'numpy'
+
+
+def get_backend(name: str) -> str:
+    """
+
+    Выбор доступного способа подсчета.
+
+    :param name: желаемый способ подсчета из настроек
+    :return: способ подсчета, который можно использовать
+    """
+    if name == BACKEND_NUMPY:
+        if np is not None:
+            return BACKEND_NUMPY
+        logger.debug('numpy не установлен, считаем на чистом python')
+    return BACKEND_PYTHON
+
+
+def count_groups(
+        values_codes: array,
+        links_codes: array,
+        counted_codes: list,
+        rows_idx,
+        backend: str = BACKEND_PYTHON
+) -> (list, dict):
+    """
+
+    Подсчет задач по группам первого столбца и счетным колонкам.
+
+    Оба способа подсчета возвращают одинаковый результат: группы
+    в порядке первого появления в реестре, счетчики - целые python.
+
+    :param values_codes: коды значений поля первого столбца
+    :param links_codes: коды ссылок на реестр поля первого столбца
+    :param counted_codes: список кортежей вида
+     (коды поля, {код значения: [id колонок]})
+    :param rows_idx: номера строк среза, попадающих в таблицу
+    :param backend: способ подсчета
+    :return: список групп вида
+     (код значения, код ссылки, кол-во задач, {id колонки: кол-во})
+     и итоги вида {id колонки: кол-во}
+    """
+    if get_backend(backend) == BACKEND_NUMPY:
+        return count_groups_numpy(
+            values_codes, links_codes, counted_codes, rows_idx
+        )
+    return count_groups_python(
+        values_codes, links_codes, counted_codes, rows_idx
+    )
+
+
+def count_groups_python(
+        values_codes: array,
+        links_codes: array,
+        counted_codes: list,
+        rows_idx
+) -> (list, dict):
+    """Подсчет в один проход по строкам на словарях (см. count_groups)."""
+    # Счетчики по группам вида
+    # {(код значения, код ссылки): [кол-во задач, {id колонки: кол-во}]}
+    groups = {}
+    total_counts = {}
+    for idx in rows_idx:
+        composite_value = (values_codes[idx], links_codes[idx])
+        group = groups.get(composite_value)
+        if group is None:
+            group = [0, {}]
+            groups[composite_value] = group
+        group[0] += 1
+        group_counts = group[1]
+        for codes, codes_to_cols in counted_codes:
+            for col_id in codes_to_cols.get(codes[idx], ()):
+                group_counts[col_id] = group_counts.get(col_id, 0) + 1
+                total_counts[col_id] = total_counts.get(col_id, 0) + 1
+    result = [
+        (value_code, link_code, count, counts)
+        for (value_code, link_code), (count, counts) in groups.items()
+    ]
+    return result, total_counts
+
+
+def count_groups_numpy(
+        values_codes: array,
+        links_codes: array,
+        counted_codes: list,
+        rows_idx
+) -> (list, dict):
+    """Подсчет через np.bincount по кодам значений (см. count_groups)."""
+    rows = _as_index(rows_idx)
+    if not len(rows):
+        return [], {}
+    values = _as_numpy(values_codes)[rows].astype(np.int64)
+    links = _as_numpy(links_codes)[rows].astype(np.int64)
+    # Пара (значение, ссылка) в одном целом ключе
+    links_size = int(links.max()) + 1
+    keys = values * links_size + links
+    unique_keys, first_rows, group_idx = np.unique(
+        keys, return_index=True, return_inverse=True
+    )
+    group_idx = group_idx.reshape(-1)
+    groups_size = len(unique_keys)
+    # Порядок групп как в словаре - по первому появлению
+    order = np.argsort(first_rows, kind='stable')
+    group_totals = np.bincount(group_idx, minlength=groups_size)
+    # Таблица кол-в вида группа x колонка
+    counted_cols = []
+    histograms = []
+    for codes, codes_to_cols in counted_codes:
+        field_codes = _as_numpy(codes)[rows].astype(np.int64)
+        wanted = list(codes_to_cols)
+        lookup_size = max(int(field_codes.max()), max(wanted)) + 1
+        lookup = np.full(lookup_size, -1, dtype=np.int64)
+        lookup[wanted] = np.arange(len(wanted))
+        selected = lookup[field_codes]
+        mask = selected >= 0
+        histogram = np.bincount(
+            group_idx[mask] * len(wanted) + selected[mask],
+            minlength=groups_size * len(wanted)
+        ).reshape(groups_size, len(wanted))
+        histograms.append(histogram)
+        counted_cols.append([codes_to_cols[code] for code in wanted])
+    result = []
+    total_counts = {}
+    for group in order.tolist():
+        counts = {}
+        for histogram, cols in zip(histograms, counted_cols):
+            for position, count in enumerate(histogram[group].tolist()):
+                if not count:
+                    continue
+                for col_id in cols[position]:
+                    counts[col_id] = counts.get(col_id, 0) + count
+                    total_counts[col_id] = total_counts.get(col_id, 0) + count
+        key = int(unique_keys[group])
+        result.append((
+            key // links_size, key % links_size,
+            int(group_totals[group]), counts
+        ))
+    return result, total_counts
+
+
+def _as_numpy(codes: array):
+    return np.frombuffer(codes, dtype=np.dtype(f'u{codes.itemsize}'))
+
+
+def _as_index(rows_idx):
+    if isinstance(rows_idx, range):
+        return np.arange(
+            rows_idx.start, rows_idx.stop, rows_idx.step, dtype=np.intp
+        )
+    return np.fromiter(rows_idx, dtype=np.intp, count=len(rows_idx))
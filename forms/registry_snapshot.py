@@ -0,0 +1,160 @@
+from array import array
+from typing import Iterable
+
+from pyrus.models import responses as resp
+
+import utils
+
+
+class ProjectedColumn:
+    """
+
+    Колонка среза реестра.
+
+    Значения хранятся как коды в массиве и список различных значений,
+    поэтому повторяющиеся значения занимают по 4 байта на задачу.
+    """
+
+    __slots__ = ('categories', 'codes', '_lookup')
+
+    def __init__(self):
+        self.categories = []
+        self.codes = array('I')
+        self._lookup = {}
+
+    def __len__(self) -> int:
+        """Количество задач в колонке."""
+        return len(self.codes)
+
+    def __getitem__(self, row: int) -> str:
+        """Значение колонки для задачи с номером row."""
+        return self.categories[self.codes[row]]
+
+    def append(self, value: str) -> None:
+        """
+
+        Добавление значения для следующей задачи.
+
+        :param value: строковое значение
+        :return:
+        """
+        code = self._lookup.get(value)
+        if code is None:
+            code = len(self.categories)
+            self.categories.append(value)
+            self._lookup[value] = code
+        self.codes.append(code)
+
+    def code_of(self, value: str) -> int:
+        """
+
+        Код значения в колонке.
+
+        :param value: строковое значение
+        :return: код значения или -1, если такого значения нет
+        """
+        return self._lookup.get(value, -1)
+
+
+class RegistrySnapshot:
+    """
+
+    Компактный срез реестра формы.
+
+    Одна строка на задачу, колонки только для полей, нужных отчету.
+    values хранит значения, приведенные utils.prepare_value,
+    links - куски ссылок на реестр из utils.prepare_registry_from_field.
+    """
+
+    __slots__ = ('form_id', 'task_ids', 'modified', 'values', 'links',
+                 'error')
+
+    def __init__(
+            self,
+            form_id: int,
+            field_ids: tuple,
+            link_field_ids: tuple,
+            error: str = None
+    ):
+        self.form_id = form_id
+        self.task_ids = array('q')
+        self.modified = array('d')
+        self.values = {field_id: ProjectedColumn() for field_id in field_ids}
+        self.links = {
+            field_id: ProjectedColumn() for field_id in link_field_ids
+        }
+        self.error = error
+
+    def __len__(self) -> int:
+        """Количество задач в срезе."""
+        return len(self.task_ids)
+
+    def append(self, task) -> None:
+        """
+
+        Добавление задачи реестра в срез.
+
+        :param task: задача реестра
+        :return:
+        """
+        task_fields = utils.index_by_id(task.flat_fields)
+        self.task_ids.append(task.id)
+        modified = getattr(task, 'last_modified_date', None)
+        self.modified.append(modified.timestamp() if modified else -1)
+        for field_id, column in self.values.items():
+            column.append(utils.prepare_value(task_fields.get(field_id)))
+        for field_id, column in self.links.items():
+            field = task_fields.get(field_id)
+            # Незаполненное поле в реестре не приходит - ссылку не дополняем
+            column.append(
+                utils.prepare_registry_from_field(field)
+                if field is not None else ''
+            )
+
+
+def project_registry(
+        form_id: int,
+        registry: resp.FormRegisterResponse,
+        field_ids: tuple,
+        link_field_ids: tuple
+) -> RegistrySnapshot:
+    """
+
+    Построение среза реестра только по нужным полям.
+
+    :param form_id: id формы
+    :param registry: реестр формы
+    :param field_ids: id полей, значения которых нужны отчету
+    :param link_field_ids: id полей, для которых нужны ссылки на реестр
+    :return: срез реестра
+    """
+    snapshot = project_tasks(
+        form_id, registry.tasks or [], field_ids, link_field_ids
+    )
+    snapshot.error = registry.error
+    return snapshot
+
+
+def project_tasks(
+        form_id: int,
+        tasks: Iterable,
+        field_ids: tuple,
+        link_field_ids: tuple
+) -> RegistrySnapshot:
+    """
+
+    Построение среза по задачам, которые приходят по одной.
+
+    Задачи после проекции не хранятся, поэтому с потоковым
+    источником память не растет с размером реестра.
+
+    :param form_id: id формы
+    :param tasks: задачи реестра (список или генератор)
+    :param field_ids: id полей, значения которых нужны отчету
+    :param link_field_ids: id полей, для которых нужны ссылки на реестр
+    :return: срез реестра
+    """
+    snapshot = RegistrySnapshot(form_id, field_ids, link_field_ids)
+    for task in tasks:
+        snapshot.append(task)
+    return snapshot
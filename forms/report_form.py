@@ -1,22 +1,41 @@
 import logging
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cache
+
+import crosstab_state
+
+import fingerprints
+
+import metrics
 
 from configuration_bot import BotConfig
 
+from forms import aggregation, registry_snapshot, report_plan
+
 from pyrus.models import entities as ent
+from pyrus.models import requests as req
 
 from pyrustools.client_plus import MyPyrus
-from pyrustools.object_methods import (get_id_by_code, object_by_code,
-                                       object_by_id)
+from pyrustools.object_methods import object_by_code
 from pyrustools.objects_plus import FormFieldPlus, TaskWithCommentsPlus
 
+import registry_stream
+
 import utils
 
+import workers
+
 
 logging.basicConfig(level=logging.DEBUG)
 logging.getLogger('urllib3').propagate = False
 logger = logging.getLogger(__name__)
 
+# Сколько раз переписывать таблицы, если состояние меняется во время записи
+WRITE_ATTEMPTS = 3
+
 
 def process_reports(
         client: MyPyrus,
@@ -32,276 +51,982 @@ def process_reports(
     :param task: задача на которой работаем
     :return:
     """
-    # Получаем поля шаблона формы
-    form_fields = task.form_template.flat_fields_static
-    res = {}
-    # Получаем дополнительные фильтры для таблиц
-    filters = get_additional_filters(
-        task.flat_fields_static,
-        config.filters_code
+    configure_caches(config)
+    with metrics.stage('total'):
+        result = build_reports(client, config, task)
+    metrics.inc(
+        'report_runs_total', help_text='Запуски обработки отчетов',
+        result=result
     )
-    filters_to_id = {}
-    # Ищем таблицы для отчетов
-    for field in form_fields:
-        type_field = getattr(field, 'type', None)
-        code_field = getattr(field.info, 'code', None)
-        if code_field is None:
-            continue
-        if type_field == 'table' and 'REPORT' in code_field:
-            report_form_id = utils.get_form_id_from_code(code_field)
-            if report_form_id is None:
-                continue
-            res[field] = report_form_id
-            filter_table = filters.get(code_field)
-            if filter_table:
-                filters_to_id[field.id] = filter_table
-    # Получаем id поля, по которому будем сортировать
-    # Получаем новые таблицы
-    new_tables = get_tables(res, client, config, filters_to_id)
+
+
+def process_source_task(
+        client: MyPyrus,
+        config: BotConfig,
+        task: TaskWithCommentsPlus
+) -> None:
+    """
+
+    Обновление отчетов по изменению задачи формы-источника.
+
+    К сохраненному состоянию каждого отчета по форме задачи применяется
+    только разница между старыми и новыми значениями ее полей,
+    реестр формы не загружается.
+
+    :param client: сущность клиента pyrus
+    :param config: конфигурационный файл
+    :param task: изменившаяся задача формы-источника
+    :return:
+    """
+    configure_caches(config)
+    store = crosstab_state.get_store(config)
+    for report_id in store.get_reports(task.form_id):
+        with metrics.stage('incremental'):
+            result = update_report(client, config, store, report_id, task)
+        metrics.inc(
+            'report_incremental_updates_total', result=result,
+            help_text='Обновления отчетов по задачам форм-источников'
+        )
+
+
+def configure_caches(config: BotConfig) -> None:
+    """
+
+    Применение ограничений общих кэшей форм и реестров.
+
+    :param config: конфигурационный файл
+    :return:
+    """
+    cache.forms.configure(config.cache_forms_size, config.cache_ttl)
+    cache.registries.configure(config.cache_registries_size, config.cache_ttl)
+    cache.contacts.configure(ttl=config.cache_directory_ttl)
+    cache.catalogs.configure(ttl=config.cache_directory_ttl)
+
+
+def build_reports(
+        client: MyPyrus,
+        config: BotConfig,
+        task: TaskWithCommentsPlus
+) -> str:
+    """
+
+    Расчет и запись кросс-таблиц с замером этапов.
+
+    При неизменном отпечатке таблицы не пересчитываются, и запись
+    пропускается, если таблицы в задаче совпадают с сохраненным
+    результатом. Если они разошлись (комментарий потерялся, таблицу
+    поправили вручную), расходящиеся строки восстанавливаются
+    из сохраненного результата - это единственная запись без пересчета.
+
+    :param client: сущность клиента pyrus
+    :param config: конфигурационный файл
+    :param task: задача на которой работаем
+    :return: итог запуска: written, unchanged, restored, rebuilt
+     или invalid
+    """
+    # Получаем скомпилированный план отчета для шаблона формы
+    with metrics.stage('plan'):
+        plan = report_plan.get_report_plan(task.form_template, config)
+        # Получаем дополнительные фильтры для таблиц
+        filters = get_additional_filters(
+            task.flat_fields_static,
+            config.filters_code
+        )
+    new_tables = None
+    sortable = all(table.sortable for table in plan.tables)
+    if sortable and config.incremental_reports:
+        return build_incremental_reports(client, config, plan, filters, task)
+    if sortable:
+        # Получаем шаблоны и реестры форм-источников
+        sources = get_sources(
+            plan, client, filters, config.fetch_workers,
+            config.registry_streaming, config.registry_server_filters
+        )
+        logger.debug(f'Счетчики кэшей: {cache.stats()}')
+        # Если входные данные не менялись, таблицы пересчитывать не нужно
+        with metrics.stage('fingerprint'):
+            store = fingerprints.get_store(config)
+            fingerprint = fingerprints.get_fingerprint(plan, filters, sources)
+            unchanged = store.get(task.id) == fingerprint
+        if unchanged:
+            # Таблицы в задаче могли разойтись с записанными (правка
+            # вручную) - возвращаем сохраненный результат без пересчета
+            with metrics.stage('write'):
+                restored = rewrite_tables(
+                    client,
+                    fingerprints.deserialize_tables(
+                        store.get_result(task.id) or {}
+                    ),
+                    task
+                )
+            if restored:
+                logger.debug(f'Таблицы отчета {task.id} восстановлены')
+                return 'restored'
+            logger.debug(f'Данные для отчета {task.id} не изменились')
+            return 'unchanged'
+        # Получаем новые таблицы
+        with metrics.stage('tables'):
+            new_tables = get_tables(
+                plan, sources, client, filters, config.aggregation_backend,
+                config.aggregation_processes
+            )
+    else:
+        logger.debug(msg='Сортировать можно только числа!')
     if not new_tables:
-        client.comment_task_plus(
+        metrics.call_api(
+            'comment_task', client.comment_task_plus,
             task_id=task.id,
             text='Сортировать можно только числа! Поправьте конфигурацию'
         )
-        return
-    # Переписываем таблицы
-    rewrite_tables(client, new_tables, task)
+        return 'invalid'
+    # Переписываем таблицы, отпечаток сохраняем только после записи:
+    # при ошибке следующий запуск не должен считать отчет актуальным
+    with metrics.stage('write'):
+        rewrite_tables(client, new_tables, task)
+        store.set(task.id, fingerprint, new_tables)
+    return 'written'
 
 
 def rewrite_tables(
         client: MyPyrus,
         tables: dict,
         task: TaskWithCommentsPlus
-) -> None:
+) -> bool:
     """
 
     Перезапись таблиц.
 
+    Отправляется один комментарий только с изменившимися,
+    добавленными и удаленными строками.
+
     :param client: сущность клиента pyrus
     :param tables: новые таблиы для записи
     :param task: задача, на которой происходит работа
-    :return:
+    :return: True, если комментарий был отправлен
+    :raises utils.TableWriteError: если pyrus не принял комментарий
     """
-    # Удаляем старые таблицы
-    utils.delete_table(client, tables, task)
-    # Пишем новые таблицы
-    utils.comment_tables(client, tables, task.id)
+    return utils.comment_table_changes(client, tables, task)
 
 
-def forming_columns_for_sort(columns: list[FormFieldPlus]) -> (list, list):
+def build_incremental_reports(
+        client: MyPyrus,
+        config: BotConfig,
+        plan: report_plan.ReportPlan,
+        filters: dict,
+        task: TaskWithCommentsPlus
+) -> str:
     """
-    Функция формирует структуру для дальнейшей правильной сортировки
 
-    :param columns: список обьектов колонок
-    :return:
-        u_code_columns_list: список словарей с ключами {'u_code', 'id', 'name'}
-         для 'оригинальных' колонок, чтобы избежать зануления текущих колонок
-        sorted_fields: список словарей с ключами {'id', 'number', 'reverse'}
-         полей сортировки
-    """
-    u_code_columns_list = []
-    sorted_fields = []
-    for col in columns:
-        code = getattr(col.info, 'code', None)  # Весь юкод
-        code_split = code.split('$')
-        code_name = code_split[0]  # До доллара
-        if len(code_split) == 2:
-            (code_sign, code_number,
-             code_revers) = code_split[1].split('_')  # Сплитим после $
-            if code_sign == 'SRT':
-                sorted_fields.append(
-                    {
-                        'number': code_number,
-                        'id': getattr(col, 'id', None),
-                        'reverse': True if code_revers == 'DESC' else False
-                    }
+    Запись кросс-таблиц по сохраненному состоянию.
+
+    Реестры загружаются и пересчитываются только при первом запуске,
+    после изменения шаблонов или фильтров и по команде пересчета
+    в комментарии. В остальное время состояние поддерживают
+    вебхуки задач форм-источников (process_source_task).
+
+    :param client: сущность клиента pyrus
+    :param config: конфигурационный файл
+    :param plan: скомпилированный план отчета
+    :param filters: дополнительные фильтры вида
+     {юкод таблицы: список фильтров}
+    :param task: задача отчета
+    :return: итог запуска: rebuilt, written или unchanged
+    """
+    store = crosstab_state.get_store(config)
+    sources = get_source_forms(plan, client, config.fetch_workers)
+    signature = crosstab_state.get_signature(plan, filters, sources)
+    stored = store.get(task.id)
+    rebuild = stored is None or stored[0] != signature
+    if not rebuild and is_rebuild_requested(task, config.rebuild_command):
+        rebuild = True
+    if rebuild:
+        logger.debug(f'Полный пересчет состояния отчета {task.id}')
+        # Вебхуки, пришедшие пока грузятся реестры, меняют старое
+        # состояние: replace применит их к новому по ревизии до загрузки
+        since = stored[2] if stored is not None else 0
+        load_registries(
+            plan, sources, client, filters, config.fetch_workers,
+            config.registry_streaming, config.registry_server_filters
+        )
+        with metrics.stage('tables'):
+            table_jobs = get_table_jobs(plan, sources, client, filters)
+            state, projections = crosstab_state.build_state(
+                table_jobs, sources, get_needed_fields(plan, sources, filters)
+            )
+            jobs = [(job[0], job[1]) for job in table_jobs]
+            revision = store.replace(
+                task.id, signature, state, projections, since,
+                lambda state, task_id, old, new: crosstab_state.move_task(
+                    jobs, state, task_id, old, new
                 )
-        u_code_columns_list.append(  # Переделал чтобы не занулялись поля
-            {
-                'u_code': code_name,
-                'id': getattr(col, 'id', None),
-                'name': getattr(col, 'name', None)
-            }
+            )
+    else:
+        _, state, revision = stored
+    with metrics.stage('write'):
+        written = write_state_tables(
+            client, store, task, plan, sources, signature, state, revision
         )
-    sorted_fields.sort(key=lambda x: int(x['number']))
-    return u_code_columns_list, sorted_fields
+    if rebuild:
+        return 'rebuilt'
+    return 'written' if written else 'unchanged'
 
 
-def get_tables(
-        field_table_to_form_id: dict,
+def update_report(
         client: MyPyrus,
         config: BotConfig,
-        filters: dict
-) -> (dict, None):
+        store,
+        report_id: int,
+        task: TaskWithCommentsPlus
+) -> str:
     """
 
-    Получение таблиц для записи.
+    Применение изменения задачи формы-источника к одному отчету.
 
-    :param field_table_to_form_id: словарь вида
-     {поле таблицы: id формы с которой собирается для нее отчет}
     :param client: сущность клиента pyrus
     :param config: конфигурационный файл
-    :param filters: дополнительные фильтры для таблиц
-    :return: словарь таблиц вида {id таблицы: строки для записи в неё}, None
+    :param store: хранилище состояния кросс-таблиц
+    :param report_id: id задачи отчета
+    :param task: изменившаяся задача формы-источника
+    :return: итог: written, unchanged, rebuilt, invalid или missing
+    """
+    report_task = get_report_task(client, report_id)
+    if report_task is None:
+        logger.error(f'Задача отчета {report_id} недоступна, '
+                     f'состояние отчета удалено')
+        store.delete(report_id)
+        return 'missing'
+    plan = report_plan.get_report_plan(report_task.form_template, config)
+    filters = get_additional_filters(
+        report_task.flat_fields_static, config.filters_code
+    )
+    sources = get_source_forms(plan, client, config.fetch_workers)
+    signature = crosstab_state.get_signature(plan, filters, sources)
+    jobs = [
+        (table, report_plan.get_source_field_ids(
+            plan, table, sources[table.source_form_id][4],
+            sources[table.source_form_id][2]
+        ))
+        for table in plan.tables if table.source_form_id == task.form_id
+    ]
+    result = store.update(
+        report_id, task.id, signature,
+        lambda state, old: crosstab_state.apply_task(jobs, state, task, old)
+    )
+    if result is None:
+        # Шаблоны или фильтры изменились - пересчитываем отчет целиком
+        return build_reports(client, config, report_task)
+    state, revision = result
+    written = write_state_tables(
+        client, store, report_task, plan, sources, signature, state, revision
+    )
+    return 'written' if written else 'unchanged'
+
+
+def write_state_tables(
+        client: MyPyrus,
+        store,
+        task: TaskWithCommentsPlus,
+        plan: report_plan.ReportPlan,
+        sources: dict,
+        signature: str,
+        state: dict,
+        revision: int
+) -> bool:
+    """
+
+    Запись таблиц из состояния с проверкой, что оно не устарело.
+
+    Если пока таблицы записывались, состояние изменил другой
+    обработчик, таблицы перезаписываются по последнему состоянию,
+    поэтому последней в задаче остается последняя ревизия.
+
+    :param client: сущность клиента pyrus
+    :param store: хранилище состояния кросс-таблиц
+    :param task: задача отчета
+    :param plan: скомпилированный план отчета
+    :param sources: шаблоны форм-источников
+    :param signature: подпись входных данных состояния
+    :param state: состояние кросс-таблиц
+    :param revision: ревизия состояния
+    :return: True, если таблицы были изменены
+    """
+    written = False
+    for _ in range(WRITE_ATTEMPTS):
+        written |= utils.comment_table_changes(
+            client, render_tables(plan, state), task
+        )
+        stored = store.get(task.id)
+        if stored is None or stored[0] != signature or stored[2] == revision:
+            break
+        _, state, revision = stored
+        task = get_report_task(client, task.id)
+        if task is None:
+            break
+    return written
+
+
+def render_tables(plan: report_plan.ReportPlan, state: dict) -> dict:
+    """
+
+    Строки таблиц отчета по счетчикам из состояния.
+
+    :param plan: скомпилированный план отчета
+    :param state: состояние кросс-таблиц
+    :return: словарь таблиц вида {id таблицы: строки для записи в неё}
     """
-    cache = {}
     tables = {}
-    # Для каждой таблицы получаем поля формы и реестр формы
-    for table, form_id in field_table_to_form_id.items():
-        # Сохраняем их в кэш, чтобы не брать одну и ту же форму несколько раз
-        if form_id in cache:
-            cash_form_meta = cache.get(form_id)
-            form = cash_form_meta[0]
-            registry_form = cash_form_meta[1]
+    for table in plan.tables:
+        table_state = state['tables'][str(table.id)]
+        rows = get_cross_tab_rows(
+            table,
+            crosstab_state.get_groups(table_state),
+            table_state['registry_link']
+        )
+        if table.sorted_fields:
+            sort_table(rows, table.sorted_fields)
+        tables[table.id] = utils.get_rows(rows)
+    return tables
+
+
+def get_report_task(client: MyPyrus, task_id: int) -> (
+        TaskWithCommentsPlus, None):
+    """
+
+    Получение задачи отчета вместе с шаблоном ее формы.
+
+    :param client: сущность клиента pyrus
+    :param task_id: id задачи отчета
+    :return: задача или None, если она недоступна
+    """
+    response = metrics.call_api('get_task', client.get_task, task_id)
+    task = getattr(response, 'task', None)
+    if task is None:
+        return None
+    metrics.call_api(
+        'update_task_field_info', client.update_task_field_info, task
+    )
+    return task
+
+
+def is_rebuild_requested(task: TaskWithCommentsPlus, command: str) -> bool:
+    """
+
+    Запрошен ли полный пересчет отчета последним комментарием.
+
+    :param task: задача отчета
+    :param command: текст команды пересчета
+    :return: True, если последний комментарий - команда пересчета
+    """
+    if not command or not task.comments:
+        return False
+    return (task.comments[-1].text or '').strip() == command
+
+
+def get_sources(
+        plan: report_plan.ReportPlan,
+        client: MyPyrus,
+        filters: dict,
+        workers: int = 1,
+        streaming: bool = False,
+        server_filters: bool = False
+) -> dict:
+    """
+
+    Получение шаблонов и срезов реестров форм, по которым строится отчет.
+
+    Сначала загружаются шаблоны форм, по ним определяются поля,
+    нужные отчету, затем загружаются и проецируются реестры.
+    Разные формы загружаются параллельно.
+
+    :param plan: скомпилированный план отчета
+    :param client: сущность клиента pyrus
+    :param filters: дополнительные фильтры вида
+     {юкод таблицы: список фильтров}
+    :param workers: количество потоков для загрузки
+    :param streaming: разбирать реестры потоково, не загружая ответ целиком
+    :param server_filters: запрашивать у pyrus только нужные поля
+     и фильтровать реестр на сервере, где это возможно
+    :return: словарь вида {id формы: [шаблон формы, срез реестра,
+     версия шаблона формы, индекс полей для фильтров по юкоду,
+     индекс полей для колонок по юкоду]}
+    """
+    sources = get_source_forms(plan, client, workers)
+    load_registries(
+        plan, sources, client, filters, workers, streaming, server_filters
+    )
+    return sources
+
+
+def get_source_forms(
+        plan: report_plan.ReportPlan,
+        client: MyPyrus,
+        workers: int = 1
+) -> dict:
+    """
+
+    Получение шаблонов форм, по которым строится отчет.
+
+    :param plan: скомпилированный план отчета
+    :param client: сущность клиента pyrus
+    :param workers: количество потоков для загрузки
+    :return: словарь вида {id формы: [шаблон формы, None,
+     версия шаблона формы, индекс полей для фильтров по юкоду,
+     индекс полей для колонок по юкоду]}
+    """
+    # Берем каждую форму один раз
+    form_ids = list(dict.fromkeys(t.source_form_id for t in plan.tables))
+    # Формы берем через общий кэш между запусками
+    with metrics.stage('get_forms'):
+        forms = run_parallel(
+            [(cache.get_form, client, form_id) for form_id in form_ids],
+            workers
+        )
+    sources = {}
+    for form_id, form in zip(form_ids, forms):
+        form_version = report_plan.get_version(form.flat_fields_static)
+        # Фильтры искали поле через object_by_code, колонки - через
+        # get_id_by_code: при повторяющихся юкодах они берут разные поля
+        form_fields = utils.index_by_code(form.flat_fields_static, first=True)
+        column_fields = utils.index_by_code(form.flat_fields_static)
+        sources[form_id] = [
+            form, None, form_version, form_fields, column_fields
+        ]
+    return sources
+
+
+def load_registries(
+        plan: report_plan.ReportPlan,
+        sources: dict,
+        client: MyPyrus,
+        filters: dict,
+        workers: int = 1,
+        streaming: bool = False,
+        server_filters: bool = False
+) -> None:
+    """
+
+    Загрузка срезов реестров форм-источников в sources.
+
+    :param plan: скомпилированный план отчета
+    :param sources: шаблоны форм-источников из get_source_forms
+    :param client: сущность клиента pyrus
+    :param filters: дополнительные фильтры вида
+     {юкод таблицы: список фильтров}
+    :param workers: количество потоков для загрузки
+    :param streaming: разбирать реестры потоково
+    :param server_filters: запрашивать только нужные поля
+     с серверными фильтрами
+    :return:
+    """
+    form_ids = list(sources)
+    needed_fields = get_needed_fields(plan, sources, filters)
+    register_filters = {}
+    if server_filters:
+        register_filters = get_register_filters(plan, sources, filters)
+    with metrics.stage('get_registries'):
+        snapshots = run_parallel(
+            [
+                (get_snapshot, client, form_id, *needed_fields[form_id],
+                 streaming, server_filters, register_filters.get(form_id, ()))
+                for form_id in form_ids
+            ],
+            workers
+        )
+    for form_id, snapshot in zip(form_ids, snapshots):
+        sources[form_id][1] = snapshot
+        metrics.observe(
+            'report_registry_tasks', len(snapshot), metrics.SIZE_BUCKETS,
+            help_text='Количество задач в реестрах форм-источников'
+        )
+
+
+def run_parallel(calls: list, workers: int) -> list:
+    """
+
+    Выполнение вызовов в ограниченном пуле потоков.
+
+    :param calls: список кортежей вида (функция, *аргументы)
+    :param workers: количество потоков
+    :return: результаты в порядке вызовов
+    """
+    workers = min(workers or 1, len(calls))
+    if workers <= 1:
+        return [fn(*args) for fn, *args in calls]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fn, *args) for fn, *args in calls]
+        return [future.result() for future in futures]
+
+
+def get_needed_fields(
+        plan: report_plan.ReportPlan,
+        sources: dict,
+        filters: dict
+) -> dict:
+    """
+
+    Поля форм-источников, которые нужны отчету.
+
+    :param plan: скомпилированный план отчета
+    :param sources: шаблоны форм-источников
+    :param filters: дополнительные фильтры вида
+     {юкод таблицы: список фильтров}
+    :return: словарь вида {id формы: (id полей со значениями,
+     id полей со ссылками на реестр)}
+    """
+    needed = {form_id: ({}, {}) for form_id in sources}
+    for table in plan.tables:
+        source = sources[table.source_form_id]
+        _, _, form_version, form_fields, column_fields = source
+        values, links = needed[table.source_form_id]
+        field_ids = report_plan.get_source_field_ids(
+            plan, table, column_fields, form_version
+        )
+        # Первый столбец раскладывается по значениям со ссылками
+        values[field_ids[0]] = None
+        links[field_ids[0]] = None
+        for col, field_id in zip(table.columns[1:], field_ids[1:]):
+            if col.kind == report_plan.COLUMN_VALUE:
+                values[field_id] = None
+        for filter_field_code, _ in filters.get(table.code, []):
+            values[form_fields.get(filter_field_code).id] = None
+    return {
+        form_id: (tuple(values), tuple(links))
+        for form_id, (values, links) in needed.items()
+    }
+
+
+def get_register_filters(
+        plan: report_plan.ReportPlan,
+        sources: dict,
+        filters: dict
+) -> dict:
+    """
+
+    Фильтры реестра, которые можно передать в запрос к pyrus.
+
+    Реестр формы общий для всех таблиц на нее, поэтому на сервер
+    уходят только фильтры, заданные для каждой такой таблицы.
+    Фильтры, которые сервер не поддерживает, остаются локальными.
+
+    :param plan: скомпилированный план отчета
+    :param sources: шаблоны форм-источников
+    :param filters: дополнительные фильтры вида
+     {юкод таблицы: список фильтров}
+    :return: словарь вида {id формы: ((id поля, значение фильтра), ...)}
+    """
+    common = {}
+    for table in plan.tables:
+        table_filters = {
+            (field_code, value)
+            for field_code, value in filters.get(table.code, [])
+        }
+        form_id = table.source_form_id
+        if form_id in common:
+            common[form_id] &= table_filters
         else:
-            form = client.get_form(form_id)
-            registry_form = client.get_registry(form_id)
-            cache[form_id] = [form, registry_form]
-        # Получаем задачи реестра
-        tasks = registry_form.tasks if registry_form.tasks is not None else []
-        filter_to_table = filters.get(table.id)
-        registry_part = ''
-        # Фильтруем по данным из фильтрационной таблицы
-        if filter_to_table:
-            tasks, registry_part = to_filter_add(
-                form.flat_fields_static,
-                tasks,
-                filter_to_table,
-                client
+            common[form_id] = table_filters
+    register_filters = {}
+    for form_id, form_filters in common.items():
+        form_fields = sources[form_id][3]
+        values = {}
+        for field_code, value in sorted(form_filters):
+            field = form_fields.get(field_code)
+            register_value = utils.prepare_register_filter(field, value)
+            if register_value is None:
+                continue
+            # Два разных значения одного поля сервер не отфильтрует
+            if values.setdefault(field.id, register_value) != register_value:
+                values[field.id] = None
+        register_filters[form_id] = tuple(
+            (field_id, value) for field_id, value in sorted(values.items())
+            if value is not None
+        )
+    return register_filters
+
+
+def get_registry_request(
+        field_ids: tuple,
+        link_field_ids: tuple,
+        register_filters: tuple
+) -> req.FormRegisterRequest:
+    """
+
+    Запрос реестра только с нужными полями и серверными фильтрами.
+
+    :param field_ids: id полей, значения которых нужны отчету
+    :param link_field_ids: id полей, для которых нужны ссылки на реестр
+    :param register_filters: фильтры вида ((id поля, значение фильтра), ...)
+    :return: запрос реестра
+    """
+    # Колонка с юкодом, которого нет в форме-источнике, дает id None:
+    # такое поле в реестре не придет и останется без значения
+    return req.FormRegisterRequest(
+        field_ids=[
+            field_id
+            for field_id in dict.fromkeys(field_ids + link_field_ids)
+            if field_id is not None
+        ],
+        filters=[
+            ent.EqualsFilter(field_id, value)
+            for field_id, value in register_filters
+        ]
+    )
+
+
+def get_snapshot(
+        client: MyPyrus,
+        form_id: int,
+        field_ids: tuple,
+        link_field_ids: tuple,
+        streaming: bool = False,
+        server_filters: bool = False,
+        register_filters: tuple = ()
+) -> registry_snapshot.RegistrySnapshot:
+    """
+
+    Получение среза реестра через общий кэш.
+
+    Полный ответ реестра не хранится: после проекции он освобождается.
+    В потоковом режиме ответ разбирается по кускам и задачи
+    проецируются по одной, не собираясь в память все сразу.
+
+    :param client: сущность клиента pyrus
+    :param form_id: id формы
+    :param field_ids: id полей, значения которых нужны отчету
+    :param link_field_ids: id полей, для которых нужны ссылки на реестр
+    :param streaming: разбирать реестр потоково
+    :param server_filters: запрашивать только нужные поля
+     с серверными фильтрами
+    :param register_filters: фильтры вида ((id поля, значение фильтра), ...)
+    :return: срез реестра
+    """
+    request = None
+    if server_filters:
+        request = get_registry_request(
+            field_ids, link_field_ids, register_filters
+        )
+
+    def load() -> registry_snapshot.RegistrySnapshot:
+        if not streaming:
+            registry = metrics.call_api(
+                'get_registry', client.get_registry, form_id, request
             )
-        columns = getattr(table.info, 'columns', [])
-        u_code_columns_list, sorted_fields = forming_columns_for_sort(columns)
-        for coll in sorted_fields:
-            if object_by_id(columns, coll['id']).type != 'number':
-                logger.debug(msg='Сортировать можно только числа!')
-                return
-        # Обрабатываем первый столбец
-        rows, filtered_tasks = prepare_first_col(
-            u_code_columns_list[0],
-            form.flat_fields_static,
-            tasks,
-            config
+            return registry_snapshot.project_registry(
+                form_id, registry, field_ids, link_field_ids
+            )
+        meta = {}
+        # Загрузка и разбор идут вместе, замеряем их одним вызовом
+        with metrics.api_call('get_registry') as call:
+            snapshot = registry_snapshot.project_tasks(
+                form_id,
+                registry_stream.iter_registry(
+                    client, form_id, meta, request
+                ),
+                field_ids,
+                link_field_ids
+            )
+            if meta.get('error'):
+                call.status = 'error'
+        snapshot.error = meta.get('error')
+        return snapshot
+
+    key = (*cache.get_client_key(client), form_id, field_ids, link_field_ids,
+           server_filters, register_filters)
+    return cache.registries.get_or_load(key, load)
+
+
+def get_tables(
+        plan: report_plan.ReportPlan,
+        sources: dict,
+        client: MyPyrus,
+        filters: dict,
+        backend: str = aggregation.BACKEND_PYTHON,
+        processes: int = 0
+) -> dict:
+    """
+
+    Получение таблиц для записи.
+
+    :param plan: скомпилированный план отчета
+    :param sources: шаблоны и срезы реестров форм-источников
+    :param client: сущность клиента pyrus
+    :param filters: дополнительные фильтры вида
+     {юкод таблицы: список фильтров}
+    :param backend: способ подсчета (python или numpy)
+    :param processes: количество процессов для подсчета,
+     0 - считать в текущем потоке
+    :return: словарь таблиц вида {id таблицы: строки для записи в неё}
+    """
+    jobs = [
+        (table, field_ids, sources[table.source_form_id][1], filter_values,
+         registry_part, backend)
+        for table, field_ids, filter_values, registry_part
+        in get_table_jobs(plan, sources, client, filters)
+    ]
+    tables = {}
+    for table, (rows, timings) in zip(
+            plan.tables, run_aggregation(jobs, processes)
+    ):
+        # Время этапов считается и в отдельных процессах, пишем его здесь
+        for stage_name, seconds in timings.items():
+            metrics.observe_stage(stage_name, seconds)
+        metrics.observe(
+            'report_table_rows', len(rows), metrics.SIZE_BUCKETS,
+            help_text='Количество строк в таблицах отчетов'
         )
-        # Обрабатываем остальные столбцы
-        prepare_other_col(
-            u_code_columns_list[1::],
-            form.flat_fields_static,
-            rows,
-            filtered_tasks,
-            config,
-            form_id,
-            registry_part
+        metrics.observe(
+            'report_table_columns', len(table.columns), metrics.SIZE_BUCKETS,
+            help_text='Количество колонок в таблицах отчетов'
         )
         # Формируем строки
-        if sorted_fields:
-            sort_table(rows, sorted_fields)
-        rows_ent = utils.get_rows(rows)
-        tables[table.id] = rows_ent
+        tables[table.id] = utils.get_rows(rows)
     return tables
 
 
-def prepare_first_col(
-        first_col: dict,
-        source_form_fields: [FormFieldPlus],
-        tasks: [ent.Task],
-        config: BotConfig
-) -> (list, dict):
+def get_table_jobs(
+        plan: report_plan.ReportPlan,
+        sources: dict,
+        client: MyPyrus,
+        filters: dict
+) -> list:
     """
 
-    Обработка первого столбца.
+    Поля, фильтры и ссылки по фильтрам для каждой таблицы отчета.
 
-    :param first_col: первый столбец таблицы в виде словаря
-     (словарь с ключами {'u_code', 'id', 'name'})
-    :param source_form_fields: список полей формы
-    :param tasks: список задач из реестра
-    :param config: конфигурационный файл
-    :return: список строк, отсортированные задачи по значению колонки
+    :param plan: скомпилированный план отчета
+    :param sources: шаблоны форм-источников
+    :param client: сущность клиента pyrus
+    :param filters: дополнительные фильтры вида
+     {юкод таблицы: список фильтров}
+    :return: список кортежей вида (план таблицы, id полей колонок,
+     фильтры вида [(id поля, значение)], ссылка на реестр по фильтрам)
+    """
+    jobs = []
+    for table in plan.tables:
+        source = sources[table.source_form_id]
+        _, _, form_version, form_fields, column_fields = source
+        filter_to_table = filters.get(table.code) or []
+        # Ссылку по фильтрам строим здесь: для нее нужны запросы к pyrus
+        with metrics.stage('filter_link'):
+            registry_part = get_filter_registry_link(
+                form_fields, filter_to_table, client
+            )
+        filter_values = [
+            (form_fields.get(filter_field_code).id, filter_value)
+            for filter_field_code, filter_value in filter_to_table
+        ]
+        field_ids = report_plan.get_source_field_ids(
+            plan, table, column_fields, form_version
+        )
+        jobs.append((table, field_ids, filter_values, registry_part))
+    return jobs
+
+
+def run_aggregation(jobs: list, processes: int = 0) -> list:
+    """
+
+    Подсчет строк таблиц в текущем потоке или в пуле процессов.
+
+    В процессы уходят только план таблицы и срез реестра, поэтому
+    запросы к pyrus и запись таблиц остаются в основном процессе.
+
+    :param jobs: список аргументов для get_table_rows
+    :param processes: количество процессов, 0 - считать в текущем потоке
+    :return: список кортежей вида (строки таблицы, {этап: секунды})
+     в порядке jobs
+    """
+    if processes <= 0 or not jobs:
+        return [get_table_rows_timed(*job) for job in jobs]
+    pool = workers.get_process_pool(processes)
+    try:
+        futures = [pool.submit(get_table_rows_timed, *job) for job in jobs]
+        return [future.result() for future in futures]
+    except BrokenProcessPool:
+        logger.error('Пул процессов упал, считаем таблицы в текущем потоке')
+        workers.reset_process_pool(pool)
+        return [get_table_rows_timed(*job) for job in jobs]
+
+
+def get_table_rows_timed(*args) -> (list, dict):
+    """
+
+    Строки таблицы вместе с временем этапов их расчета.
+
+    :param args: аргументы get_table_rows
+    :return: строки таблицы и словарь вида {этап: секунды}
+    """
+    timings = {}
+    rows = get_table_rows(*args, timings=timings)
+    return rows, timings
+
+
+def get_table_rows(
+        table: report_plan.TablePlan,
+        field_ids: tuple,
+        snapshot: registry_snapshot.RegistrySnapshot,
+        filter_values: list,
+        filter_registry_link: str,
+        backend: str = aggregation.BACKEND_PYTHON,
+        timings: dict = None
+) -> list:
+    """
+
+    Фильтрация среза, подсчет и сортировка строк одной таблицы.
+
+    Функция не обращается к pyrus, поэтому может выполняться
+    в отдельном процессе.
+
+    :param table: план таблицы
+    :param field_ids: id полей формы-источника в порядке колонок таблицы
+    :param snapshot: срез реестра
+    :param filter_values: фильтры вида [(id поля, значение)]
+    :param filter_registry_link: ссылка на реестр по фильтрам
+    :param backend: способ подсчета (python или numpy)
+    :param timings: словарь для времени этапов вида {этап: секунды}
+    :return: список строк таблицы вида {id колонки: значение колонки}
+    """
+    # Строки среза реестра, попадающие в таблицу
+    rows_idx = range(len(snapshot))
+    # Фильтруем по данным из фильтрационной таблицы
+    with metrics.stage('filter', timings):
+        for field_id, filter_value in filter_values:
+            rows_idx = utils.filter_rows(
+                snapshot.values[field_id], rows_idx, filter_value
+            )
+    # Собираем строки таблицы за один проход по реестру
+    with metrics.stage('cross_tab', timings):
+        rows = build_cross_tab(
+            table,
+            field_ids,
+            snapshot,
+            rows_idx,
+            filter_registry_link,
+            backend
+        )
+    if table.sorted_fields:
+        with metrics.stage('sort', timings):
+            sort_table(rows, table.sorted_fields)
+    return rows
+
+
+def build_cross_tab(
+        table: report_plan.TablePlan,
+        field_ids: tuple,
+        snapshot: registry_snapshot.RegistrySnapshot,
+        rows_idx: list,
+        filter_registry_link: str,
+        backend: str = aggregation.BACKEND_PYTHON
+) -> list:
+    """
+
+    Построение кросс-таблицы за один проход по реестру.
+
+    Задачи группируются по значению первого столбца, и в том же проходе
+    считаются значения всех остальных столбцов.
+
+    :param table: план таблицы
+    :param field_ids: id полей формы-источника в порядке колонок таблицы
+    :param snapshot: срез реестра
+    :param rows_idx: номера строк среза, попадающих в таблицу
+    :param filter_registry_link: ссылка на реестр
+    :param backend: способ подсчета (python или numpy)
+    :return: список строк таблицы вида {id колонки: значение колонки}
     """
-    res = {}
     rows = []
-    # Получаем юкод из столбца,
-    # значение которого будем раскладывать в вертикаль
-    code_source = first_col.get('u_code', None)
-    if code_source in config.mapping_service_code:
-        code_source = config.mapping_service_code.get(code_source)
-    first_col_id = first_col.get('id', None)
-    if code_source is None:
-        return rows, res
-    # Получаем id поля по юкоду из столбца
-    source_field_id = get_id_by_code(source_form_fields, code_source)
-    for task in tasks:
-        # Получаем значение этого поля для каждой задачи
-        first_value_field = object_by_id(task.flat_fields, source_field_id)
-        value = utils.prepare_value(first_value_field)
-        # Получаем кусок ссылки на реестр
-        registry_link = utils.prepare_registry_from_field(first_value_field)
-        # Собираем в ключ вида (значение поля, ссылка на реестр)
-        composite_value = (value, registry_link)
-        # Фильтруем задачи по значению поля
-        if composite_value in res:
-            res[composite_value].append(task)
-        else:
-            res[composite_value] = [task]
-            rows.append({first_col_id: value})
+    first_col, other_cols = table.columns[0], table.columns[1:]
+    # Поле, значение которого будем раскладывать в вертикаль
+    if first_col.source_code is None:
+        return rows
+    first_values = snapshot.values[field_ids[0]]
+    first_links = snapshot.links[field_ids[0]]
+    # Для счетных колонок запоминаем, какой код значения какого поля
+    # они считают: {коды поля: {код значения: [id колонок]}}
+    counted_fields = {}
+    for col, source_field_id in zip(other_cols, field_ids[1:]):
+        if col.kind != report_plan.COLUMN_VALUE:
+            continue
+        column = snapshot.values[source_field_id]
+        code = column.code_of(col.name)
+        if code == -1:
+            continue
+        codes_to_cols = counted_fields.setdefault(source_field_id, {})
+        codes_to_cols.setdefault(code, []).append(col.id)
+    counted_codes = [
+        (snapshot.values[field_id].codes, codes_to_cols)
+        for field_id, codes_to_cols in counted_fields.items()
+    ]
+    groups, total_counts = aggregation.count_groups(
+        first_values.codes, first_links.codes, counted_codes, rows_idx,
+        backend
+    )
+    # Ключ вида (значение поля, ссылка на реестр)
+    result = [
+        (first_values.categories[value_code],
+         first_links.categories[link_code], count, counts)
+        for value_code, link_code, count, counts in groups
+    ]
     # Добавляем итоговую служебную строку
-    res[('Всего', '')] = tasks
-    rows.append({first_col_id: 'Всего'})
-    return rows, res
+    result.append(('Всего', '', len(rows_idx), total_counts))
+    return get_cross_tab_rows(table, result, filter_registry_link)
 
 
-def prepare_other_col(
-        columns: list,
-        source_form_fields: list,
-        rows: list,
-        tasks_by_item: dict,
-        config: BotConfig,
-        form_id: int,
+def get_cross_tab_rows(
+        table: report_plan.TablePlan,
+        groups: list,
         filter_registry_link: str
-) -> None:
+) -> list:
     """
 
-    Обработка дефолтных столбцов.
+    Строки кросс-таблицы по посчитанным группам.
 
-    :param columns: список словарей колонок
-    (словарь с ключами {'u_code', 'id', 'name'})
-    :param source_form_fields: список полей формы
-    :param rows: строки для будущей таблицы
-    :param tasks_by_item: отсортированные задачи
-    :param config: конфигурационный файл
-    :param form_id: id формы
-    :param filter_registry_link: ссылка на реестр
-    :return:
+    :param table: план таблицы
+    :param groups: список групп с итоговой строкой в конце вида
+     (значение, ссылка, кол-во задач, {id колонки: кол-во})
+    :param filter_registry_link: ссылка на реестр по фильтрам
+    :return: список строк таблицы вида {id колонки: значение колонки}
     """
-    # Остальные колонки присоединяем к строкам,
-    # которые им соответствуют (в том порядке, в котором они идут)
-    for col in columns:
-        code_source = col.get('u_code', None)
-        # Если служебный код, меняем его
-        if code_source in config.mapping_service_code:
-            code_source = config.mapping_service_code.get(code_source)
-        source_field_id = get_id_by_code(source_form_fields, code_source)
-        source_value_for_common = col.get('name', None)
-        i = 0
-        for meta, tasks in tasks_by_item.items():
+    rows = []
+    first_col, other_cols = table.columns[0], table.columns[1:]
+    if first_col.source_code is None:
+        return rows
+    for value, registry_link, count, counts in groups:
+        row = {first_col.id: value}
+        for col in other_cols:
             # Служебная итоговая колонка
-            if code_source == config.total_code:
-                value = len(tasks)
+            if col.kind == report_plan.COLUMN_TOTAL:
+                row[col.id] = count
             # Служебная колонка для реестра
-            elif code_source == config.registry_code:
-                value = f'https://pyrus.com/t#rg{form_id}?ao=true&tz=180&sm=0'
-                if meta[1]:
-                    value = f'{value}&{meta[1]}'
-                if filter_registry_link:
-                    value = f'{value}&{filter_registry_link}'
+            elif col.kind == report_plan.COLUMN_REGISTRY:
+                row[col.id] = get_registry_url(
+                    table.source_form_id, registry_link, filter_registry_link
+                )
             # Остальные колонки
             else:
-                value = len(
-                    utils.filter_tasks(
-                        tasks, source_value_for_common, source_field_id
-                    )
-                )
-            rows[i][col['id']] = value
-            i += 1
+                row[col.id] = counts.get(col.id, 0)
+        rows.append(row)
+    return rows
+
+
+def get_registry_url(
+        form_id: int,
+        registry_link: str,
+        filter_registry_link: str
+) -> str:
+    """
+
+    Формирование ссылки на реестр для строки таблицы.
+
+    :param form_id: id формы
+    :param registry_link: кусок ссылки по значению первого столбца
+    :param filter_registry_link: кусок ссылки по дополнительным фильтрам
+    :return: ссылка на реестр
+    """
+    value = f'https://pyrus.com/t#rg{form_id}?ao=true&tz=180&sm=0'
+    if registry_link:
+        value = f'{value}&{registry_link}'
+    if filter_registry_link:
+        value = f'{value}&{filter_registry_link}'
+    return value
 
 
 def get_additional_filters(
@@ -342,33 +1067,25 @@ def get_additional_filters(
     return filters
 
 
-def to_filter_add(
-        form_fields: [FormFieldPlus],
-        tasks: [ent.Task],
+def get_filter_registry_link(
+        form_fields: dict,
         filters_data: [[]],
         client: MyPyrus
-) -> (list, str):
+) -> str:
     """
 
-    Накладываем дополнительные фильтры полученные ранее.
+    Кусок ссылки на реестр по дополнительным фильтрам.
 
-    :param form_fields: список полей шаблона формы
-    :param tasks: список задач из реестра
+    :param form_fields: индекс полей шаблона формы вида {юкод поля: поле}
     :param filters_data: список списков фильтров вида
     [[юкод фильтруемого поля, значение фильтруемого поля]]
     :param client: сущность клиента pyrus
-    :return: список отфильтрованных задач, ссылку на реестр
+    :return: ссылка на реестр
     """
     registry_dict = {}
-    for filter_data in filters_data:
-        # получаем код
-        filter_field_code = filter_data[0]
-        # получаем значение
-        filter_value = filter_data[1]
+    for filter_field_code, filter_value in filters_data:
         # Получаем поле из шаблона форма
-        filter_field = object_by_code(form_fields, filter_field_code)
-        # фильтруем задачи
-        tasks = utils.filter_tasks(tasks, filter_value, filter_field.id)
+        filter_field = form_fields.get(filter_field_code)
         # получаем ссылку на реестр
         key_registry, value_registry = utils.prepare_registry_from_form(
             filter_field,
@@ -378,8 +1095,7 @@ def to_filter_add(
         if key_registry:
             registry_dict[key_registry] = value_registry
     # формируем ссылку
-    registry_link = urllib.parse.urlencode(registry_dict)
-    return tasks, registry_link
+    return urllib.parse.urlencode(registry_dict)
 
 
 def sort_table(rows: list, fields: list) -> None:
@@ -0,0 +1,258 @@
+import hashlib
+import json
+import logging
+import threading
+from typing import NamedTuple
+
+from configuration_bot import BotConfig
+
+from pyrustools.objects_plus import FormFieldPlus, FormResponsePlus
+
+import utils
+
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+# Виды колонок отчета
+COLUMN_TOTAL = 'total'
+COLUMN_REGISTRY = 'registry'
+COLUMN_VALUE = 'value'
+
+# Скомпилированные планы вида {id формы отчета: план}
+_plans = {}
+# Поля источников вида
+# {(id формы отчета, id таблицы, id формы-источника):
+#  (версия плана, версия источника, id полей колонок)}
+_source_fields = {}
+_lock = threading.Lock()
+
+
+class ColumnPlan(NamedTuple):
+    """Колонка таблицы отчета."""
+
+    id: int
+    name: str
+    source_code: str
+    kind: str
+
+
+class TablePlan(NamedTuple):
+    """Таблица отчета."""
+
+    id: int
+    code: str
+    source_form_id: int
+    columns: tuple
+    sorted_fields: tuple
+    sortable: bool
+
+
+class ReportPlan(NamedTuple):
+    """Скомпилированный план отчета для шаблона формы."""
+
+    form_id: int
+    version: str
+    tables: tuple
+
+
+def get_report_plan(form: FormResponsePlus, config: BotConfig) -> ReportPlan:
+    """
+
+    Получение плана отчета из кэша или его компиляция.
+
+    :param form: шаблон формы отчета
+    :param config: конфигурационный файл
+    :return: план отчета
+    """
+    version = get_version(form.flat_fields_static, config)
+    with _lock:
+        plan = _plans.get(form.id)
+    if plan is not None and plan.version == version:
+        return plan
+    logger.debug(f'Компиляция плана отчета для формы {form.id}')
+    plan = compile_report_plan(form, config, version)
+    with _lock:
+        _plans[form.id] = plan
+    return plan
+
+
+def get_version(fields: [FormFieldPlus], config: BotConfig = None) -> str:
+    """
+
+    Версия шаблона формы: отпечаток полей, которые влияют на отчет.
+
+    :param fields: список полей шаблона формы
+    :param config: конфигурационный файл, если план зависит от него
+    :return: строка-отпечаток
+    """
+    structure = []
+    for field in fields:
+        info = getattr(field, 'info', None)
+        columns = getattr(info, 'columns', None) or []
+        structure.append([
+            field.id,
+            field.type,
+            getattr(info, 'code', None),
+            [
+                [col.id, col.type, col.name, getattr(col.info, 'code', None)]
+                for col in columns
+            ]
+        ])
+    if config is not None:
+        structure.append([
+            config.mapping_service_code,
+            config.total_code,
+            config.registry_code
+        ])
+    dump = json.dumps(structure, ensure_ascii=False, default=str)
+    return hashlib.sha1(dump.encode('utf-8')).hexdigest()
+
+
+def compile_report_plan(
+        form: FormResponsePlus,
+        config: BotConfig,
+        version: str
+) -> ReportPlan:
+    """
+
+    Разбор шаблона формы отчета в план.
+
+    :param form: шаблон формы отчета
+    :param config: конфигурационный файл
+    :param version: версия шаблона формы
+    :return: план отчета
+    """
+    tables = []
+    # Ищем таблицы для отчетов
+    for field in form.flat_fields_static:
+        type_field = getattr(field, 'type', None)
+        code_field = getattr(field.info, 'code', None)
+        if code_field is None:
+            continue
+        if type_field == 'table' and 'REPORT' in code_field:
+            report_form_id = utils.get_form_id_from_code(code_field)
+            if report_form_id is None:
+                continue
+            tables.append(compile_table(field, code_field, report_form_id,
+                                        config))
+    return ReportPlan(form.id, version, tuple(tables))
+
+
+def compile_table(
+        table: FormFieldPlus,
+        code: str,
+        source_form_id: int,
+        config: BotConfig
+) -> TablePlan:
+    """
+
+    Разбор таблицы отчета.
+
+    :param table: поле таблицы из шаблона формы
+    :param code: юкод таблицы
+    :param source_form_id: id формы, по которой собирается отчет
+    :param config: конфигурационный файл
+    :return: план таблицы
+    """
+    columns = getattr(table.info, 'columns', None) or []
+    u_code_columns_list, sorted_fields = forming_columns_for_sort(columns)
+    columns_by_id = utils.index_by_id(columns)
+    sortable = all(
+        columns_by_id[coll['id']].type == 'number' for coll in sorted_fields
+    )
+    columns_plan = []
+    for col in u_code_columns_list:
+        source_code = col['u_code']
+        # Если служебный код, меняем его
+        if source_code in config.mapping_service_code:
+            source_code = config.mapping_service_code.get(source_code)
+        if source_code == config.total_code:
+            kind = COLUMN_TOTAL
+        elif source_code == config.registry_code:
+            kind = COLUMN_REGISTRY
+        else:
+            kind = COLUMN_VALUE
+        columns_plan.append(
+            ColumnPlan(col['id'], col['name'], source_code, kind)
+        )
+    return TablePlan(
+        table.id,
+        code,
+        source_form_id,
+        tuple(columns_plan),
+        tuple(sorted_fields),
+        sortable
+    )
+
+
+def forming_columns_for_sort(columns: list[FormFieldPlus]) -> (list, list):
+    """
+    Функция формирует структуру для дальнейшей правильной сортировки.
+
+    :param columns: список обьектов колонок
+    :return:
+        u_code_columns_list: список словарей с ключами {'u_code', 'id', 'name'}
+         для 'оригинальных' колонок, чтобы избежать зануления текущих колонок
+        sorted_fields: список словарей с ключами {'id', 'number', 'reverse'}
+         полей сортировки
+    """
+    u_code_columns_list = []
+    sorted_fields = []
+    for col in columns:
+        code = getattr(col.info, 'code', None)  # Весь юкод
+        code_split = code.split('$')
+        code_name = code_split[0]  # До доллара
+        if len(code_split) == 2:
+            (code_sign, code_number,
+             code_revers) = code_split[1].split('_')  # Сплитим после $
+            if code_sign == 'SRT':
+                sorted_fields.append(
+                    {
+                        'number': code_number,
+                        'id': getattr(col, 'id', None),
+                        'reverse': True if code_revers == 'DESC' else False
+                    }
+                )
+        u_code_columns_list.append(  # Переделал чтобы не занулялись поля
+            {
+                'u_code': code_name,
+                'id': getattr(col, 'id', None),
+                'name': getattr(col, 'name', None)
+            }
+        )
+    sorted_fields.sort(key=lambda x: int(x['number']))
+    return u_code_columns_list, sorted_fields
+
+
+def get_source_field_ids(
+        plan: ReportPlan,
+        table: TablePlan,
+        source_fields: dict,
+        source_version: str
+) -> tuple:
+    """
+
+    Получение id полей формы-источника для колонок таблицы.
+
+    Результат кэшируется по версиям плана и шаблона формы-источника.
+
+    :param plan: план отчета
+    :param table: план таблицы
+    :param source_fields: индекс полей формы-источника вида {юкод поля: поле}
+    :param source_version: версия шаблона формы-источника
+    :return: id полей в порядке колонок таблицы
+    """
+    key = (plan.form_id, table.id, table.source_form_id)
+    with _lock:
+        cached = _source_fields.get(key)
+    if cached is not None and cached[:2] == (plan.version, source_version):
+        return cached[2]
+    field_ids = tuple(
+        getattr(source_fields.get(col.source_code), 'id', None)
+        for col in table.columns
+    )
+    with _lock:
+        _source_fields[key] = (plan.version, source_version, field_ids)
+    return field_ids
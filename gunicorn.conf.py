@@ -0,0 +1,40 @@
+"""
+Настройки gunicorn для запуска в продакшене.
+
+Запуск из корня репозитория:
+    gunicorn --config gunicorn.conf.py wsgi:app
+
+Количество процессов и потоков берется из bot_config.json
+(WEB_WORKERS, WEB_THREADS). Каждый процесс держит свой пул
+обработчиков отчетов на WORKERS_COUNT потоков, вебхуки одной задачи
+объединяются между процессами через TASK_LOCK_DIRECTORY.
+Процессы сбрасывают метрики в METRICS_DIRECTORY, и /diagnostics/metrics
+любого процесса отвечает суммой по всем процессам.
+"""
+import json
+import os
+
+from configuration_bot import BotConfig
+
+import metrics
+
+with open('bot_config.json', encoding='utf8') as config_file:
+    web_config = BotConfig(json.load(config_file))
+
+bind = f'0.0.0.0:{web_config.web_port}'
+workers = web_config.web_workers
+threads = web_config.web_threads
+worker_class = 'gthread'
+timeout = web_config.web_timeout
+keepalive = 5
+# Пулы обработчиков создаются при импорте приложения, поэтому оно
+# загружается в каждом процессе после fork, а не в мастер-процессе
+preload_app = False
+# Файлы сердцебиения на диске контейнера могут тормозить процессы
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+
+def on_starting(server) -> None:
+    """Файлы метрик прошлого запуска не попадают в новые суммы."""
+    metrics.clear_directory(web_config.metrics_directory)
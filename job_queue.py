@@ -0,0 +1,303 @@
+import json
+import logging
+import random
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from typing import NamedTuple
+
+from configuration_bot import BotConfig
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+BACKEND_MEMORY = 'memory'
+BACKEND_SQLITE = 'sqlite'
+
+# Состояния задач в очереди
+STATUS_QUEUED = 'queued'
+STATUS_LEASED = 'leased'
+STATUS_FAILED = 'failed'
+
+
+class Job(NamedTuple):
+    """Задача, выданная обработчику."""
+
+    id: int
+    key: str
+    payload: dict
+    attempt: int
+    token: str
+
+
+class JobQueue:
+    """
+
+    Очередь задач в файле SQLite, переживает перезапуск.
+
+    Обработчик берет задачу в аренду на время видимости. Если он
+    не завершил задачу и не продлил аренду, задача снова выдается
+    другому обработчику. Ошибки повторяются с экспоненциальной
+    задержкой, после max_attempts задача остается в статусе failed.
+    Задачи с одинаковым ключом не выполняются одновременно,
+    а ожидающая задача при новом событии получает свежие данные.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            max_size: int = 1000,
+            max_attempts: int = 5,
+            backoff: float = 5,
+            max_backoff: float = 300
+    ):
+        """
+
+        Открытие очереди.
+
+        :param path: путь к файлу базы
+        :param max_size: сколько задач может ожидать и выполняться
+        :param max_attempts: сколько раз выполнять задачу с ошибкой
+        :param backoff: задержка перед первым повтором в секундах
+        :param max_backoff: наибольшая задержка перед повтором в секундах
+        """
+        self.path = path
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        with self._transaction() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, '
+                'payload TEXT NOT NULL, status TEXT NOT NULL, '
+                'attempts INTEGER NOT NULL DEFAULT 0, '
+                'available_at REAL NOT NULL, token TEXT, leased_until REAL, '
+                'error TEXT, created_at REAL NOT NULL)'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_status '
+                'ON jobs (status, available_at)'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status)'
+            )
+
+    def enqueue(self, payload: dict, key: str = None) -> bool:
+        """
+
+        Постановка задачи в очередь.
+
+        :param payload: данные задачи, сериализуемые в JSON
+        :param key: ключ для объединения задач (id задачи pyrus)
+        :return: True, если задача принята, False - если очередь заполнена
+        """
+        data = json.dumps(payload, ensure_ascii=False)
+        now = time.time()
+        with self._transaction() as connection:
+            if key is not None:
+                updated = connection.execute(
+                    'UPDATE jobs SET payload = ?, attempts = 0, '
+                    'available_at = ?, error = NULL '
+                    'WHERE key = ? AND status = ?',
+                    (data, now, key, STATUS_QUEUED)
+                ).rowcount
+                if updated:
+                    return True
+            size = connection.execute(
+                'SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)',
+                (STATUS_QUEUED, STATUS_LEASED)
+            ).fetchone()[0]
+            if size >= self.max_size:
+                return False
+            connection.execute(
+                'INSERT INTO jobs (key, payload, status, available_at, '
+                'created_at) VALUES (?, ?, ?, ?, ?)',
+                (key, data, STATUS_QUEUED, now, now)
+            )
+        return True
+
+    def lease(self, visibility_timeout: float) -> (Job, None):
+        """
+
+        Получение следующей задачи в аренду.
+
+        :param visibility_timeout: на сколько секунд задача скрывается
+         от других обработчиков
+        :return: задача или None, если выполнять нечего
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            # Аренда истекла на последней попытке - обработчик упал
+            connection.execute(
+                'UPDATE jobs SET status = ?, error = ? '
+                'WHERE status = ? AND leased_until <= ? AND attempts >= ?',
+                (STATUS_FAILED, 'Истекла аренда', STATUS_LEASED, now,
+                 self.max_attempts)
+            )
+            row = connection.execute(
+                'SELECT id, key, payload, attempts FROM jobs '
+                'WHERE ((status = ? AND available_at <= ?) '
+                'OR (status = ? AND leased_until <= ?)) '
+                'AND (key IS NULL OR key NOT IN ('
+                'SELECT key FROM jobs WHERE status = ? AND leased_until > ? '
+                'AND key IS NOT NULL)) '
+                'ORDER BY available_at, id LIMIT 1',
+                (STATUS_QUEUED, now, STATUS_LEASED, now, STATUS_LEASED, now)
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, key, payload, attempts = row
+            token = uuid.uuid4().hex
+            connection.execute(
+                'UPDATE jobs SET status = ?, token = ?, leased_until = ?, '
+                'attempts = ? WHERE id = ?',
+                (STATUS_LEASED, token, now + visibility_timeout,
+                 attempts + 1, job_id)
+            )
+        return Job(job_id, key, json.loads(payload), attempts + 1, token)
+
+    def extend(self, job: Job, visibility_timeout: float) -> bool:
+        """
+
+        Продление аренды задачи.
+
+        :param job: задача в аренде
+        :param visibility_timeout: на сколько секунд от текущего момента
+        :return: False, если аренда уже потеряна
+        """
+        with self._transaction() as connection:
+            return bool(connection.execute(
+                'UPDATE jobs SET leased_until = ? '
+                'WHERE id = ? AND token = ? AND status = ?',
+                (time.time() + visibility_timeout, job.id, job.token,
+                 STATUS_LEASED)
+            ).rowcount)
+
+    def complete(self, job: Job) -> bool:
+        """
+
+        Удаление выполненной задачи.
+
+        :param job: задача в аренде
+        :return: False, если аренда уже потеряна
+        """
+        with self._transaction() as connection:
+            return bool(connection.execute(
+                'DELETE FROM jobs WHERE id = ? AND token = ?',
+                (job.id, job.token)
+            ).rowcount)
+
+    def fail(self, job: Job, error: str) -> bool:
+        """
+
+        Возврат задачи с ошибкой в очередь с задержкой.
+
+        :param job: задача в аренде
+        :param error: описание ошибки
+        :return: True, если задача будет повторена
+        """
+        retry = job.attempt < self.max_attempts
+        status = STATUS_QUEUED if retry else STATUS_FAILED
+        delay = self.get_backoff(job.attempt) if retry else 0
+        with self._transaction() as connection:
+            if retry and job.key is not None and connection.execute(
+                    'SELECT 1 FROM jobs WHERE key = ? AND status = ?',
+                    (job.key, STATUS_QUEUED)
+            ).fetchone():
+                # Уже есть задача со свежими данными, повтором будет она
+                connection.execute(
+                    'DELETE FROM jobs WHERE id = ? AND token = ?',
+                    (job.id, job.token)
+                )
+                return True
+            connection.execute(
+                'UPDATE jobs SET status = ?, available_at = ?, token = NULL, '
+                'leased_until = NULL, error = ? WHERE id = ? AND token = ?',
+                (status, time.time() + delay, error, job.id, job.token)
+            )
+        return retry
+
+    def defer(self, job: Job, delay: float) -> None:
+        """
+
+        Возврат задачи в очередь без учета попытки, например при лимите API.
+
+        :param job: задача в аренде
+        :param delay: через сколько секунд выдать задачу снова
+        :return:
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                'UPDATE jobs SET status = ?, available_at = ?, token = NULL, '
+                'leased_until = NULL, attempts = attempts - 1 '
+                'WHERE id = ? AND token = ?',
+                (STATUS_QUEUED, time.time() + delay, job.id, job.token)
+            )
+
+    def get_backoff(self, attempt: int) -> float:
+        """
+
+        Задержка перед повтором с равномерным разбросом.
+
+        :param attempt: номер неудачной попытки, начиная с 1
+        :return: задержка в секундах
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+    def stats(self) -> dict:
+        """
+
+        Количество задач по состояниям.
+
+        :return: словарь вида {состояние: количество}
+        """
+        with self._transaction() as connection:
+            rows = connection.execute(
+                'SELECT status, COUNT(*) FROM jobs GROUP BY status'
+            ).fetchall()
+        result = dict.fromkeys(
+            (STATUS_QUEUED, STATUS_LEASED, STATUS_FAILED), 0
+        )
+        result.update(rows)
+        return result
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE сразу берет блокировку записи, поэтому
+        # два процесса не выдадут одну задачу дважды
+        connection = sqlite3.connect(
+            self.path, timeout=30, isolation_level=None
+        )
+        try:
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+
+def get_job_queue(config: BotConfig) -> JobQueue:
+    """
+
+    Очередь задач по настройкам.
+
+    :param config: конфигурационный файл
+    :return: очередь задач
+    """
+    return JobQueue(
+        config.job_queue_db,
+        config.queue_size,
+        config.job_max_attempts,
+        config.job_retry_backoff,
+        config.job_max_backoff
+    )
@@ -0,0 +1,439 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Callable
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм
+SECONDS_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+# Для быстрых операций вроде ответа на вебхук
+FAST_SECONDS_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1
+)
+
+_lock = threading.Lock()
+# Метрики вида {имя: [тип, описание, {метки: значение}]}
+_metrics = {}
+# Функции, возвращающие текущие значения вида [(имя, метки, значение)]
+_collectors = []
+# Папка, куда каждый процесс сбрасывает свои метрики, None - не сбрасывать
+_directory = None
+
+
+class Histogram:
+    """Гистограмма наблюдений с накопительными корзинами."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """
+
+        Добавление наблюдения.
+
+        :param value: наблюдаемое значение
+        :return:
+        """
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def inc(name: str, value: float = 1, help_text: str = '', **labels) -> None:
+    """
+
+    Увеличение счетчика.
+
+    :param name: имя метрики
+    :param value: на сколько увеличить
+    :param help_text: описание метрики
+    :param labels: метки
+    :return:
+    """
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _get_series(name, 'counter', help_text)
+        series[key] = series.get(key, 0) + value
+
+
+def observe(
+        name: str,
+        value: float,
+        buckets: tuple = SECONDS_BUCKETS,
+        help_text: str = '',
+        **labels
+) -> None:
+    """
+
+    Добавление наблюдения в гистограмму.
+
+    :param name: имя метрики
+    :param value: наблюдаемое значение
+    :param buckets: границы корзин
+    :param help_text: описание метрики
+    :param labels: метки
+    :return:
+    """
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _get_series(name, 'histogram', help_text)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = Histogram(buckets)
+            series[key] = histogram
+        histogram.observe(value)
+
+
+@contextmanager
+def stage(name: str, timings: dict = None):
+    """
+
+    Замер времени этапа обработки отчета.
+
+    :param name: название этапа
+    :param timings: словарь для накопления времени вида
+     {этап: секунды}; если не передан, время сразу пишется в гистограмму
+    :return:
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if timings is None:
+            observe_stage(name, elapsed)
+        else:
+            timings[name] = timings.get(name, 0) + elapsed
+
+
+def observe_stage(name: str, seconds: float) -> None:
+    """
+
+    Запись времени этапа обработки отчета.
+
+    :param name: название этапа
+    :param seconds: длительность в секундах
+    :return:
+    """
+    observe(
+        'report_stage_seconds', seconds,
+        help_text='Длительность этапов обработки отчета', stage=name
+    )
+
+
+@contextmanager
+def api_call(method: str):
+    """
+
+    Замер количества и длительности обращений к API pyrus.
+
+    Pyrus сообщает об ошибке в теле ответа с кодом 200, такую ошибку
+    вызывающий код записывает в status объекта вызова.
+
+    :param method: название метода API
+    :return: объект вызова с атрибутом status
+    """
+    start = time.perf_counter()
+    call = SimpleNamespace(status='ok')
+    try:
+        yield call
+    except Exception:
+        call.status = 'error'
+        raise
+    finally:
+        inc('pyrus_api_calls_total', help_text='Обращения к API pyrus',
+            method=method, status=call.status)
+        observe(
+            'pyrus_api_call_seconds', time.perf_counter() - start,
+            help_text='Длительность обращений к API pyrus', method=method
+        )
+
+
+def call_api(method: str, fn: Callable, *args, **kwargs):
+    """
+
+    Вызов метода API pyrus с замером.
+
+    :param method: название метода API
+    :param fn: вызываемая функция
+    :param args: аргументы функции
+    :param kwargs: именованные аргументы функции
+    :return: результат функции
+    """
+    with api_call(method) as call:
+        result = fn(*args, **kwargs)
+        if getattr(result, 'error', None):
+            call.status = 'error'
+        return result
+
+
+def add_collector(collector: Callable[[], list]) -> None:
+    """
+
+    Регистрация источника текущих значений (очереди, кэши).
+
+    :param collector: функция, возвращающая список вида
+     [(имя метрики, {метки}, значение)]
+    :return:
+    """
+    with _lock:
+        _collectors.append(collector)
+
+
+def configure_directory(directory: str, interval: float) -> None:
+    """
+
+    Общие метрики нескольких процессов (gunicorn, report_worker.py).
+
+    Как в режиме multiprocess у prometheus_client: каждый процесс раз
+    в interval секунд сбрасывает свои значения в файл <pid>.json,
+    render складывает счетчики и гистограммы всех файлов папки,
+    а текущие значения показывает по живым процессам с меткой pid.
+
+    :param directory: папка файлов метрик, пустая - метрики процесса
+    :param interval: период сброса в секундах
+    :return:
+    """
+    global _directory
+    if not directory:
+        return
+    os.makedirs(directory, exist_ok=True)
+    with _lock:
+        started = _directory is not None
+        _directory = directory
+    if not started:
+        threading.Thread(
+            target=_flush_loop, args=(interval,), name='metrics-flush',
+            daemon=True
+        ).start()
+        atexit.register(flush)
+
+
+def clear_directory(directory: str) -> None:
+    """
+
+    Удаление файлов метрик прошлого запуска.
+
+    :param directory: папка файлов метрик
+    :return:
+    """
+    if not directory or not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            os.remove(os.path.join(directory, name))
+
+
+def flush() -> None:
+    """Запись метрик процесса в его файл в общей папке."""
+    directory = _directory
+    if directory is None:
+        return
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    with open(f'{path}.tmp', 'w', encoding='utf8') as snapshot_file:
+        json.dump(_snapshot(), snapshot_file)
+    # Читатели видят либо прошлый, либо новый файл целиком
+    os.replace(f'{path}.tmp', path)
+
+
+def render() -> str:
+    """
+
+    Все метрики в текстовом формате Prometheus.
+
+    С общей папкой метрик - сумма по всем процессам.
+
+    :return: текст для /diagnostics/metrics
+    """
+    pid = os.getpid()
+    snapshots = [(pid, _snapshot())]
+    directory = _directory
+    if directory is not None:
+        snapshots.extend(_read_snapshots(directory, pid))
+    merged, gauges = _merge(snapshots, directory is not None)
+    lines = []
+    for name, (kind, help_text, series) in sorted(merged.items()):
+        if help_text:
+            lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for key, value in sorted(series.items()):
+            labels = dict(key)
+            if kind == 'counter':
+                lines.append(f'{name}{_labels(labels)} {value}')
+                continue
+            for bound, count in zip(value['buckets'], value['counts']):
+                bucket_labels = dict(labels, le=str(bound))
+                lines.append(
+                    f'{name}_bucket{_labels(bucket_labels)} {count}'
+                )
+            inf_labels = dict(labels, le='+Inf')
+            lines.append(
+                f'{name}_bucket{_labels(inf_labels)} {value["count"]}'
+            )
+            lines.append(f'{name}_sum{_labels(labels)} {value["sum"]}')
+            lines.append(f'{name}_count{_labels(labels)} {value["count"]}')
+    for name, values in sorted(gauges.items()):
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in values:
+            lines.append(f'{name}{_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def totals(name: str, label: str) -> dict:
+    """
+
+    Суммы метрики в разрезе одной метки.
+
+    :param name: имя метрики
+    :param label: имя метки
+    :return: словарь вида {значение метки: сумма}, для гистограмм -
+     сумма наблюдений
+    """
+    result = {}
+    with _lock:
+        kind, _, series = _metrics.get(name, (None, None, {}))
+        for key, value in series.items():
+            label_value = dict(key).get(label)
+            amount = value.sum if kind == 'histogram' else value
+            result[label_value] = result.get(label_value, 0) + amount
+    return result
+
+
+def reset() -> None:
+    """Очистка накопленных метрик."""
+    with _lock:
+        _metrics.clear()
+
+
+def _snapshot() -> dict:
+    # Значения процесса в виде, который можно сохранить в JSON
+    with _lock:
+        collectors = list(_collectors)
+        snapshot = {
+            'metrics': {
+                name: [kind, help_text, [
+                    [[[label, str(value)] for label, value in key],
+                     _dump_value(value)]
+                    for key, value in series.items()
+                ]]
+                for name, (kind, help_text, series) in _metrics.items()
+            },
+        }
+    snapshot['gauges'] = [
+        [name, {key: str(value) for key, value in labels.items()}, value]
+        for collector in collectors
+        for name, labels, value in collector()
+    ]
+    return snapshot
+
+
+def _dump_value(value):
+    if not isinstance(value, Histogram):
+        return value
+    return {'buckets': list(value.buckets), 'counts': list(value.counts),
+            'sum': value.sum, 'count': value.count}
+
+
+def _read_snapshots(directory: str, own_pid: int) -> list:
+    snapshots = []
+    for name in sorted(os.listdir(directory)):
+        pid, ext = os.path.splitext(name)
+        if ext != '.json' or not pid.isdigit() or int(pid) == own_pid:
+            continue
+        try:
+            with open(os.path.join(directory, name),
+                      encoding='utf8') as snapshot_file:
+                snapshots.append((int(pid), json.load(snapshot_file)))
+        except (OSError, ValueError):
+            logger.warning(f'Файл метрик {name} не прочитан')
+    return snapshots
+
+
+def _merge(snapshots: list, by_pid: bool) -> (dict, dict):
+    # Счетчики и гистограммы складываются, счетчики завершившихся
+    # процессов тоже, чтобы сумма не уменьшалась
+    merged = {}
+    gauges = {}
+    for pid, snapshot in snapshots:
+        for name, (kind, help_text, series) in snapshot['metrics'].items():
+            metric = merged.setdefault(name, [kind, help_text, {}])
+            for labels, value in series:
+                key = tuple(tuple(pair) for pair in labels)
+                total = metric[2].get(key)
+                if kind == 'counter':
+                    metric[2][key] = (total or 0) + value
+                elif total is None:
+                    metric[2][key] = dict(value, counts=list(value['counts']))
+                else:
+                    total['counts'] = [
+                        a + b for a, b in zip(total['counts'], value['counts'])
+                    ]
+                    total['sum'] += value['sum']
+                    total['count'] += value['count']
+        # Текущие значения завершившихся процессов уже не текущие
+        if by_pid and pid != snapshots[0][0] and not _is_alive(pid):
+            continue
+        for name, labels, value in snapshot['gauges']:
+            if by_pid:
+                labels = dict(labels, pid=str(pid))
+            gauges.setdefault(name, []).append((labels, value))
+    return merged, gauges
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _flush_loop(interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        try:
+            flush()
+        except Exception:
+            logger.exception('Метрики процесса не записаны')
+
+
+def _get_series(name: str, kind: str, help_text: str) -> dict:
+    metric = _metrics.get(name)
+    if metric is None:
+        metric = [kind, help_text, {}]
+        _metrics[name] = metric
+    return metric[2]
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    items = ','.join(
+        '{}="{}"'.format(
+            key,
+            str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n')
+        )
+        for key, value in labels.items()
+    )
+    return '{' + items + '}'
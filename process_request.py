@@ -1,58 +1,298 @@
+import json
 import logging
+import os
+import threading
+
+import api_scheduler
+
+import cache
+
+import client_pool
 
 from configuration_bot import BotConfig
 
 from forms import report_form
 
+import job_queue
+
 import pyrustools.bot
 import pyrustools.client_plus
 import pyrustools.comments_copy
 import pyrustools.object_methods
 import pyrustools.objects_plus
 
+import metrics
+
+import workers
+
 
 logging.basicConfig(level=logging.DEBUG)
 logging.getLogger('urllib3').propagate = False
 logger = logging.getLogger(__name__)
 
+# Пул обработчиков настраивается из локального bot_config.json
+with open('bot_config.json', encoding='utf8') as config_file:
+    pool_config = BotConfig(json.load(config_file))
+pool = workers.WorkerPool(
+    pool_config.workers_count,
+    pool_config.queue_size,
+    pool_config.queue_full_policy,
+    pool_config.queue_put_timeout
+)
+# Вебхуки одной задачи объединяются и между процессами gunicorn
+coalescer = workers.ProcessCoalescer(pool_config.task_lock_directory)
+# Постоянная очередь, задачи из которой выполняет report_worker.py
+jobs = None
+if pool_config.job_queue == job_queue.BACKEND_SQLITE:
+    jobs = job_queue.get_job_queue(pool_config)
+
+
+def collect_metrics() -> list:
+    """
+
+    Текущее состояние очереди обработчиков и общих кэшей.
+
+    :return: список вида [(имя метрики, {метки}, значение)]
+    """
+    # Процессы, чьи значения вошли в ответ /diagnostics/metrics
+    values = [('report_metrics_process', {'pid': str(os.getpid())}, 1)]
+    values.extend(
+        (f'report_pool_{name}', {}, value)
+        for name, value in pool.stats().items()
+    )
+    if jobs is not None:
+        values.extend(
+            ('report_job_queue_jobs', {'status': status}, count)
+            for status, count in jobs.stats().items()
+        )
+    values.extend(
+        (f'pyrus_client_pool_{name}', {}, value)
+        for name, value in client_pool.get_pool(pool_config).stats().items()
+    )
+    for cache_name, cache_stats in cache.stats().items():
+        values.extend(
+            (f'report_cache_{name}', {'cache': cache_name}, value)
+            for name, value in cache_stats.items()
+        )
+    return values
+
+
+metrics.add_collector(collect_metrics)
+# Метрики всех процессов gunicorn и report_worker.py собираются в одной папке
+metrics.configure_directory(
+    pool_config.metrics_directory, pool_config.metrics_flush_interval
+)
+
 
-def process_thread(*args):
-    """:return."""
+def process_thread(*args, client=None):
+    """
+
+    Main bot function: one report run for a webhook or a test call.
+    Errors are logged and not raised, runs that hit Pyrus API limits
+    are resubmitted after the delay.
+    :param args: (task_id,) for a test call or (body, retry, session_id)
+    :param client: Pyrus API client to use instead of a new MyPyrus,
+     e.g. cassette.ReplayPyrus
+    :return:
+    """
     try:
-        bot = pyrustools.bot.Bot()
+        process_task(*args, client=client)
+    except api_scheduler.RetryLater as error:
         if len(args) == 1:
-            bot.init_from_test('config.json', args[0])
-        else:
-            bot.init_from_webhook(args[0], args[1], args[2])
-        configuration = BotConfig(bot.configuration)
-        bot.pyrus_client.update_task_field_info(bot.task)
-        bot_form_id = bot.task.form_id
-        bot.pyrus_client.comment_task_plus(
-            bot.task.id, approval_choice='approved'
-        )
-        if bot_form_id in configuration.allow_form_ids:
-            report_form.process_reports(
-                bot.pyrus_client, configuration, bot.task
-            )
+            logger.error(str(error))
+            return
+        # The worker is released; the webhook is queued again after the delay
+        logger.warning(f'Report run deferred: {error}')
+        schedule_resubmit(error.delay, args)
     except Exception:
         error = pyrustools.object_methods.get_exception()
         logger.error(error)
 
 
+def process_task(*args, client=None):
+    """
+
+    One report run, errors are raised so the job queue can retry the job.
+    :param args: (task_id,) for a test call or (body, retry, session_id)
+    :param client: Pyrus API client to use instead of the pooled
+     client_pool.PooledPyrus
+    :return:
+    """
+    bot = pyrustools.bot.Bot()
+    # Pyrus API limits, tokens and cached data apply to each bot user
+    # separately; a test call is keyed by the bot login
+    account = args[0].get('user_id') if len(args) > 1 else None
+    if client is None:
+        client = client_pool.get_pool(pool_config).get_client(account)
+    elif account is not None:
+        client.account = account
+    bot.pyrus_client = client
+    if len(args) == 1:
+        bot.init_from_test('config.json', args[0])
+    else:
+        bot.init_from_webhook(args[0], args[1], args[2])
+    configuration = BotConfig(bot.configuration)
+    metrics.call_api(
+        'update_task_field_info',
+        bot.pyrus_client.update_task_field_info, bot.task
+    )
+    bot_form_id = bot.task.form_id
+    metrics.call_api(
+        'comment_task', bot.pyrus_client.comment_task_plus,
+        bot.task.id, approval_choice='approved'
+    )
+    if bot_form_id in configuration.allow_form_ids:
+        report_form.process_reports(
+            bot.pyrus_client, configuration, bot.task
+        )
+    elif configuration.incremental_reports:
+        # Задача формы-источника: обновляем построенные по ней отчеты
+        report_form.process_source_task(
+            bot.pyrus_client, configuration, bot.task
+        )
+
+
+def schedule_resubmit(delay, args, attempt=1):
+    """
+
+    Queueing a deferred report run again after the delay.
+    :param delay: delay in seconds
+    :param args: (body, retry, session_id) of the webhook
+    :param attempt: resubmit attempt number, starting from 1
+    :return:
+    """
+    timer = threading.Timer(delay, resubmit, (args, attempt))
+    timer.daemon = True
+    timer.start()
+
+
+def resubmit(args, attempt):
+    """
+
+    Timer callback for a deferred report run.
+    If the queue is still full, the run is retried with a growing delay
+    (JOB_RETRY_BACKOFF, up to JOB_MAX_BACKOFF) for JOB_MAX_ATTEMPTS
+    attempts, then dropped with an error and a metric.
+    :param args: (body, retry, session_id) of the webhook
+    :param attempt: resubmit attempt number, starting from 1
+    :return:
+    """
+    if submit_webhook(*args):
+        return
+    task_id = args[0].get('task_id')
+    if attempt >= pool_config.job_max_attempts:
+        logger.error(f'Deferred report run for task {task_id} dropped: '
+                     f'worker queue is full after {attempt} attempts')
+        metrics.inc('report_deferred_total', result='dropped',
+                    help_text='Resubmits of deferred report runs')
+        return
+    delay = min(pool_config.job_max_backoff,
+                pool_config.job_retry_backoff * 2 ** (attempt - 1))
+    logger.warning(f'Worker queue is full, deferred report run for task '
+                   f'{task_id} is retried in {delay} s')
+    metrics.inc('report_deferred_total', result='queue_full',
+                help_text='Resubmits of deferred report runs')
+    schedule_resubmit(delay, args, attempt + 1)
+
+
+def submit_webhook(body, retry, session_id) -> bool:
+    """
+
+    Queueing a report run to the worker pool or the job queue.
+    :param body: Body we got from webhook request
+    :param retry: Retry number
+    :param session_id: Unique session ID
+    :return: False if the queue is full
+    """
+    task_id = body.get('task_id')
+    if jobs is not None:
+        return jobs.enqueue(
+            get_job_payload(body, retry, session_id),
+            key=None if task_id is None else str(task_id)
+        )
+    if task_id is None:
+        return pool.submit(process_thread, body, retry, session_id)
+    return pool.submit(
+        coalescer.run, task_id, process_thread, body, retry, session_id,
+        key=task_id
+    )
+
+
+def get_job_payload(body, retry, session_id) -> dict:
+    """
+
+    Job queue payload for a webhook.
+    The bot token and the task are not stored: the token may expire
+    before the job runs, so process_job signs in again and gets
+    the current task.
+    :param body: Body we got from webhook request
+    :param retry: Retry number
+    :param session_id: Unique session ID
+    :return: payload with task_id, retry, session_id, user_id
+     and bot_settings
+    """
+    return {
+        'task_id': body.get('task_id'),
+        'retry': retry,
+        'session_id': session_id,
+        'user_id': body.get('user_id'),
+        'bot_settings': body.get('bot_settings'),
+    }
+
+
+def process_job(payload, client=None):
+    """
+
+    One report run for a job from the job queue.
+    The client signs in with the bot credentials from config.json,
+    then the webhook body is rebuilt with a fresh token and task.
+    :param payload: job payload from get_job_payload
+    :param client: Pyrus API client to use instead of the pooled
+     client_pool.PooledPyrus
+    :return:
+    """
+    if client is None:
+        client = client_pool.get_pool(pool_config).get_client(
+            payload['user_id']
+        )
+    if client.login is None:
+        client.read_login_info('config.json')
+    client.get_host(json.loads(payload['bot_settings']))
+    task_id = payload['task_id']
+    response = metrics.call_api('get_task', client.get_task, task_id)
+    if getattr(response, 'task', None) is None:
+        raise LookupError(f'Task {task_id} is not available: '
+                          f'{getattr(response, "error", None)}')
+    body = {
+        'task_id': task_id,
+        'task': response.original_response['task'],
+        'access_token': client.access_token,
+        'user_id': payload['user_id'],
+        'bot_settings': payload['bot_settings'],
+    }
+    process_task(body, payload['retry'], payload['session_id'], client=client)
+
+
 def process_webhook(body, retry, session_id):
     """
 
     This function is called from flask app.py.
-    Here we're initializing bot parameters, pyrus_client and launching
-    in a thread main bot function
+    Here we're queueing main bot function to the bounded worker pool
+    or, with JOB_QUEUE set to sqlite, to the persistent job queue
+    served by report_worker.py.
+    Webhooks for the same task are coalesced into one report run,
+    also across web server processes.
+    If the queue is full, 503 is returned so Pyrus retries the webhook later
     :param body: Body we got from webhook request
     :param retry: Retry number
     :param session_id: Unique session ID
     :return:
     """
-    # Running main function in a thread
-    pyrustools.bot.start_in_thread(process_thread, body, retry, session_id)
+    # Queueing main function to the worker pool
+    if not submit_webhook(body, retry, session_id):
+        logger.error(f'Worker queue is full, stats: {(jobs or pool).stats()}')
+        return '', 503
     # Immediately sending 200 OK to Pyrus
-    msg = "Sending 200 OK to Pyrus request after launching bot in a thread"
+    msg = "Sending 200 OK to Pyrus request after queueing bot job"
     logger.debug(msg)
     return ''
@@ -0,0 +1,157 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+# Интервал между снимками стеков в секундах
+SAMPLE_INTERVAL = 0.005
+
+
+class StackSampler:
+    """
+
+    Сэмплирующий профилировщик стеков всех потоков.
+
+    cProfile видит только поток, в котором запущен, а отчет загружает
+    реестры в пуле потоков, поэтому для flamegraph стеки снимаются
+    с каждого потока через равные интервалы.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        """
+
+        Настройка профилировщика.
+
+        :param interval: интервал между снимками в секундах
+        """
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Запуск снятия стеков в отдельном потоке."""
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='stack-sampler', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Остановка снятия стеков."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write_collapsed(self, path: str) -> None:
+        """
+
+        Запись стеков в свернутом формате (flamegraph.pl, speedscope).
+
+        :param path: путь к файлу
+        :return:
+        """
+        with open(path, 'w', encoding='utf8') as collapsed_file:
+            for stack, count in sorted(self.stacks.items()):
+                collapsed_file.write(f'{";".join(stack)} {count}\n')
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {
+                thread.ident: thread.name for thread in threading.enumerate()
+            }
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[tuple(reversed(stack))] += 1
+
+
+@contextmanager
+def profile(path: str, top: int = 30):
+    """
+
+    Профилирование блока кода.
+
+    Сохраняет статистику cProfile в <path>.prof (pstats, snakeviz)
+    и стеки всех потоков в <path>.folded для flamegraph,
+    печатает самые затратные функции по накопленному времени.
+
+    :param path: путь к файлам без расширения
+    :param top: сколько функций напечатать
+    :return:
+    """
+    profiler = cProfile.Profile()
+    sampler = StackSampler()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        profiler.dump_stats(f'{path}.prof')
+        sampler.write_collapsed(f'{path}.folded')
+        output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        print(output.getvalue())
+        print(f'Profile saved to {path}.prof, '
+              f'collapsed stacks to {path}.folded')
+
+
+@contextmanager
+def trace_memory(top: int = 30, frames: int = 1):
+    """
+
+    Отслеживание выделений памяти в блоке кода.
+
+    Печатает строки кода, выделившие больше всего памяти,
+    и пиковый объем отслеживаемой памяти.
+
+    :param top: сколько строк напечатать
+    :param frames: глубина стека для каждого выделения
+    :return:
+    """
+    tracemalloc.start(frames)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*'),
+        ))
+        print(f'Top {top} allocators:')
+        for stat in snapshot.statistics('lineno')[:top]:
+            print(f'  {stat}')
+        print(f'Memory: current {current / 2 ** 20:.1f} MiB, '
+              f'peak {peak / 2 ** 20:.1f} MiB, '
+              f'{time.perf_counter() - start:.2f} s')
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    file_name = os.path.basename(code.co_filename)
+    return f'{code.co_name} ({file_name}:{code.co_firstlineno})'
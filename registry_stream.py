@@ -0,0 +1,277 @@
+import codecs
+import json
+import logging
+import os
+from typing import Iterable, Iterator
+
+import api_scheduler
+
+import requests
+
+from pyrus.models import entities as ent
+from pyrus.models import requests as req
+from pyrus.models import responses as resp
+
+from pyrustools.client_plus import MyPyrus
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _Reader:
+    """Посимвольное чтение JSON из потока кусков текста."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._chunks = iter(chunks)
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size: int = 1) -> bool:
+        # Дочитываем не меньше size символов, чтобы буфер рос геометрически
+        if self._eof:
+            return False
+        parts = [self._buffer[self._pos:]]
+        read = 0
+        while read < max(size, 1):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._eof = True
+                parts.append(self._utf8.decode(b'', final=True))
+                break
+            text = self._utf8.decode(chunk)
+            parts.append(text)
+            read += len(text)
+        self._buffer = ''.join(parts)
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Следующий значимый символ (пробелы пропускаются)."""
+        while True:
+            while self._pos < len(self._buffer):
+                char = self._buffer[self._pos]
+                if not char.isspace():
+                    return char
+                self._pos += 1
+            if not self._fill():
+                return ''
+
+    def expect(self, char: str) -> None:
+        """Чтение ожидаемого символа."""
+        if self.peek() != char:
+            raise ValueError(f'Ожидался символ {char!r} в ответе реестра')
+        self._pos += 1
+
+    def value(self):
+        """Чтение одного значения JSON целиком."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill(len(self._buffer) - self._pos):
+                    raise
+                continue
+            # Число могло оборваться на границе куска
+            if end == len(self._buffer) and not self._eof:
+                self._fill()
+                continue
+            self._pos = end
+            return value
+
+
+def iter_array_items(
+        chunks: Iterable[bytes],
+        key: str,
+        meta: dict
+) -> Iterator[dict]:
+    """
+
+    Потоковый разбор массива верхнего уровня из JSON-объекта.
+
+    Элементы массива по ключу key отдаются по одному,
+    остальные ключи верхнего уровня складываются в meta.
+
+    :param chunks: куски ответа в байтах
+    :param key: ключ массива
+    :param meta: словарь для остальных ключей ответа
+    :return: генератор элементов массива
+    """
+    reader = _Reader(chunks)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key and reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.peek() == ',':
+                        reader.expect(',')
+                        continue
+                    reader.expect(']')
+                    break
+        else:
+            meta[name] = reader.value()
+        if reader.peek() == ',':
+            reader.expect(',')
+            continue
+        reader.expect('}')
+        return
+
+
+def iter_registry(
+        client: MyPyrus,
+        form_id: int,
+        meta: dict,
+        request: req.FormRegisterRequest = None
+) -> Iterator[ent.Task]:
+    """
+
+    Потоковое получение задач реестра формы по одной.
+
+    Если у клиента есть метод get_registry_chunks (локальная подмена
+    реестра), куски ответа берутся из него, иначе из API pyrus.
+
+    :param client: сущность клиента pyrus
+    :param form_id: id формы
+    :param meta: словарь для остальных ключей ответа (например, error)
+    :param request: запрос реестра с полями и фильтрами
+    :return: генератор задач реестра
+    """
+    get_chunks = getattr(client, 'get_registry_chunks', None)
+    if get_chunks:
+        chunks = get_chunks(form_id, request)
+    else:
+        chunks = http_chunks(client, form_id, request)
+    for task in iter_array_items(chunks, 'tasks', meta):
+        yield ent.Task(**task)
+
+
+def http_chunks(
+        client: MyPyrus,
+        form_id: int,
+        request: req.FormRegisterRequest = None
+) -> Iterator[bytes]:
+    """
+
+    Потоковая загрузка ответа реестра из API pyrus.
+
+    :param client: сущность клиента pyrus
+    :param form_id: id формы
+    :param request: запрос реестра с полями и фильтрами
+    :return: генератор кусков ответа
+    """
+    url = client._create_url(f'/forms/{form_id}/register')
+    if not client.access_token:
+        client._auth()
+    if isinstance(client, api_scheduler.ScheduledPyrus):
+        response = client.send(lambda: _open_stream(client, url, request))
+    else:
+        response = _open_stream(client, url, request)
+        if response.status_code == 401:
+            response.close()
+            client._auth()
+            response = _open_stream(client, url, request)
+    with response:
+        if response.status_code >= 500:
+            msg = f'Статус ответа реестра {form_id}: {response.status_code}'
+            logger.error(msg)
+            yield json.dumps(
+                {'error': msg, 'error_code': 'server_error'}
+            ).encode('utf-8')
+            return
+        yield from response.iter_content(CHUNK_SIZE)
+
+
+def _open_stream(
+        client: MyPyrus,
+        url: str,
+        request: req.FormRegisterRequest = None
+) -> requests.Response:
+    verify = client._host != 'pyrus.abk-invest.ru'
+    # Клиент из пула передает выгрузку через общие соединения
+    http = getattr(client, 'session', requests)
+    if request is None:
+        return http.get(
+            url,
+            headers=client._create_default_headers(),
+            proxies=client.proxy,
+            stream=True,
+            verify=verify
+        )
+    return http.post(
+        url,
+        headers=client._create_default_headers(),
+        data=client.serialize_request(request),
+        proxies=client.proxy,
+        stream=True,
+        verify=verify
+    )
+
+
+class FileRegistrySource:
+    """
+
+    Локальная подмена реестров pyrus ответами из файлов.
+
+    Реестр формы читается из файла <directory>/<id формы>.json.
+    Запрос реестра с полями и фильтрами не применяется: файл отдается
+    целиком, а отчет все равно фильтрует реестр локально.
+    """
+
+    _host = 'file'
+
+    def __init__(self, directory: str, chunk_size: int = CHUNK_SIZE):
+        self.directory = directory
+        self.chunk_size = chunk_size
+
+    def get_registry_chunks(
+            self,
+            form_id: int,
+            request: req.FormRegisterRequest = None
+    ) -> Iterator[bytes]:
+        """
+
+        Потоковое чтение реестра из файла.
+
+        :param form_id: id формы
+        :param request: запрос реестра (не применяется)
+        :return: генератор кусков файла
+        """
+        with open(self._path(form_id), 'rb') as file:
+            while True:
+                chunk = file.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def get_registry(
+            self,
+            form_id: int,
+            request: req.FormRegisterRequest = None
+    ) -> resp.FormRegisterResponse:
+        """
+
+        Чтение реестра из файла целиком.
+
+        :param form_id: id формы
+        :param request: запрос реестра (не применяется)
+        :return: реестр формы
+        """
+        with open(self._path(form_id), encoding='utf-8') as file:
+            return resp.FormRegisterResponse(**json.load(file))
+
+    def _path(self, form_id: int) -> str:
+        return os.path.join(self.directory, f'{form_id}.json')
@@ -0,0 +1,187 @@
+"""
+Обработчики постоянной очереди отчетов (JOB_QUEUE = sqlite).
+
+Запуск из корня репозитория рядом с веб-сервером:
+    python report_worker.py --processes 2
+
+Каждый процесс выполняет задачи в WORKERS_COUNT потоках. Процессы
+можно запускать отдельно от веб-сервера, в том числе в другом
+контейнере с общим файлом очереди JOB_QUEUE_DB.
+
+Токен бота в очереди не хранится: обработчик входит по LOGIN
+и SECRET_KEY бота из config.json и получает задачу заново.
+
+Метрики процессы пишут в METRICS_DIRECTORY, их отдает
+/diagnostics/metrics веб-сервера, если папка у них общая.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+
+import api_scheduler
+
+from configuration_bot import BotConfig
+
+import job_queue
+
+import metrics
+
+import pyrustools.object_methods
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+
+def load_config() -> BotConfig:
+    """
+
+    Настройки из локального bot_config.json.
+
+    :return: конфигурационный файл
+    """
+    with open('bot_config.json', encoding='utf8') as config_file:
+        return BotConfig(json.load(config_file))
+
+
+def work(
+        jobs: job_queue.JobQueue,
+        config: BotConfig,
+        stop: threading.Event
+) -> None:
+    """
+
+    Цикл обработчика: аренда задачи, выполнение, завершение или повтор.
+
+    :param jobs: очередь задач
+    :param config: конфигурационный файл
+    :param stop: событие остановки, текущая задача выполняется до конца
+    :return:
+    """
+    # Импорт здесь, чтобы процесс-супервизор не создавал пул обработчиков
+    import process_request
+
+    timeout = config.job_visibility_timeout
+    while not stop.is_set():
+        try:
+            job = jobs.lease(timeout)
+        except Exception:
+            logger.error(pyrustools.object_methods.get_exception())
+            job = None
+        if job is None:
+            stop.wait(config.job_poll_interval)
+            continue
+        done = threading.Event()
+        keeper = threading.Thread(
+            target=keep_lease, args=(jobs, job, timeout, done),
+            name=f'lease-{job.id}', daemon=True
+        )
+        keeper.start()
+        error = None
+        delay = None
+        try:
+            process_request.process_job(job.payload)
+        except api_scheduler.RetryLater as retry_later:
+            logger.warning(f'Job {job.id} deferred: {retry_later}')
+            delay = retry_later.delay
+        except Exception:
+            error = pyrustools.object_methods.get_exception()
+            logger.error(error)
+        finally:
+            done.set()
+            keeper.join()
+        if delay is not None:
+            jobs.defer(job, delay)
+        elif error is None:
+            if not jobs.complete(job):
+                logger.error(f'Job {job.id} lease was lost before completion')
+        elif jobs.fail(job, error):
+            logger.debug(f'Job {job.id} attempt {job.attempt} will be retried')
+        else:
+            logger.error(f'Job {job.id} failed after {job.attempt} attempts')
+
+
+def keep_lease(
+        jobs: job_queue.JobQueue,
+        job: job_queue.Job,
+        timeout: float,
+        done: threading.Event
+) -> None:
+    """
+
+    Продление аренды, пока задача выполняется.
+
+    :param jobs: очередь задач
+    :param job: задача в аренде
+    :param timeout: время видимости в секундах
+    :param done: событие завершения задачи
+    :return:
+    """
+    while not done.wait(timeout / 3):
+        try:
+            if not jobs.extend(job, timeout):
+                logger.error(f'Job {job.id} lease was lost')
+                return
+        except Exception:
+            logger.error(pyrustools.object_methods.get_exception())
+
+
+def run_process() -> None:
+    """Процесс обработчиков: WORKERS_COUNT потоков до сигнала SIGTERM."""
+    config = load_config()
+    jobs = job_queue.get_job_queue(config)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    threads = [
+        threading.Thread(
+            target=work, args=(jobs, config, stop), name=f'job-worker-{n}'
+        )
+        for n in range(config.workers_count)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Процесс multiprocessing завершается без atexit
+    metrics.flush()
+
+
+def main() -> None:
+    """Запуск процессов обработчиков и перезапуск упавших."""
+    config = load_config()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int,
+                        default=config.job_worker_processes,
+                        help='number of worker processes')
+    args = parser.parse_args()
+    # Очередь создается до запуска процессов, чтобы они не гонялись
+    # за созданием таблицы
+    job_queue.get_job_queue(config)
+    context = multiprocessing.get_context('spawn')
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    processes = [None] * args.processes
+    while not stop.is_set():
+        for n, process in enumerate(processes):
+            if process is None or not process.is_alive():
+                if process is not None:
+                    logger.error(f'Worker process {process.pid} exited '
+                                 f'with code {process.exitcode}, restarting')
+                processes[n] = context.Process(
+                    target=run_process, name=f'report-worker-{n}'
+                )
+                processes[n].start()
+        stop.wait(1)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
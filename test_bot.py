@@ -1,7 +1,12 @@
 import argparse
+import contextlib
+
+import cassette
 
 import process_request
 
+import profiling
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -12,6 +17,58 @@ if __name__ == '__main__':
         type=int,
         required=True
     )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="save cProfile stats to PATH.prof and collapsed stacks "
+             "for flamegraph to PATH.folded"
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="print top allocators and peak memory (tracemalloc)"
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=30,
+        help="number of entries to print for --profile and --trace-memory"
+    )
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument(
+        "--record",
+        metavar="CASSETTE",
+        help="record API requests and responses to a cassette "
+             "(compressed if the name ends with .gz)"
+    )
+    source.add_argument(
+        "--replay",
+        metavar="CASSETTE",
+        help="serve API responses from a recorded cassette "
+             "instead of live Pyrus"
+    )
+    parser.add_argument(
+        "--latency",
+        type=cassette.parse_latency,
+        default=0,
+        help="simulated latency of each replayed API call in seconds, "
+             "or 'recorded' to repeat the recorded durations"
+    )
     args = parser.parse_args()
 
-    process_request.process_thread(args.task)
+    client = None
+    if args.replay:
+        client = cassette.ReplayPyrus(args.replay, args.latency)
+    elif args.record:
+        client = cassette.RecordingPyrus(args.record)
+    with contextlib.ExitStack() as stack:
+        if args.record:
+            stack.callback(client.close)
+        if args.trace_memory:
+            stack.enter_context(profiling.trace_memory(args.top))
+        if args.profile:
+            stack.enter_context(profiling.profile(args.profile, args.top))
+        process_request.process_thread(args.task, client=client)
+    if args.replay:
+        print(f'Replayed {len(client.calls)} API calls, '
+              f'{len(client.comments)} comments not sent')
@@ -0,0 +1,148 @@
+import json
+import random
+from array import array
+
+from benchmarks import synthetic
+from benchmarks.local_pyrus import LocalPyrus
+
+from configuration_bot import BotConfig
+
+from forms import aggregation, report_form, report_plan
+
+from pyrustools.objects_plus import FormResponsePlus
+
+import pytest
+
+pytestmark = pytest.mark.skipif(
+    aggregation.np is None, reason='numpy не установлен'
+)
+
+SOURCE_FORM_ID = 1001
+NUMBER_FIELD_ID = 6
+NUMBERS = (0.1, 0.2, 0.30000000000000004, 1e-7, 2.5, -0.0)
+
+
+def count_both(*args) -> tuple:
+    """Подсчет обоими способами."""
+    return tuple(
+        aggregation.count_groups(*args, backend=backend)
+        for backend in (aggregation.BACKEND_PYTHON,
+                        aggregation.BACKEND_NUMPY)
+    )
+
+
+def random_codes(rnd, size: int, cardinality: int) -> array:
+    """Коды значений колонки среза."""
+    return array('I', (rnd.randrange(cardinality) for _ in range(size)))
+
+
+@pytest.mark.parametrize('size', [1, 7, 1000])
+@pytest.mark.parametrize('rows', ['all', 'subset', 'empty'])
+def test_count_groups_backends_match(size, rows):
+    """Группы, порядок и счетчики совпадают до типа значений."""
+    rnd = random.Random(size)
+    values = random_codes(rnd, size, 12)
+    links = random_codes(rnd, size, 3)
+    counted = [
+        (random_codes(rnd, size, 8), {1: [10], 3: [11, 12], 7: [13]}),
+        (values, {0: [20], 5: [21]}),
+    ]
+    rows_idx = {
+        'all': range(size),
+        'subset': [idx for idx in range(size) if idx % 3],
+        'empty': [],
+    }[rows]
+
+    python, numpy = count_both(values, links, counted, rows_idx)
+
+    assert python == numpy
+    groups, totals = numpy
+    numbers = [*totals.values()] + [
+        value for group in groups
+        for value in (*group[:3], *group[3].values())
+    ]
+    assert all(type(value) is int for value in numbers)
+
+
+def make_source_form() -> dict:
+    """Форма-источник с числовым полем с дробными значениями."""
+    form = synthetic.make_source_form(SOURCE_FORM_ID)
+    form['fields'].append({
+        'id': NUMBER_FIELD_ID, 'type': 'number', 'name': 'Число',
+        'info': {'code': 'Num'}
+    })
+    return form
+
+
+def make_registry(size: int) -> dict:
+    """Реестр, где у части задач заполнено числовое поле."""
+    registry = synthetic.make_registry(SOURCE_FORM_ID, size, 2)
+    for n, task in enumerate(registry['tasks']):
+        if n % 4:
+            task['fields'].append({
+                'id': NUMBER_FIELD_ID, 'type': 'number',
+                'value': NUMBERS[n % len(NUMBERS)]
+            })
+    return registry
+
+
+def make_report() -> dict:
+    """Отчет с таблицей по числовому полю и подсчетом дробных значений."""
+    report = synthetic.make_report_form([SOURCE_FORM_ID], 2)
+    table = next(
+        field for field in report['fields']
+        if field['info']['code'] == f'REPORT_{SOURCE_FORM_ID}_people'
+    )
+    table['info']['columns'] += [
+        {'id': 39000 + n, 'type': 'number', 'name': str(number),
+         'info': {'code': 'Num'}}
+        for n, number in enumerate(NUMBERS)
+    ]
+    numbers = json.loads(json.dumps(table))
+    numbers['id'] = 50000
+    numbers['info']['code'] = f'REPORT_{SOURCE_FORM_ID}_numbers'
+    numbers['info']['columns'][0]['info']['code'] = 'Num'
+    for n, column in enumerate(numbers['info']['columns']):
+        column['id'] = 50000 + n + 1
+    report['fields'].append(numbers)
+    return report
+
+
+@pytest.mark.parametrize('size', [0, 1, 300])
+@pytest.mark.parametrize('filters', [
+    {},
+    {f'REPORT_{SOURCE_FORM_ID}': [['City', 'Москва']]},
+    # Под фильтр не попадает ни одна задача - пустая таблица
+    {f'REPORT_{SOURCE_FORM_ID}_people': [['City', 'Нет такого']]},
+], ids=['all', 'filtered', 'empty'])
+def test_report_tables_match_between_backends(size, filters):
+    """Таблицы отчета одинаковы при подсчете python и numpy."""
+    with open('bot_config.json', encoding='utf8') as config_file:
+        config = BotConfig(dict(json.load(config_file), CACHE_TTL=0))
+    report_form.configure_caches(config)
+    client = LocalPyrus(
+        forms={SOURCE_FORM_ID: make_source_form()},
+        registries={SOURCE_FORM_ID: make_registry(size)},
+        contacts=synthetic.make_contacts(),
+        catalogs={synthetic.CATALOG_ID: synthetic.make_catalog()}
+    )
+    plan = report_plan.get_report_plan(
+        FormResponsePlus(**make_report()), config
+    )
+    sources = report_form.get_sources(plan, client, filters)
+
+    tables = {}
+    for backend in (aggregation.BACKEND_PYTHON, aggregation.BACKEND_NUMPY):
+        tables[backend] = {
+            table_id: [
+                [(cell.id, repr(cell.value)) for cell in row.cells]
+                for row in rows
+            ]
+            for table_id, rows in report_form.get_tables(
+                plan, sources, client, filters, backend
+            ).items()
+        }
+
+    assert tables[aggregation.BACKEND_PYTHON] == tables[
+        aggregation.BACKEND_NUMPY
+    ]
@@ -0,0 +1,153 @@
+import email.utils
+
+import api_scheduler
+
+import process_request
+
+import pytest
+
+
+class Clock:
+    """Время, которое двигает только ожидание планировщика."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        """Текущее время."""
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        """Ожидание без реальной паузы."""
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Response:
+    """Ответ requests с кодом и заголовками."""
+
+    def __init__(self, status_code: int, headers: dict = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self) -> None:
+        """Соединение возвращается в пул."""
+        self.closed = True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Подмена времени и ожидания планировщика."""
+    clock = Clock()
+    monkeypatch.setattr(api_scheduler.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(api_scheduler.time, 'sleep', clock.sleep)
+    monkeypatch.setattr(api_scheduler.random, 'uniform', lambda a, b: b)
+    return clock
+
+
+def make_client(scheduler: api_scheduler.ApiScheduler,
+                responses: list) -> api_scheduler.ScheduledPyrus:
+    """Клиент, запросы которого получают ответы по очереди."""
+    client = api_scheduler.ScheduledPyrus(scheduler, access_token='token')
+    client.account = 7
+    client.responses = iter(responses)
+    return client
+
+
+def send(client: api_scheduler.ScheduledPyrus) -> Response:
+    """Запрос через планировщик с очередным ответом."""
+    return client.send(lambda: next(client.responses))
+
+
+def test_token_bucket_paces_requests_per_account(clock):
+    """После всплеска запросы идут с частотой rate, у аккаунтов свои лимиты."""
+    scheduler = api_scheduler.ApiScheduler(rate=2, burst=2, max_wait=10)
+
+    for _ in range(4):
+        scheduler.acquire(7)
+    scheduler.acquire(8)
+
+    assert clock.sleeps == [0.5, 0.5]
+
+
+def test_long_rate_limit_wait_raises_retry_later(clock):
+    """Ожидание дольше max_wait не занимает поток, токен возвращается."""
+    scheduler = api_scheduler.ApiScheduler(rate=1, burst=1, max_wait=0.5)
+    scheduler.acquire(7)
+
+    with pytest.raises(api_scheduler.RetryLater) as error:
+        scheduler.acquire(7)
+    assert error.value.delay == pytest.approx(1)
+
+    clock.now += 1
+    scheduler.acquire(7)
+    assert clock.sleeps == []
+
+
+def test_retry_after_is_waited_before_the_retry(clock):
+    """429 с Retry-After повторяется через указанное время."""
+    scheduler = api_scheduler.ApiScheduler(max_wait=10)
+    client = make_client(scheduler, [
+        Response(429, {'Retry-After': '3'}), Response(200)
+    ])
+
+    response = send(client)
+
+    assert response.status_code == 200
+    assert clock.sleeps == [3]
+
+
+def test_retry_after_pauses_the_whole_account(clock):
+    """Пока действует Retry-After, ждут все запросы аккаунта, но не других."""
+    scheduler = api_scheduler.ApiScheduler(max_wait=10)
+
+    assert scheduler.retry_delay(7, 1, 429, 3) == 3
+    scheduler.acquire(8)
+    scheduler.acquire(7)
+
+    assert clock.sleeps == [3]
+
+
+def test_retry_after_http_date(clock, monkeypatch):
+    """Retry-After в виде даты переводится в секунды от текущего времени."""
+    monkeypatch.setattr(api_scheduler.time, 'time', lambda: 1700000000)
+    date = email.utils.formatdate(1700000005, usegmt=True)
+
+    assert api_scheduler.get_retry_after(Response(429, {
+        'Retry-After': date
+    })) == 5
+    assert api_scheduler.get_retry_after(Response(429)) is None
+
+
+def test_server_errors_back_off_then_raise_retry_later(clock):
+    """Ошибки 5xx повторяются с растущей задержкой до max_retries."""
+    scheduler = api_scheduler.ApiScheduler(max_retries=2, backoff=1,
+                                           max_wait=10)
+    client = make_client(scheduler, [Response(502)] * 3)
+
+    with pytest.raises(api_scheduler.RetryLater):
+        send(client)
+    assert clock.sleeps == [1, 2]
+
+
+def test_long_retry_after_resubmits_the_webhook(clock, monkeypatch):
+    """Retry-After дольше max_wait откладывает весь запуск отчета."""
+    scheduler = api_scheduler.ApiScheduler(max_wait=10)
+    client = make_client(scheduler, [Response(429, {'Retry-After': '30'})])
+    resubmitted = []
+    monkeypatch.setattr(
+        process_request, 'process_task',
+        lambda *args, client=None: send(client)
+    )
+    monkeypatch.setattr(
+        process_request, 'schedule_resubmit',
+        lambda delay, args: resubmitted.append((delay, args))
+    )
+    args = ({'task_id': 5}, 0, 'session')
+
+    process_request.process_thread(*args, client=client)
+
+    assert resubmitted == [(30, args)]
+    assert clock.sleeps == []
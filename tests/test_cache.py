@@ -0,0 +1,37 @@
+from pyrustools.client_plus import MyPyrus
+
+import cache
+
+import pytest
+
+
+def make_client(token: str, account=None, login=None) -> MyPyrus:
+    """Клиент с токеном, аккаунтом и логином."""
+    client = MyPyrus(login=login, access_token=token)
+    if account is not None:
+        client.account = account
+    return client
+
+
+def test_client_key_is_the_account_not_the_token():
+    """Ключ кэшей - аккаунт бота, токен на него не влияет."""
+    first = cache.get_client_key(make_client('token-1', account=7))
+    refreshed = cache.get_client_key(make_client('token-2', account=7))
+    other = cache.get_client_key(make_client('token-1', account=8))
+
+    assert first == refreshed
+    assert first != other
+    assert 'token-1' not in first
+
+
+def test_client_key_falls_back_to_login():
+    """Тестовый запуск без вебхука получает ключ по логину бота."""
+    key = cache.get_client_key(make_client('token', login='bot@example.com'))
+
+    assert key[1] == 'bot@example.com'
+
+
+def test_client_without_account_has_no_key():
+    """Клиент только с токеном не получает общий ключ."""
+    with pytest.raises(ValueError):
+        cache.get_client_key(make_client('token'))
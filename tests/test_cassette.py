@@ -0,0 +1,94 @@
+import json
+
+from benchmarks import synthetic
+from benchmarks.local_pyrus import LocalPyrus
+
+import cassette
+
+from configuration_bot import BotConfig
+
+from forms import report_form
+
+from pyrustools.client_plus import MyPyrus
+
+import pytest
+
+SOURCE_FORM_ID = 1001
+
+
+class LocalServer:
+    """API pyrus поверх данных LocalPyrus для записи кассеты."""
+
+    def __init__(self, report: dict):
+        self.local = LocalPyrus(
+            forms={
+                SOURCE_FORM_ID: synthetic.make_source_form(SOURCE_FORM_ID),
+                synthetic.REPORT_FORM_ID: report,
+            },
+            registries={
+                SOURCE_FORM_ID: synthetic.make_registry(SOURCE_FORM_ID, 30)
+            },
+            contacts=synthetic.make_contacts(),
+            catalogs={synthetic.CATALOG_ID: synthetic.make_catalog()}
+        )
+
+    def respond(self, client, url, method, body=None, *args) -> dict:
+        """Ответ на запрос клиента, как его разбирает MyPyrus."""
+        parts = cassette._request_parts(client, url, None)[0].split('/')
+        if parts[1] == 'forms' and len(parts) == 3:
+            return json.loads(self.local._forms[int(parts[2])])
+        if parts[1] == 'forms' and parts[3] == 'register':
+            return json.loads(self.local._registry_body(int(parts[2]), body))
+        if parts[1] == 'tasks' and parts[3] == 'comments':
+            return {'task': {'id': int(parts[2])}}
+        raise AssertionError(f'Неожиданный запрос {method.name} {url}')
+
+
+def make_config(tmp_path, name: str) -> BotConfig:
+    """Настройки без кэшей и со своей базой отпечатков."""
+    with open('bot_config.json', encoding='utf8') as config_file:
+        config = BotConfig(dict(
+            json.load(config_file), CACHE_TTL=0,
+            FINGERPRINT_STORE='sqlite',
+            FINGERPRINT_DB=str(tmp_path / f'{name}.db')
+        ))
+    report_form.configure_caches(config)
+    return config
+
+
+def run_report(client: MyPyrus, config: BotConfig, report: dict) -> None:
+    """Построение отчета клиентом."""
+    task = synthetic.make_report_task(
+        1, report, ((f'REPORT_{SOURCE_FORM_ID}', 'City', 'Москва'),)
+    )
+    client.update_task_field_info(task)
+    assert report_form.build_reports(client, config, task) == 'written'
+
+
+def test_replay_writes_the_recorded_comments(tmp_path, monkeypatch):
+    """Воспроизведение дает те же комментарии, незаписанный запрос - ошибка."""
+    report = synthetic.make_report_form([SOURCE_FORM_ID])
+    server = LocalServer(report)
+    monkeypatch.setattr(
+        MyPyrus, '_perform_request_with_retry',
+        lambda client, *args: server.respond(client, *args)
+    )
+    path = str(tmp_path / 'cassette.jsonl.gz')
+    recording = cassette.RecordingPyrus(
+        path, login='bot@example.com', access_token='token'
+    )
+    run_report(recording, make_config(tmp_path, 'record'), report)
+    recording.close()
+    with cassette.open_cassette(path) as cassette_file:
+        records = [json.loads(line) for line in cassette_file]
+    recorded = [(record['path'], record['body']) for record in records
+                if record['path'].endswith(cassette.WRITE_PATH_SUFFIXES)]
+
+    replay = cassette.ReplayPyrus(path)
+    run_report(replay, make_config(tmp_path, 'replay'), report)
+
+    (comment_path, comment_body), = recorded
+    assert json.loads(comment_body)['field_updates']
+    assert replay.comments == recorded
+    with pytest.raises(LookupError):
+        replay.get_form(SOURCE_FORM_ID + 1)
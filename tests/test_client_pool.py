@@ -0,0 +1,130 @@
+import threading
+
+import api_scheduler
+
+import client_pool
+
+TIMEOUT = 5
+
+
+class Response:
+    """Ответ requests с кодом и телом."""
+
+    def __init__(self, status_code: int, body: dict = None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.headers = {}
+
+    def json(self) -> dict:
+        """Тело ответа."""
+        return self.body
+
+    def close(self) -> None:
+        """Соединение возвращается в пул."""
+
+
+class Session:
+    """Сессия, которая выдает новый токен на каждый вход по логину."""
+
+    def __init__(self):
+        self.logins = []
+
+    def post(self, url, json=None, **kwargs) -> Response:
+        """Вход по логину."""
+        self.logins.append(json['login'])
+        token = f'token-{len(self.logins)}'
+        return Response(200, {'access_token': token})
+
+
+class WatchedLock:
+    """Блокировка, которая сообщает, что поток начал ее ждать."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = threading.Event()
+
+    def __enter__(self):
+        """Ожидание блокировки."""
+        self.waiting.set()
+        self.lock.acquire()
+
+    def __exit__(self, *args):
+        """Освобождение блокировки."""
+        self.lock.release()
+
+
+def make_pool() -> client_pool.ClientPool:
+    """Пул без ограничения частоты и без сети."""
+    pool = client_pool.ClientPool(api_scheduler.ApiScheduler(rate=1000))
+    pool.session = Session()
+    return pool
+
+
+def make_client(pool: client_pool.ClientPool,
+                account=None) -> client_pool.PooledPyrus:
+    """Клиент пула с логином бота."""
+    client = pool.get_client(account)
+    client.login = 'bot@example.com'
+    client.security_key = 'key'
+    return client
+
+
+def expired_then_ok(client: client_pool.PooledPyrus, seen: list):
+    """Запрос: 401 со старым токеном, 200 с новым."""
+    def perform():
+        seen.append(client.access_token)
+        if client.access_token == 'expired':
+            return Response(401)
+        return Response(200)
+    return perform
+
+
+def test_401_refreshes_the_pooled_token_once():
+    """После 401 токен обновляется и сразу виден другим клиентам пула."""
+    pool = make_pool()
+    client = make_client(pool)
+    client.access_token = 'expired'
+    seen = []
+
+    response = client.send(expired_then_ok(client, seen))
+
+    assert response.status_code == 200
+    assert seen == ['expired', 'token-1']
+    assert pool.session.logins == ['bot@example.com']
+    assert make_client(pool).access_token == 'token-1'
+
+
+def test_waiting_request_reuses_the_token_refreshed_by_another():
+    """Пока один поток обновляет токен, другой ждет и не входит заново."""
+    pool = make_pool()
+    client = make_client(pool)
+    client.access_token = 'expired'
+    seen = []
+    lock = WatchedLock()
+    pool.auth_lock = lambda key: lock
+    lock.lock.acquire()
+    thread = threading.Thread(
+        target=client.send, args=(expired_then_ok(client, seen),)
+    )
+    thread.start()
+    assert lock.waiting.wait(TIMEOUT)
+    # Другой поток получил новый токен и отпускает блокировку
+    pool.set_token(client.token_key, 'fresh')
+    lock.lock.release()
+    thread.join(TIMEOUT)
+
+    assert seen == ['expired', 'fresh']
+    assert pool.session.logins == []
+
+
+def test_bot_token_is_not_refreshed_by_login():
+    """Токен бота из вебхука обновляет только следующий вебхук."""
+    pool = make_pool()
+    client = pool.get_client(7)
+    client.access_token = 'expired'
+    seen = []
+
+    response = client.send(expired_then_ok(client, seen))
+
+    assert response.status_code == 401
+    assert pool.session.logins == []
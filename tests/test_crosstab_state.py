@@ -0,0 +1,229 @@
+import copy
+import json
+
+from benchmarks import synthetic
+from benchmarks.local_pyrus import LocalPyrus
+
+from configuration_bot import BotConfig
+
+import crosstab_state
+
+from forms import report_form, report_plan
+
+from pyrustools.objects_plus import FormResponsePlus, TaskWithCommentsPlus
+
+import pytest
+
+SOURCE_FORM_ID = 1001
+
+
+def make_config(tmp_path, **options) -> BotConfig:
+    """Настройки из bot_config.json без кэширования реестров."""
+    with open('bot_config.json', encoding='utf8') as config_file:
+        config = json.load(config_file)
+    config.update(
+        CACHE_TTL=0,
+        INCREMENTAL_DB=str(tmp_path / 'crosstab_state.db'),
+        **options
+    )
+    return BotConfig(config)
+
+
+def make_report(config: BotConfig, report: dict) -> report_plan.ReportPlan:
+    """План отчета по шаблону формы."""
+    report_form.configure_caches(config)
+    return report_plan.get_report_plan(FormResponsePlus(**report), config)
+
+
+def make_client(registry: dict) -> LocalPyrus:
+    """Локальный клиент с одной формой-источником."""
+    return LocalPyrus(
+        forms={SOURCE_FORM_ID: synthetic.make_source_form(SOURCE_FORM_ID)},
+        registries={SOURCE_FORM_ID: registry},
+        contacts=synthetic.make_contacts(),
+        catalogs={synthetic.CATALOG_ID: synthetic.make_catalog()}
+    )
+
+
+def build(plan, client, filters) -> tuple:
+    """Полный пересчет состояния по реестру клиента."""
+    sources = report_form.get_sources(plan, client, filters)
+    table_jobs = report_form.get_table_jobs(plan, sources, client, filters)
+    state, projections = crosstab_state.build_state(
+        table_jobs, sources,
+        report_form.get_needed_fields(plan, sources, filters)
+    )
+    return state, projections, [(job[0], job[1]) for job in table_jobs]
+
+
+def render(plan, state: dict) -> dict:
+    """Таблицы отчета вида {id таблицы: [[(id, значение)]]}."""
+    return {
+        table_id: [[(cell.id, cell.value) for cell in row.cells]
+                   for row in rows]
+        for table_id, rows in report_form.render_tables(plan, state).items()
+    }
+
+
+def make_task(task: dict) -> TaskWithCommentsPlus:
+    """Задача формы-источника, как она приходит в вебхуке."""
+    return TaskWithCommentsPlus(**copy.deepcopy(task))
+
+
+def set_field(task: dict, field: dict) -> None:
+    """Замена значения поля задачи реестра."""
+    task['fields'] = [f for f in task['fields'] if f['id'] != field['id']]
+    task['fields'].append(field)
+
+
+@pytest.fixture(params=[crosstab_state.BACKEND_MEMORY,
+                        crosstab_state.BACKEND_SQLITE])
+def store(request, tmp_path):
+    """Хранилище состояния каждого вида."""
+    config = make_config(tmp_path, INCREMENTAL_STORE=request.param)
+    return crosstab_state.get_store(config)
+
+
+def test_rebuild_keeps_changes_made_while_registries_load(tmp_path, store):
+    """Вебхук между загрузкой реестра и сохранением не теряется."""
+    registry = synthetic.make_registry(SOURCE_FORM_ID, 30)
+    client = make_client(registry)
+    plan = make_report(
+        make_config(tmp_path), synthetic.make_report_form([SOURCE_FORM_ID])
+    )
+    state, projections, jobs = build(plan, client, {})
+    since = store.replace(7, 'signature', state, projections)
+    # Пересчет загрузил реестр до изменения задачи
+    stale_state, stale_projections, _ = build(plan, client, {})
+
+    task = registry['tasks'][0]
+    set_field(task, {'id': synthetic.CITY_FIELD_ID, 'type': 'text',
+                     'value': 'Новгород'})
+    assert store.update(
+        7, task['id'], 'signature',
+        lambda state, old: crosstab_state.apply_task(
+            jobs, state, make_task(task), old
+        )
+    ) is not None
+    store.replace(
+        7, 'signature', stale_state, stale_projections, since,
+        lambda state, task_id, old, new: crosstab_state.move_task(
+            jobs, state, task_id, old, new
+        )
+    )
+
+    expected, _, _ = build(plan, client, {})
+    _, saved, _ = store.get(7)
+    assert render(plan, saved) == render(plan, expected)
+
+
+def test_webhook_task_with_empty_fields_matches_registry():
+    """Поле со значением None проецируется так же, как отсутствующее."""
+    registry = synthetic.make_registry(SOURCE_FORM_ID, 1)
+    task = registry['tasks'][0]
+    task['fields'] = [
+        field for field in task['fields']
+        if field['id'] not in (synthetic.PERSON_FIELD_ID,
+                               synthetic.CATALOG_FIELD_ID)
+    ]
+    webhook_task = copy.deepcopy(task)
+    webhook_task['fields'] += [
+        {'id': synthetic.PERSON_FIELD_ID, 'type': 'person'},
+        {'id': synthetic.CATALOG_FIELD_ID, 'type': 'catalog'},
+    ]
+    field_ids = [synthetic.PERSON_FIELD_ID, synthetic.CATALOG_FIELD_ID]
+    snapshot = crosstab_state.registry_snapshot.project_registry(
+        SOURCE_FORM_ID,
+        make_client(registry).get_registry(SOURCE_FORM_ID),
+        tuple(field_ids), tuple(field_ids)
+    )
+
+    projection = crosstab_state.project_task(
+        make_task(webhook_task), field_ids, field_ids
+    )
+    assert projection == crosstab_state.project_row(snapshot, 0)
+
+
+def test_new_group_keeps_rebuild_order(tmp_path):
+    """Новая группа встает туда же, куда ее поставит полный пересчет."""
+    registry = synthetic.make_registry(SOURCE_FORM_ID, 30)
+    client = make_client(registry)
+    plan = make_report(
+        make_config(tmp_path), synthetic.make_report_form([SOURCE_FORM_ID])
+    )
+    state, projections, jobs = build(plan, client, {})
+
+    task = registry['tasks'][0]
+    set_field(task, {
+        'id': synthetic.PERSON_FIELD_ID, 'type': 'person',
+        'value': {'id': 99, 'first_name': 'Имя', 'last_name': 'Фамилия99',
+                  'type': 'user'}
+    })
+    crosstab_state.apply_task(
+        jobs, state, make_task(task), projections[task['id']]
+    )
+
+    expected, _, _ = build(plan, client, {})
+    for table_id, table_state in expected['tables'].items():
+        groups = crosstab_state.get_groups(state['tables'][table_id])
+        assert groups == crosstab_state.get_groups(table_state)
+
+
+def make_unsorted_report() -> dict:
+    """Шаблон отчета без сортировок $SRT_."""
+    report = synthetic.make_report_form([SOURCE_FORM_ID])
+    for field in report['fields']:
+        for column in field['info']['columns']:
+            column['info']['code'] = column['info']['code'].split('$')[0]
+    return report
+
+
+@pytest.mark.parametrize('report', [
+    synthetic.make_report_form([SOURCE_FORM_ID]),
+    make_unsorted_report(),
+], ids=['sorted', 'unsorted'])
+def test_task_changes_match_full_rebuild(tmp_path, store, report):
+    """Цепочка изменений задач дает те же таблицы, что полный пересчет."""
+    registry = synthetic.make_registry(SOURCE_FORM_ID, 40)
+    client = make_client(registry)
+    plan = make_report(make_config(tmp_path), report)
+    filters = {f'REPORT_{SOURCE_FORM_ID}': [['City', 'Москва']]}
+    state, projections, jobs = build(plan, client, filters)
+    store.replace(7, 'signature', state, projections)
+    tasks = registry['tasks']
+    in_filter = next(task for task in tasks[5:] if any(
+        field['id'] == synthetic.CITY_FIELD_ID and field['value'] == 'Москва'
+        for field in task['fields']
+    ))
+    new_task = copy.deepcopy(tasks[1])
+    new_task['id'] = tasks[-1]['id'] + 1
+    tasks.append(new_task)
+    set_field(tasks[0], {
+        'id': synthetic.STATUS_FIELD_ID, 'type': 'multiple_choice',
+        'value': {'choice_ids': [1], 'choice_names': ['Статус 1']}
+    })
+    set_field(in_filter, {'id': synthetic.CITY_FIELD_ID, 'type': 'text',
+                          'value': 'Омск'})
+    empty = tasks[3]
+    empty['fields'] = [
+        field for field in empty['fields']
+        if field['id'] not in (synthetic.PERSON_FIELD_ID,
+                               synthetic.CATALOG_FIELD_ID)
+    ]
+    webhook_empty = copy.deepcopy(empty)
+    webhook_empty['fields'] += [
+        {'id': synthetic.PERSON_FIELD_ID, 'type': 'person'},
+        {'id': synthetic.CATALOG_FIELD_ID, 'type': 'catalog'},
+    ]
+
+    for task in (new_task, tasks[0], in_filter, webhook_empty):
+        store.update(
+            7, task['id'], 'signature',
+            lambda state, old, task=task: crosstab_state.apply_task(
+                jobs, state, make_task(task), old
+            )
+        )
+
+    expected, _, _ = build(plan, client, filters)
+    _, saved, _ = store.get(7)
+    assert render(plan, saved) == render(plan, expected)
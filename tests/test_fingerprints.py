@@ -0,0 +1,23 @@
+import fingerprints
+
+
+def test_memory_store_evicts_least_recently_used():
+    """Хранилище в памяти держит не больше maxsize отчетов."""
+    store = fingerprints.MemoryFingerprintStore(2, 60)
+    for key in (1, 2):
+        store.set(key, f'fingerprint-{key}', {})
+    assert store.get(1) == 'fingerprint-1'
+
+    store.set(3, 'fingerprint-3', {10: []})
+
+    assert store.get(2) is None
+    assert store.get(1) == 'fingerprint-1'
+    assert (store.get(3), store.get_result(3)) == ('fingerprint-3', {10: []})
+
+
+def test_memory_store_expires_old_fingerprints():
+    """Устаревший отпечаток не считается совпавшим."""
+    store = fingerprints.MemoryFingerprintStore(10, -1)
+    store.set(1, 'fingerprint', {})
+
+    assert store.get(1) is None
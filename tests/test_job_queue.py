@@ -0,0 +1,110 @@
+import job_queue
+
+import pytest
+
+
+class Clock:
+    """Время, которое двигает тест."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        """Текущее время."""
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Подмена времени очереди."""
+    clock = Clock()
+    monkeypatch.setattr(job_queue.time, 'time', clock)
+    return clock
+
+
+def make_queue(tmp_path, **options) -> job_queue.JobQueue:
+    """Очередь во временном файле."""
+    return job_queue.JobQueue(str(tmp_path / 'jobs.db'), **options)
+
+
+def test_expired_lease_is_delivered_again(tmp_path, clock):
+    """Задача с истекшей арендой снова выдается, старая аренда потеряна."""
+    jobs = make_queue(tmp_path)
+    jobs.enqueue({'task_id': 1})
+    first = jobs.lease(10)
+    assert jobs.lease(10) is None
+
+    clock.now += 11
+    second = jobs.lease(10)
+
+    assert (second.id, second.attempt) == (first.id, 2)
+    assert not jobs.extend(first, 10)
+    assert not jobs.complete(first)
+    assert jobs.complete(second)
+    assert jobs.stats()[job_queue.STATUS_QUEUED] == 0
+
+
+def test_failed_job_backs_off_then_dead_letters(tmp_path, clock):
+    """Ошибка повторяется с задержкой, после max_attempts задача failed."""
+    jobs = make_queue(tmp_path, max_attempts=2, backoff=4)
+    jobs.enqueue({'task_id': 1})
+
+    assert jobs.fail(jobs.lease(10), 'error')
+    assert jobs.lease(10) is None
+    clock.now += 4
+    job = jobs.lease(10)
+    assert job.attempt == 2
+    assert not jobs.fail(job, 'error')
+
+    clock.now += 1000
+    assert jobs.lease(10) is None
+    assert jobs.stats()[job_queue.STATUS_FAILED] == 1
+
+
+def test_backoff_grows_up_to_limit(tmp_path):
+    """Задержка удваивается, с разбросом в половину, не больше предела."""
+    jobs = make_queue(tmp_path, backoff=5, max_backoff=30)
+
+    assert 2.5 <= jobs.get_backoff(1) <= 5
+    assert 10 <= jobs.get_backoff(3) <= 20
+    assert 15 <= jobs.get_backoff(10) <= 30
+
+
+def test_deferred_job_keeps_its_attempt(tmp_path, clock):
+    """Отложенная задача выдается после задержки без учета попытки."""
+    jobs = make_queue(tmp_path, max_attempts=1)
+    jobs.enqueue({'task_id': 1})
+
+    jobs.defer(jobs.lease(10), 30)
+    clock.now += 29
+    assert jobs.lease(10) is None
+    clock.now += 1
+    job = jobs.lease(10)
+
+    assert job.attempt == 1
+    assert jobs.complete(job)
+
+
+def test_pending_jobs_with_one_key_are_merged(tmp_path, clock):
+    """Ожидающая задача получает свежие данные, задачи ключа не параллельны."""
+    jobs = make_queue(tmp_path)
+    jobs.enqueue({'retry': 1}, key='5')
+    jobs.enqueue({'retry': 2}, key='5')
+    assert jobs.stats()[job_queue.STATUS_QUEUED] == 1
+
+    running = jobs.lease(10)
+    jobs.enqueue({'retry': 3}, key='5')
+    assert running.payload == {'retry': 2}
+    assert jobs.lease(10) is None
+
+    assert jobs.complete(running)
+    assert jobs.lease(10).payload == {'retry': 3}
+
+
+def test_full_queue_rejects_jobs(tmp_path, clock):
+    """Заполненная очередь не принимает новые задачи."""
+    jobs = make_queue(tmp_path, max_size=1)
+
+    assert jobs.enqueue({'task_id': 1}, key='1')
+    assert not jobs.enqueue({'task_id': 2}, key='2')
+    assert jobs.enqueue({'task_id': 1}, key='1')
@@ -0,0 +1,89 @@
+import json
+import os
+from types import SimpleNamespace
+
+import metrics
+
+import pytest
+
+# Такого процесса нет: pid больше предела pid в linux
+DEAD_PID = 4194305
+
+
+@pytest.fixture
+def directory(monkeypatch, tmp_path):
+    """Общая папка метрик во временной папке, источники не сохраняются."""
+    monkeypatch.setattr(metrics, '_directory', str(tmp_path))
+    monkeypatch.setattr(metrics, '_collectors', list(metrics._collectors))
+    return tmp_path
+
+
+def get_line(prefix: str) -> str:
+    """Строка метрики из /diagnostics/metrics."""
+    return next(
+        (line for line in metrics.render().splitlines()
+         if line.startswith(prefix)),
+        None
+    )
+
+
+def get_calls(method: str, status: str) -> str:
+    """Строка счетчика обращений к API из /diagnostics/metrics."""
+    return get_line(f'pyrus_api_calls_total{{method="{method}",'
+                    f'status="{status}"}} ')
+
+
+def test_call_api_counts_error_body_as_error(monkeypatch):
+    """Ответ pyrus с ошибкой в теле считается ошибкой, а не ok."""
+    monkeypatch.setattr(metrics, '_directory', None)
+
+    def get_form(form_id):
+        return SimpleNamespace(error='access_denied')
+
+    metrics.call_api('test_get_form', get_form, 1)
+    metrics.call_api('test_get_form', lambda: SimpleNamespace(error=None))
+
+    assert get_calls('test_get_form', 'error').endswith(' 1')
+    assert get_calls('test_get_form', 'ok').endswith(' 1')
+
+
+def test_render_sums_metrics_of_all_processes(directory):
+    """Счетчики и гистограммы процессов складываются, gauge - по живым."""
+    metrics.inc('test_merged_total', method='a')
+    metrics.observe('test_merged_seconds', 0.2, (0.1, 1))
+    metrics.add_collector(lambda: [('test_merged_queue', {}, 3)])
+    # Снимок этого процесса под чужими pid: живого и завершившегося
+    metrics.flush()
+    snapshot = (directory / f'{os.getpid()}.json').read_text('utf8')
+    (directory / f'{os.getppid()}.json').write_text(snapshot, 'utf8')
+    (directory / f'{DEAD_PID}.json').write_text(snapshot, 'utf8')
+    os.remove(directory / f'{os.getpid()}.json')
+
+    assert get_line('test_merged_total{method="a"} ').endswith(' 3')
+    assert get_line('test_merged_seconds_bucket{le="0.1"} ').endswith(' 0')
+    assert get_line('test_merged_seconds_bucket{le="1"} ').endswith(' 3')
+    assert get_line('test_merged_seconds_count ').endswith(' 3')
+    queues = [line for line in metrics.render().splitlines()
+              if line.startswith('test_merged_queue')]
+    assert sorted(queues) == sorted(
+        f'test_merged_queue{{pid="{pid}"}} 3'
+        for pid in (os.getpid(), os.getppid())
+    )
+
+
+def test_broken_snapshot_is_skipped(directory):
+    """Поврежденный файл процесса не ломает ответ."""
+    metrics.inc('test_broken_total')
+    (directory / f'{DEAD_PID}.json').write_text('{', 'utf8')
+    (directory / 'notes.txt').write_text('', 'utf8')
+
+    assert get_line('test_broken_total ').endswith(' 1')
+
+
+def test_clear_directory_removes_old_snapshots(directory):
+    """При старте gunicorn файлы прошлого запуска удаляются."""
+    (directory / f'{DEAD_PID}.json').write_text(json.dumps({}), 'utf8')
+
+    metrics.clear_directory(str(directory))
+
+    assert not (directory / f'{DEAD_PID}.json').exists()
@@ -0,0 +1,111 @@
+import json
+from types import SimpleNamespace
+
+import metrics
+
+import process_request
+
+import pytest
+
+
+def test_deferred_run_dropped_when_queue_stays_full(monkeypatch):
+    """Отложенный запуск при полной очереди повторяется, потом учитывается."""
+    scheduled = []
+    # Только метрики этого процесса, без файлов других запусков
+    monkeypatch.setattr(metrics, '_directory', None)
+    monkeypatch.setattr(process_request, 'submit_webhook', lambda *a: False)
+    monkeypatch.setattr(
+        process_request, 'schedule_resubmit',
+        lambda delay, args, attempt=1: scheduled.append((delay, attempt))
+    )
+    attempts = process_request.pool_config.job_max_attempts
+    args = ({'task_id': 1}, 0, 'session')
+
+    for attempt in range(1, attempts + 1):
+        process_request.resubmit(args, attempt)
+
+    assert [item[1] for item in scheduled] == list(range(2, attempts + 1))
+    assert 'report_deferred_total{result="dropped"} 1' in metrics.render()
+
+
+class FakeClient:
+    """Клиент, который входит по логину из файла и отдает задачу."""
+
+    login = None
+    access_token = None
+
+    def read_login_info(self, filename):
+        """Вход по логину из файла."""
+        self.login = filename
+        self.access_token = 'fresh-token'
+
+    def get_host(self, settings):
+        """Хост из настроек бота."""
+        self.host = settings.get('HOST')
+
+    def get_task(self, task_id):
+        """Текущая задача."""
+        task = {'id': task_id, 'form_id': 1}
+        return SimpleNamespace(task=task, original_response={'task': task})
+
+
+def test_job_queue_payload_has_no_token(monkeypatch):
+    """В очередь не попадают токен и задача, задача берется заново."""
+    body = {
+        'task_id': 5, 'user_id': 7, 'access_token': 'webhook-token',
+        'task': {'id': 5, 'form_id': 1}, 'bot_settings': '{"HOST": "h"}'
+    }
+    payload = process_request.get_job_payload(body, 2, 'session')
+    calls = []
+    monkeypatch.setattr(
+        process_request, 'process_task',
+        lambda *args, client=None: calls.append(args)
+    )
+    client = FakeClient()
+
+    process_request.process_job(json.loads(json.dumps(payload)), client)
+
+    assert 'webhook-token' not in json.dumps(payload)
+    assert 'task' not in payload
+    (body, retry, session_id), = calls
+    assert body['access_token'] == 'fresh-token'
+    assert body['task'] == {'id': 5, 'form_id': 1}
+    assert (retry, session_id, client.host) == (2, 'session', 'h')
+
+
+class StopRun(Exception):
+    """Остановка запуска отчета после входа клиента."""
+
+
+class WebhookClient(FakeClient):
+    """Клиент, переданный в запуск по вебхуку."""
+
+    account = None
+
+    def initialize_from_token(self, token):
+        """Вход по токену из вебхука."""
+        self.access_token = token
+
+    def update_task_field_info(self, task):
+        """Дальше отчет не строится."""
+        raise StopRun
+
+
+def test_webhook_account_is_set_on_a_given_client(monkeypatch):
+    """Переданный клиент получает аккаунт пользователя бота из вебхука."""
+    # Логирование бота заменяет обработчики корневого логгера
+    monkeypatch.setattr(
+        process_request.pyrustools.bot.Bot, '_console_logging_init',
+        lambda self: None
+    )
+    body = {
+        'task_id': 5, 'user_id': 7, 'access_token': 'webhook-token',
+        'task': {'id': 5, 'form_id': 1},
+        'bot_settings': '{"HOST": "h", "BOT_NAME": "Bot"}'
+    }
+    client = WebhookClient()
+
+    with pytest.raises(StopRun):
+        process_request.process_task(body, 0, 'session', client=client)
+
+    assert client.account == 7
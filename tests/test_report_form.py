@@ -0,0 +1,232 @@
+import json
+
+from benchmarks import synthetic
+from benchmarks.local_pyrus import LocalPyrus
+
+from configuration_bot import BotConfig
+
+from forms import report_form
+
+import pytest
+
+import utils
+
+SOURCE_FORM_ID = 1001
+TABLE_ID = 20000
+# Колонка с юкодом, которого нет в форме-источнике
+MISSING_COLUMN_ID = TABLE_ID + 99
+
+
+def make_client(report: dict, registry: dict = None) -> LocalPyrus:
+    """Локальный клиент с одной формой-источником."""
+    if registry is None:
+        registry = synthetic.make_registry(SOURCE_FORM_ID, 50)
+    return LocalPyrus(
+        forms={
+            SOURCE_FORM_ID: synthetic.make_source_form(SOURCE_FORM_ID),
+            synthetic.REPORT_FORM_ID: report,
+        },
+        registries={SOURCE_FORM_ID: registry},
+        contacts=synthetic.make_contacts(),
+        catalogs={synthetic.CATALOG_ID: synthetic.make_catalog()}
+    )
+
+
+def make_config(tmp_path, **options) -> BotConfig:
+    """Настройки из bot_config.json с базами во временной папке."""
+    with open('bot_config.json', encoding='utf8') as config_file:
+        config = json.load(config_file)
+    config.update(
+        CACHE_TTL=0,
+        INCREMENTAL_DB=str(tmp_path / 'crosstab_state.db'),
+        FINGERPRINT_DB=str(tmp_path / 'fingerprints.db'),
+        **options
+    )
+    return BotConfig(config)
+
+
+def get_tables(comment: dict) -> dict:
+    """Значения таблиц из комментария вида {id таблицы: [[(id, значение)]]}."""
+    return {
+        field.id: [
+            [(cell.id, cell.value) for cell in row.cells]
+            for row in field.value
+        ]
+        for field in comment['field_updates']
+    }
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'REGISTRY_STREAMING': True},
+    {'INCREMENTAL_REPORTS': True, 'INCREMENTAL_STORE': 'sqlite'},
+    {'REGISTRY_SERVER_FILTERS': False},
+])
+def test_column_code_missing_on_source_form(tmp_path, options):
+    """Колонка с юкодом, которого нет в форме-источнике, не ломает отчет."""
+    report = synthetic.make_report_form([SOURCE_FORM_ID])
+    table = next(f for f in report['fields'] if f['id'] == TABLE_ID)
+    table['info']['columns'].append({
+        'id': MISSING_COLUMN_ID, 'type': 'number', 'name': 'Нет поля',
+        'info': {'code': 'NoSuchCode'}
+    })
+    client = make_client(report)
+    task = synthetic.make_report_task(1, report)
+    client.update_task_field_info(task)
+
+    result = report_form.build_reports(
+        client, make_config(tmp_path, **options), task
+    )
+
+    assert result in ('written', 'rebuilt')
+    (task_id, comment), = client.comments
+    tables = {field.id: field.value for field in comment['field_updates']}
+    rows = tables[TABLE_ID]
+    assert rows
+    for row in rows:
+        cells = {cell.id: cell.value for cell in row.cells}
+        assert cells[MISSING_COLUMN_ID] == 0
+
+
+def test_fingerprint_kept_only_after_successful_write(tmp_path):
+    """Ошибка записи не дает следующему запуску пропустить отчет."""
+    report = synthetic.make_report_form([SOURCE_FORM_ID])
+    client = make_client(report)
+    task = synthetic.make_report_task(2, report)
+    client.update_task_field_info(task)
+    config = make_config(tmp_path)
+    write = client.comment_task_plus
+    client.comment_task_plus = lambda task_id, **kwargs: None
+
+    with pytest.raises(utils.TableWriteError):
+        report_form.build_reports(client, config, task)
+
+    client.comment_task_plus = write
+    assert report_form.build_reports(client, config, task) == 'written'
+
+
+def test_unchanged_report_is_not_written(tmp_path):
+    """Отчет с прежними данными и таблицами не пересчитывается и не пишется."""
+    report = synthetic.make_report_form([SOURCE_FORM_ID])
+    client = make_client(report)
+    task = synthetic.make_report_task(5, report)
+    client.update_task_field_info(task)
+    config = make_config(tmp_path)
+    assert report_form.build_reports(client, config, task) == 'written'
+    # В задаче теперь записанные таблицы
+    fields = {field.id: field for field in task.flat_fields_static}
+    for field in client.comments[-1][1]['field_updates']:
+        fields[field.id].value = field.value
+    calls = len(client.calls)
+
+    assert report_form.build_reports(client, config, task) == 'unchanged'
+    assert len(client.comments) == 1
+    assert 'comment_task' not in client.calls[calls:]
+
+
+def test_unchanged_report_restores_stored_tables(tmp_path):
+    """Таблицы, расходящиеся с сохраненным результатом, восстанавливаются."""
+    report = synthetic.make_report_form([SOURCE_FORM_ID])
+    client = make_client(report)
+    task = synthetic.make_report_task(3, report)
+    client.update_task_field_info(task)
+    config = make_config(tmp_path)
+    assert report_form.build_reports(client, config, task) == 'written'
+    written = get_tables(client.comments[-1][1])
+
+    # В задаче по-прежнему пустые таблицы, как будто запись потерялась
+    assert report_form.build_reports(client, config, task) == 'restored'
+    assert get_tables(client.comments[-1][1]) == written
+
+
+def make_status(choice_id: int) -> dict:
+    """Значение поля статуса задачи реестра."""
+    return {
+        'id': synthetic.STATUS_FIELD_ID, 'type': 'multiple_choice',
+        'value': {'choice_id': choice_id, 'choice_ids': [choice_id],
+                  'choice_names': [f'Статус {choice_id}']}
+    }
+
+
+def make_person(person: int = None) -> dict:
+    """Значение поля исполнителя, без person поле пустое."""
+    field = {'id': synthetic.PERSON_FIELD_ID, 'type': 'person'}
+    if person is not None:
+        field['value'] = {'id': person, 'first_name': 'Имя',
+                          'last_name': f'Фамилия{person}', 'type': 'user'}
+    return field
+
+
+def make_city(city: str) -> dict:
+    """Значение поля города."""
+    return {'id': synthetic.CITY_FIELD_ID, 'type': 'text', 'value': city}
+
+
+def make_small_table(table_id: int, code: str, first_code: str,
+                     counted_columns: list) -> dict:
+    """Таблица отчета с колонками группы, итога, реестра и подсчета."""
+    columns = [('Группа', 'text', first_code), ('Итого', 'number', 'total'),
+               ('Реестр', 'text', 'registry')]
+    columns += [(name, 'number', code) for name, code in counted_columns]
+    return {
+        'id': table_id, 'type': 'table', 'name': code,
+        'info': {'code': code, 'columns': [
+            {'id': table_id + 1 + n, 'type': kind, 'name': name,
+             'info': {'code': column_code}}
+            for n, (name, kind, column_code) in enumerate(columns)
+        ]}
+    }
+
+
+def test_small_report_matches_hand_counted_rows(tmp_path):
+    """Таблицы маленького отчета совпадают с посчитанными вручную."""
+    tasks = [
+        [make_status(1), make_person(1), make_city('Москва')],
+        [make_status(2), make_person(), make_city('Москва')],
+        [make_status(1), make_person(2), make_city('Омск'),
+         {'id': synthetic.CHECKMARK_FIELD_ID, 'type': 'checkmark',
+          'value': 'checked'}],
+        [make_status(1), make_person(1), make_city('Москва')],
+    ]
+    report = synthetic.make_report_form([SOURCE_FORM_ID])
+    report['fields'] = [
+        make_small_table(TABLE_ID, f'REPORT_{SOURCE_FORM_ID}', 'Status', [
+            ('Москва', 'City'), ('Омск', 'City'),
+            ('Имя Фамилия1', 'Resp'), ('checked', 'Chk'),
+        ]),
+        make_small_table(
+            TABLE_ID + 10000, f'REPORT_{SOURCE_FORM_ID}_people', 'Resp',
+            [('Статус 1', 'Status'), ('Статус 2', 'Status')]
+        ),
+        report['fields'][-1],
+    ]
+    client = make_client(report, {'tasks': [
+        {'id': 100 + n, 'form_id': SOURCE_FORM_ID, 'fields': fields}
+        for n, fields in enumerate(tasks)
+    ]})
+    task = synthetic.make_report_task(
+        4, report, ((f'REPORT_{SOURCE_FORM_ID}_people', 'City', 'Москва'),)
+    )
+    client.update_task_field_info(task)
+
+    assert report_form.build_reports(
+        client, make_config(tmp_path), task
+    ) == 'written'
+
+    link = f'https://pyrus.com/t#rg{SOURCE_FORM_ID}?ao=true&tz=180&sm=0'
+    moscow = 'str3=%D0%9C%D0%BE%D1%81%D0%BA%D0%B2%D0%B0'
+    status_rows = [
+        ['Статус 1', 3, f'{link}&mch1=1', 2, 1, 2, 1],
+        ['Статус 2', 1, f'{link}&mch1=2', 1, 0, 0, 0],
+        ['Всего', 4, link, 3, 1, 2, 1],
+    ]
+    people_rows = [
+        ['Имя Фамилия1', 2, f'{link}&cid2=1&{moscow}', 2, 0],
+        ['Нет значения', 1, f'{link}&cid2=-1&{moscow}', 0, 1],
+        ['Всего', 3, f'{link}&{moscow}', 2, 1],
+    ]
+    tables = get_tables(client.comments[-1][1])
+    assert {
+        table_id: [[value for _, value in row] for row in rows]
+        for table_id, rows in tables.items()
+    } == {TABLE_ID: status_rows, TABLE_ID + 10000: people_rows}
@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+
+from benchmarks.local_pyrus import LocalPyrus
+
+from pyrustools.objects_plus import TaskWithCommentsPlus
+
+import utils
+
+TABLE_ID = 10
+
+
+def make_field(field_id: int, code: str) -> SimpleNamespace:
+    """Поле шаблона формы с юкодом."""
+    return SimpleNamespace(id=field_id, info=SimpleNamespace(code=code))
+
+
+def test_index_by_code_duplicate_codes():
+    """Повторяющийся юкод: последнее поле, как get_id_by_code, или первое."""
+    fields = [make_field(1, 'Code'), make_field(2, 'Other'),
+              make_field(3, 'Code'), SimpleNamespace(id=4, info=None)]
+
+    assert utils.index_by_code(fields)['Code'].id == 3
+    assert utils.index_by_code(fields, first=True)['Code'].id == 1
+    assert set(utils.index_by_code(fields)) == {'Code', 'Other'}
+
+
+def make_table_task(rows: list) -> TaskWithCommentsPlus:
+    """Задача с таблицей, уже заполненной строками rows."""
+    return TaskWithCommentsPlus(id=1, form_id=2, comments=[], fields=[{
+        'id': TABLE_ID, 'type': 'table',
+        'value': [
+            {'row_id': row_id, 'cells': [
+                {'id': cell_id, 'type': 'text', 'value': value}
+                for cell_id, value in row.items()
+            ]}
+            for row_id, row in enumerate(rows)
+        ]
+    }])
+
+
+def get_changes(rows: list) -> list:
+    """Изменения вида [(row_id, удаление, [(id ячейки, значение)])]."""
+    return [
+        (row.row_id, bool(getattr(row, 'delete', False)),
+         [(cell.id, cell.value) for cell in getattr(row, 'cells', None) or []])
+        for row in rows
+    ]
+
+
+def make_client() -> LocalPyrus:
+    """Клиент, который запоминает комментарии."""
+    return LocalPyrus(forms={}, registries={}, contacts={}, catalogs={})
+
+
+OLD_ROWS = [{11: 'a', 12: '1'}, {11: 'b', 12: '2'}, {11: 'c', 12: '3'}]
+
+
+def test_table_changes_hold_only_changed_rows_and_cells():
+    """В изменения попадают новые строки, измененные ячейки и удаления."""
+    task = make_table_task(OLD_ROWS)
+    new_rows = [{11: 'a', 12: '1'}, {11: 'b', 12: '5'}]
+
+    changes = utils.get_table_changes(
+        task.flat_fields_static[0].value, utils.get_rows(new_rows)
+    )
+    assert get_changes(changes) == [(1, False, [(12, '5')]), (2, True, [])]
+
+    new_rows.append({11: 'c', 12: '3'})
+    new_rows.append({11: 'd', 12: '4'})
+    changes = utils.get_table_changes(
+        task.flat_fields_static[0].value, utils.get_rows(new_rows)
+    )
+    expected = [(1, False, [(12, '5')]), (3, False, [(11, 'd'), (12, '4')])]
+    assert get_changes(changes) == expected
+
+
+def test_comment_table_changes_sends_only_the_diff():
+    """Отправляется один комментарий с изменениями, без них - ни одного."""
+    client = make_client()
+    task = make_table_task(OLD_ROWS)
+
+    assert not utils.comment_table_changes(
+        client, {TABLE_ID: utils.get_rows(OLD_ROWS)}, task
+    )
+    assert client.comments == []
+
+    new_rows = [dict(row) for row in OLD_ROWS]
+    new_rows[0][12] = '7'
+    assert utils.comment_table_changes(
+        client, {TABLE_ID: utils.get_rows(new_rows)}, task
+    )
+    (task_id, comment), = client.comments
+    (field,) = comment['field_updates']
+    assert (task_id, field.id) == (1, TABLE_ID)
+    assert get_changes(field.value) == [(0, False, [(12, '7')])]
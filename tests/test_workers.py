@@ -0,0 +1,206 @@
+import threading
+import time
+
+import pytest
+
+import workers
+
+TIMEOUT = 5
+
+
+class Blocker:
+    """Задача, которая выполняется, пока тест ее не отпустит."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, *args) -> None:
+        """Выполнение до release."""
+        self.started.set()
+        assert self.release.wait(TIMEOUT)
+
+
+def noop(*args) -> None:
+    """Задача, которая ничего не делает."""
+
+
+def wait_for(condition) -> None:
+    """Ожидание условия, которое выполнит другой поток."""
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def blocker():
+    """Занятый обработчик, отпускается в конце теста."""
+    blocker = Blocker()
+    yield blocker
+    blocker.release.set()
+
+
+def make_busy_pool(blocker, policy, put_timeout=1) -> workers.WorkerPool:
+    """Пул из одного обработчика, занятого blocker, с полной очередью."""
+    pool = workers.WorkerPool(1, 1, policy, put_timeout)
+    pool.submit(blocker)
+    assert blocker.started.wait(TIMEOUT)
+    return pool
+
+
+def test_reject_policy(blocker):
+    """При полной очереди задача отклоняется."""
+    done = []
+    pool = make_busy_pool(blocker, workers.POLICY_REJECT)
+    assert pool.submit(done.append, 1)
+
+    assert not pool.submit(done.append, 2)
+    blocker.release.set()
+    pool.join()
+
+    assert done == [1]
+    assert pool.stats()['rejected'] == 1
+
+
+def test_block_policy_waits_for_a_free_slot(blocker):
+    """Постановка ждет свободное место до put_timeout."""
+    done = []
+    pool = make_busy_pool(blocker, workers.POLICY_BLOCK, TIMEOUT)
+    assert pool.submit(done.append, 1)
+
+    threading.Timer(0.05, blocker.release.set).start()
+    assert pool.submit(done.append, 2)
+    pool.join()
+
+    assert done == [1, 2]
+
+
+def test_drop_oldest_policy(blocker):
+    """Новая задача вытесняет самую старую из очереди."""
+    done = []
+    pool = make_busy_pool(blocker, workers.POLICY_DROP_OLDEST)
+    assert pool.submit(done.append, 1, key=1)
+
+    assert pool.submit(done.append, 2, key=2)
+    blocker.release.set()
+    pool.join()
+
+    assert done == [2]
+    assert pool.stats()['dropped'] == 1
+
+
+def test_coalesced_webhook_is_not_accepted_for_a_failed_put(blocker):
+    """Пока задача ставится в очередь, тот же ключ не объединяется с ней."""
+    pool = make_busy_pool(blocker, workers.POLICY_BLOCK, 0.2)
+    assert pool.submit(noop, key=0)
+    results = {}
+
+    def submit(name):
+        results[name] = pool.submit(noop, name, key=1)
+
+    first = threading.Thread(target=submit, args=('first',))
+    first.start()
+    wait_for(lambda: 1 in pool._keys)
+    second = threading.Thread(target=submit, args=('second',))
+    second.start()
+    first.join()
+    second.join()
+
+    assert results == {'first': False, 'second': False}
+    assert 1 not in pool._keys
+
+
+def test_webhooks_coalesce_while_queued(blocker):
+    """Пока задача ждет в очереди, события заменяют ее аргументы."""
+    done = []
+    pool = make_busy_pool(blocker, workers.POLICY_REJECT)
+
+    for args in (1, 2, 3):
+        assert pool.submit(done.append, args, key=5)
+    blocker.release.set()
+    pool.join()
+
+    assert done == [3]
+    assert pool.stats()['coalesced'] == 2
+
+
+def test_exactly_one_follow_up_while_running():
+    """Пока задача выполняется, после нее запускается один повтор."""
+    runs = []
+    first = Blocker()
+
+    def run(args):
+        runs.append(args)
+        if args == 1:
+            first(args)
+
+    pool = workers.WorkerPool(2, 10)
+    assert pool.submit(run, 1, key=5)
+    assert first.started.wait(TIMEOUT)
+    for args in (2, 3, 4):
+        assert pool.submit(run, args, key=5)
+    first.release.set()
+    pool.join()
+
+    assert runs == [1, 4]
+
+
+def test_follow_up_waits_for_a_free_slot(blocker):
+    """Повтор при полной очереди не теряется, а ждет места."""
+    runs = []
+    first = Blocker()
+
+    def run(args):
+        runs.append(args)
+        if args == 1:
+            first(args)
+
+    pool = workers.WorkerPool(1, 1, workers.POLICY_REJECT)
+    assert pool.submit(run, 1, key=5)
+    assert first.started.wait(TIMEOUT)
+    assert pool.submit(run, 2, key=5)
+    assert pool.submit(blocker)
+    first.release.set()
+    assert blocker.started.wait(TIMEOUT)
+    blocker.release.set()
+    pool.join()
+
+    assert runs == [1, 2]
+    assert pool.stats()['rejected'] == 0
+
+
+def test_process_coalescer_runs_latest_args_once(tmp_path):
+    """Пока ключ занят, запуски отдают аргументы владельцу и не ждут."""
+    coalescer = workers.ProcessCoalescer(str(tmp_path))
+    runs = []
+    first = Blocker()
+
+    def run(args):
+        runs.append(args)
+        if args == 1:
+            first(args)
+
+    owner = threading.Thread(target=coalescer.run, args=(5, run, 1))
+    owner.start()
+    assert first.started.wait(TIMEOUT)
+    for args in (2, 3):
+        coalescer.run(5, run, args)
+    assert runs == [1]
+    first.release.set()
+    owner.join(TIMEOUT)
+
+    assert runs == [1, 3]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_process_coalescer_runs_each_sequential_call(tmp_path):
+    """Запуски по очереди выполняются каждый."""
+    coalescer = workers.ProcessCoalescer(str(tmp_path))
+    runs = []
+
+    for args in (1, 2):
+        coalescer.run(5, runs.append, args)
+
+    assert runs == [1, 2]
+    assert list(tmp_path.iterdir()) == []
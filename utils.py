@@ -1,12 +1,16 @@
 import logging
 import urllib.parse
+from types import SimpleNamespace
 from typing import Any
 
+import cache
+
+import metrics
+
 from pyrus.models import entities as ent
 from pyrus.models import responses as resp
 
 from pyrustools.client_plus import MyPyrus
-from pyrustools.object_methods import object_by_id
 from pyrustools.objects_plus import TaskWithCommentsPlus, set_value_to_field
 
 logging.basicConfig(level=logging.DEBUG)
@@ -14,6 +18,10 @@ logging.getLogger('urllib3').propagate = False
 logger = logging.getLogger(__name__)
 
 
+class TableWriteError(Exception):
+    """Pyrus не принял комментарий с таблицами."""
+
+
 def get_form_id_from_code(code: str) -> int:
     """
 
@@ -139,12 +147,10 @@ def prepare_registry_from_form(
             logger.debug(msg)
             return key_reg, val_reg
     if field.type == 'person':
-        # Для типа контакт получаем все контакты организации
-        # и ищем в ролях и в людях
-        all_members = client.get_contacts()
-        organizations = getattr(all_members, 'organizations', [])
-        role = unit_from_organization(organizations, 'roles', value)
-        person = unit_from_organization(organizations, 'persons', value)
+        # Для типа контакт ищем в индексе ролей и людей организации
+        contacts = get_contacts_index(client)
+        role = contacts.roles.get(value, -1)
+        person = contacts.persons.get(value, -1)
         if role == -1 and person == -1:
             msg = f'Не найдено совпадений по контактам со значением {value}'
             logger.debug(msg)
@@ -155,16 +161,18 @@ def prepare_registry_from_form(
             val_reg = person
         key_reg = 'cid'
     if field.type == 'catalog':
-        # Для каталога получаем каталог и ищем по позиции
+        # Для каталога ищем в индексе каталога по позиции
         # (по умолчанию 0, но может быть добавлена через запятую)
         catalog_id = getattr(field.info, 'catalog_id', 0)
-        catalog = client.get_catalog(catalog_id)
+        catalog = get_catalog_index(client, catalog_id)
         lst_value = value.split(',')
         [item.strip() for item in lst_value]
         if len(lst_value) == 1:
             lst_value.append('0')
         compare_value, pos = lst_value
-        catalog_item_id = get_catalog_item(catalog, compare_value, pos)
+        catalog_item_id = -1
+        if pos.isdigit():
+            catalog_item_id = catalog.items.get((int(pos), compare_value), -1)
         if catalog_item_id == -1:
             msg = f'Не найдено совпадений ' \
                   f'по каталогу {catalog_id} значения {value}'
@@ -183,77 +191,167 @@ def prepare_registry_from_form(
     return f'{key_reg}{field.id}', val_reg
 
 
-def get_catalog_item(
-        catalog: resp.CatalogResponse,
-        compare_value: str,
-        pos: str
-) -> int:
+def prepare_register_filter(field: ent.FormField, value: str) -> Any:
+    """
+
+    Значение фильтра запроса реестра pyrus для поля и искомого значения.
+
+    Сервер должен вернуть все задачи, которые пройдут локальный фильтр
+    (сравнение utils.prepare_value со значением), поэтому фильтр
+    формируется только для однозначных случаев: отметка и вариант выбора
+    с уникальным названием. Для остальных типов фильтрация остается
+    локальной.
+
+    :param field: поле из шаблона формы
+    :param value: строковое значение
+    :return: значение фильтра или None, если сервер так фильтровать не умеет
+    """
+    if field.type == 'checkmark' and value in ('checked', 'unchecked'):
+        return value
+    if field.type == 'multiple_choice':
+        options_choice = getattr(field.info, 'options', None) or []
+        my_options = [
+            option.choice_id for option in options_choice
+            if option.choice_value == value
+        ]
+        if len(my_options) == 1:
+            return my_options[0]
+    return None
+
+
+def get_contacts_index(client: MyPyrus) -> SimpleNamespace:
     """
 
-    Поиск в справочнике элемента по позиции и значению.
+    Индекс контактов организации через общий кэш.
+
+    :param client: сущность клиента пайрус
+    :return: индекс с атрибутами persons {имя и фамилия: id контакта}
+     и roles {название роли: id роли}
+    """
+    return cache.contacts.get_or_load(
+        cache.get_client_key(client),
+        lambda: index_contacts(
+            metrics.call_api('get_contacts', client.get_contacts)
+        )
+    )
+
+
+def index_contacts(contacts: resp.ContactsResponse) -> SimpleNamespace:
+    """
+
+    Построение индекса контактов.
+
+    При совпадениях остается первый найденный контакт.
+
+    :param contacts: контакты, доступные пользователю
+    :return: индекс с атрибутами persons, roles и error
+    """
+    persons, roles = {}, {}
+    for org in getattr(contacts, 'organizations', None) or []:
+        for person in getattr(org, 'persons', None) or []:
+            persons.setdefault(
+                f'{person.first_name} {person.last_name}', person.id
+            )
+        for role in getattr(org, 'roles', None) or []:
+            roles.setdefault(role.name, role.id)
+    return SimpleNamespace(persons=persons, roles=roles, error=contacts.error)
+
+
+def get_catalog_index(client: MyPyrus, catalog_id: int) -> SimpleNamespace:
+    """
+
+    Индекс элементов справочника через общий кэш.
+
+    :param client: сущность клиента пайрус
+    :param catalog_id: id справочника
+    :return: индекс с атрибутом items
+     {(позиция колонки, значение): id элемента справочника}
+    """
+    return cache.catalogs.get_or_load(
+        (*cache.get_client_key(client), catalog_id),
+        lambda: index_catalog(
+            metrics.call_api('get_catalog', client.get_catalog, catalog_id)
+        )
+    )
+
+
+def index_catalog(catalog: resp.CatalogResponse) -> SimpleNamespace:
+    """
+
+    Построение индекса элементов справочника.
+
+    При совпадениях остается первый найденный элемент.
 
     :param catalog: сущность каталога
-    :param compare_value: значение по которому ищется элемент каталога
-    :param pos: позиция для поиска в справочнике
-    :return: id элемента каталога
+    :return: индекс с атрибутами items и error
+    """
+    items = {}
+    for item in catalog.items or []:
+        for pos, value in enumerate(item.values or []):
+            items.setdefault((pos, value), item.item_id)
+    return SimpleNamespace(items=items, error=catalog.error)
+
+
+def index_by_id(fields: [ent.FormField]) -> dict:
+    """
+
+    Индекс полей по id.
+
+    При повторяющихся id (ячейки таблиц) остаётся первое вхождение,
+    как в object_by_id.
+
+    :param fields: список полей
+    :return: словарь вида {id поля: поле}
     """
-    if not pos.isdigit():
-        return -1
-    pos = int(pos)
-    for item in catalog.items:
-        if item.values[pos] == compare_value:
-            return item.item_id
-    return -1
-
-
-def unit_from_organization(
-        orgs: [ent.Organization],
-        unit: str,
-        value: str
-) -> int:
+    index = {}
+    for field in fields or []:
+        index.setdefault(field.id, field)
+    return index
+
+
+def index_by_code(fields: [ent.FormField], first: bool = False) -> dict:
     """
 
-    Поиск сущности в организации.
+    Индекс полей шаблона формы по юкоду.
+
+    При повторяющихся юкодах остаётся последнее вхождение,
+    как в get_id_by_code, или первое, как в object_by_code.
 
-    :param orgs: список организаций в контакте
-    :param unit: указание на то, где ищем (roles/persons)
-    :param value: значение для поиска (название роли или имя и фамилия)
-    :return: id контакта
+    :param fields: список полей шаблона формы
+    :param first: оставлять первое вхождение вместо последнего
+    :return: словарь вида {юкод поля: поле}
     """
-    for org in orgs:
-        unit_values = getattr(org, unit, [])
-        for unit_value in unit_values:
-            if isinstance(unit_value, ent.Person):
-                if value == f'{unit_value.first_name} {unit_value.last_name}':
-                    return unit_value.id
-            if isinstance(unit_value, ent.Role):
-                if value == unit_value.name:
-                    return unit_value.id
-    return -1
-
-
-def filter_tasks(
-        tasks: [ent.Task],
-        filtered_value: Any,
-        filtered_field_id: int
+    index = {}
+    for field in fields or []:
+        code = getattr(getattr(field, 'info', None), 'code', None)
+        if code is None:
+            continue
+        if first:
+            index.setdefault(code, field)
+        else:
+            index[code] = field
+    return index
+
+
+def filter_rows(
+        column,
+        rows_idx: list,
+        filtered_value: Any
 ) -> list:
     """
 
-    Фильтрация задач по знаечению.
+    Фильтрация строк среза реестра по значению.
 
-    :param tasks: список задач
-    :param filtered_value: значение, по которому фильтруются задачи
-    :param filtered_field_id: id поля по которому фильтруются задачи
-    :return: список отфильтрованных задач
+    :param column: колонка среза реестра (ProjectedColumn)
+    :param rows_idx: номера строк среза
+    :param filtered_value: значение, по которому фильтруются строки
+    :return: номера отфильтрованных строк
     """
-    # Фильтрация задач по значению
-    filtered_tasks = [
-        task for task in tasks
-        if filtered_value == prepare_value(
-            object_by_id(task.flat_fields, filtered_field_id)
-        )
-    ]
-    return filtered_tasks
+    code = column.code_of(filtered_value)
+    if code == -1:
+        return []
+    codes = column.codes
+    return [idx for idx in rows_idx if codes[idx] == code]
 
 
 def get_rows(rows: [dict]) -> [ent.TableRow]:
@@ -276,48 +374,72 @@ def get_rows(rows: [dict]) -> [ent.TableRow]:
     return rows_ent
 
 
-def delete_table(
+def get_table_changes(
+        old_rows: [ent.TableRow],
+        new_rows: [ent.TableRow]
+) -> [ent.TableRow]:
+    """
+
+    Сравнение текущих строк таблицы с новыми.
+
+    :param old_rows: текущие строки таблицы в задаче
+    :param new_rows: новые строки таблицы
+    :return: добавляемые строки целиком, у изменившихся строк только
+     изменившиеся ячейки и удаляемые строки (с флагом delete)
+    """
+    old_by_id = {row.row_id: row for row in old_rows or []}
+    changes = []
+    for row in new_rows:
+        old_row = old_by_id.pop(row.row_id, None)
+        if old_row is None:
+            changes.append(row)
+            continue
+        old_values = {cell.id: cell.value for cell in old_row.cells or []}
+        cells = [
+            cell for cell in row.cells
+            if old_values.get(cell.id) != cell.value
+        ]
+        if cells:
+            changes.append(ent.TableRow(row_id=row.row_id, cells=cells))
+    # Лишние строки удаляем
+    for row_id in old_by_id:
+        changes.append(ent.TableRow(row_id=row_id, delete=True))
+    return changes
+
+
+def comment_table_changes(
         client: MyPyrus,
         tables: dict,
         task: TaskWithCommentsPlus
-) -> None:
+) -> bool:
     """
 
-    Удаление текущих таблиц, которые будут обновлены.
+    Запись в задачу только изменившихся строк таблиц одним комментарием.
 
     :param client: сущность клиента пайрус
     :param tables: словарь таблиц вида
      {id поля таблицы: новые значение этих таблиц}
     :param task: задача на которой происходит работа
-    :return:
+    :return: True, если комментарий был отправлен
+    :raises TableWriteError: если pyrus вернул ошибку
     """
+    task_fields = index_by_id(task.flat_fields_static)
     field_updates = []
-    # Получаем таблицу из задачи, чтобы её очистить
-    for table_id in tables.keys():
-        table = object_by_id(task.flat_fields_static, table_id)
-        table_value = getattr(table, 'value', None)
-        rows = table_value if table_value else []
-        for row in rows:
-            row.delete = True
-        table.value = rows
-        field_updates.append(table)
-    client.comment_task_plus(task.id, field_updates=field_updates)
-
-
-def comment_tables(client: MyPyrus, tables: dict, task_id: int) -> None:
-    """
-
-    Запись новых данных в таблицы.
-
-    :param client: сущность клиента пайрус
-    :param tables: словарь таблиц вида
-     {id поля таблицы: новые значение этих таблиц}
-    :param task_id: id задачи, на которой происходит работа
-    :return:
-
-    """
-    field_updates = [
-        set_value_to_field(table_id, table)
-        for table_id, table in tables.items()
-    ]
-    client.comment_task_plus(task_id, field_updates=field_updates)
+    for table_id, rows in tables.items():
+        table = task_fields.get(table_id)
+        changes = get_table_changes(getattr(table, 'value', None), rows)
+        if changes:
+            field_updates.append(set_value_to_field(table_id, changes))
+    if not field_updates:
+        logger.debug(f'Таблицы задачи {task.id} не изменились')
+        return False
+    # comment_task_plus не бросает исключений, при ошибке возвращает None
+    response = metrics.call_api(
+        'comment_task', client.comment_task_plus,
+        task.id, field_updates=field_updates
+    )
+    if response is None:
+        raise TableWriteError(
+            f'Не удалось записать таблицы в задачу {task.id}'
+        )
+    return True
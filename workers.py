@@ -0,0 +1,352 @@
+import fcntl
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+
+import pyrustools.object_methods
+
+logging.basicConfig(level=logging.DEBUG)
+logging.getLogger('urllib3').propagate = False
+logger = logging.getLogger(__name__)
+
+# Политики при переполненной очереди
+POLICY_REJECT = 'reject'
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop_oldest'
+
+# Общий пул процессов для тяжелых вычислений
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+class WorkerPool:
+    """
+
+    Ограниченный пул потоков-обработчиков с очередью задач.
+
+    Задачи с одинаковым ключом (id задачи pyrus) объединяются:
+    пока задача в очереди, новые события заменяют её аргументы,
+    а пока задача выполняется, после неё запускается ровно один повтор.
+    Повтор, для которого нет места в очереди, ждет первого
+    освободившегося места.
+    """
+
+    def __init__(
+            self,
+            workers: int = 4,
+            queue_size: int = 100,
+            policy: str = POLICY_REJECT,
+            put_timeout: float = 1
+    ):
+        if policy not in (POLICY_REJECT, POLICY_BLOCK, POLICY_DROP_OLDEST):
+            raise ValueError(f'Неизвестная политика очереди {policy}')
+        self.workers = workers
+        self.policy = policy
+        self.put_timeout = put_timeout
+        self.rejected = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        # Оповещение о конце постановки задачи с ключом в очередь
+        self._put_done = threading.Condition(self._lock)
+        # Состояние задач по ключам вида
+        # {ключ: {'job': задача в очереди или None, 'follow_up': аргументы,
+        # 'putting': задача еще ставится в очередь}}
+        self._keys = {}
+        # Повторы, ожидающие места в очереди
+        self._waiting = []
+
+    def submit(self, fn: Callable, *args, key=None) -> bool:
+        """
+
+        Постановка задачи в очередь.
+
+        :param fn: функция для выполнения
+        :param args: аргументы функции
+        :param key: ключ для объединения повторных задач
+        :return: True, если задача принята
+        """
+        self._start()
+        job = [fn, args, key]
+        if key is None:
+            return self._put(job)
+        with self._lock:
+            while True:
+                state = self._keys.get(key)
+                if state is None:
+                    break
+                if state['putting']:
+                    # Задача может не попасть в очередь - ждем, чтобы
+                    # не ответить True за запуск, которого не будет
+                    self._put_done.wait()
+                    continue
+                self.coalesced += 1
+                if state['job'] is not None:
+                    # Задача ещё в очереди - берём свежие аргументы
+                    state['job'][1] = args
+                else:
+                    # Задача выполняется - запланируем один повтор
+                    state['follow_up'] = args
+                return True
+            state = {'job': job, 'follow_up': None, 'putting': True}
+            self._keys[key] = state
+        submitted = self._put(job)
+        with self._lock:
+            state['putting'] = False
+            if not submitted and self._keys.get(key) is state:
+                del self._keys[key]
+            self._put_done.notify_all()
+        return submitted
+
+    def _put(self, job: list) -> bool:
+        if self.policy == POLICY_BLOCK:
+            try:
+                self._queue.put(job, timeout=self.put_timeout)
+                return True
+            except queue.Full:
+                return self._reject()
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except queue.Full:
+            if self.policy == POLICY_REJECT:
+                return self._reject()
+        # Вытесняем самую старую задачу в пользу новой
+        with self._lock:
+            try:
+                dropped_job = self._queue.get_nowait()
+                self._queue.task_done()
+                self._keys.pop(dropped_job[2], None)
+                self.dropped += 1
+                logger.error('Очередь переполнена, старая задача отброшена')
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(job)
+                return True
+            except queue.Full:
+                return self._reject()
+
+    def stats(self) -> dict:
+        """
+
+        Состояние пула.
+
+        :return: словарь вида {название счетчика: значение}
+        """
+        return {
+            'workers': len(self._threads),
+            'queued': self._queue.qsize(),
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'waiting': len(self._waiting),
+        }
+
+    def join(self) -> None:
+        """Ожидание выполнения всех задач из очереди и повторов."""
+        while True:
+            self._queue.join()
+            self._put_waiting()
+            with self._lock:
+                if not self._waiting:
+                    return
+
+    def _put_waiting(self) -> None:
+        with self._lock:
+            while self._waiting:
+                try:
+                    self._queue.put_nowait(self._waiting[0])
+                except queue.Full:
+                    return
+                self._waiting.pop(0)
+
+    def _reject(self) -> bool:
+        self.rejected += 1
+        logger.error('Очередь переполнена, задача отклонена')
+        return False
+
+    def _start(self) -> None:
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name=f'report-worker-{len(self._threads)}',
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            # Освободилось место для повтора, ожидающего очереди
+            self._put_waiting()
+            fn, key = job[0], job[2]
+            if key is not None:
+                with self._lock:
+                    self._keys[key]['job'] = None
+                    args = job[1]
+            else:
+                args = job[1]
+            try:
+                fn(*args)
+            except Exception:
+                error = pyrustools.object_methods.get_exception()
+                logger.error(error)
+            finally:
+                if key is not None:
+                    self._follow_up(fn, key)
+                self._queue.task_done()
+
+    def _follow_up(self, fn: Callable, key) -> None:
+        with self._lock:
+            state = self._keys.pop(key)
+            follow_up = state['follow_up']
+            if follow_up is None:
+                return
+            job = [fn, follow_up, key]
+            self._keys[key] = {'job': job, 'follow_up': None, 'putting': False}
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                # В повторе самые свежие аргументы - не отбрасываем его,
+                # новые события по ключу объединятся с ним
+                self._waiting.append(job)
+                logger.warning('Очередь переполнена, повтор ждет места')
+
+
+class ProcessCoalescer:
+    """
+
+    Объединение запусков с одинаковым ключом между процессами.
+
+    Несколько процессов веб-сервера получают вебхуки одной задачи
+    независимо, поэтому WorkerPool объединяет их только внутри процесса.
+    Аргументы запуска сохраняются в файл <ключ>.pending, а выполняет их
+    тот процесс, который держит блокировку <ключ>.lock. Остальные
+    не ждут блокировку, а оставляют свежие аргументы владельцу,
+    который после запуска проверяет их еще раз. Когда аргументов
+    не осталось, владелец удаляет файл блокировки, а после снятия
+    блокировки еще раз проверяет, не появились ли новые аргументы.
+    """
+
+    def __init__(self, directory: str):
+        """
+
+        Подготовка каталога блокировок.
+
+        :param directory: каталог для файлов блокировок, общий для процессов
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def run(self, key, fn: Callable, *args) -> None:
+        """
+
+        Запуск функции, если ее не выполняет другой процесс.
+
+        :param key: ключ для объединения запусков (id задачи pyrus)
+        :param fn: функция для выполнения
+        :param args: аргументы функции, должны сериализоваться pickle
+        :return:
+        """
+        base = os.path.join(self.directory, str(key))
+        pending = f'{base}.pending'
+        lock_path = f'{base}.lock'
+        temporary = f'{pending}.{os.getpid()}.{threading.get_ident()}'
+        with open(temporary, 'wb') as pending_file:
+            pickle.dump(args, pending_file)
+        os.replace(temporary, pending)
+        while True:
+            with open(lock_path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Владелец блокировки выполнит свежие аргументы сам
+                    return
+                try:
+                    # Прежний владелец мог удалить файл, пока мы его
+                    # открывали: блокировка старого файла ничего не дает
+                    if not _is_same_file(lock_file, lock_path):
+                        continue
+                    while True:
+                        args = _take_pending(pending)
+                        if args is None:
+                            break
+                        fn(*args)
+                    os.remove(lock_path)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            # Процесс, записавший аргументы, пока блокировка еще была
+            # у нас, не смог ее взять и рассчитывает на этот цикл
+            if not os.path.exists(pending):
+                return
+
+
+def get_process_pool(processes: int) -> ProcessPoolExecutor:
+    """
+
+    Общий пул процессов для подсчета таблиц.
+
+    Процессы запускаются через spawn: родительский процесс многопоточный,
+    и fork мог бы скопировать захваченные другими потоками блокировки.
+
+    :param processes: количество процессов
+    :return: пул процессов
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _process_pool
+
+
+def reset_process_pool(pool: ProcessPoolExecutor = None) -> None:
+    """
+
+    Остановка общего пула процессов, следующий вызов создаст новый.
+
+    :param pool: пул, который нужно сбросить; если общий пул уже
+     заменен другим потоком, он не трогается
+    :return:
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None or pool not in (None, _process_pool):
+            return
+        old_pool, _process_pool = _process_pool, None
+    old_pool.shutdown(wait=False)
+
+
+def _is_same_file(opened, path: str) -> bool:
+    try:
+        return os.fstat(opened.fileno()).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _take_pending(path: str) -> (tuple, None):
+    # Файл сначала переименовывается, чтобы не удалить аргументы,
+    # записанные другим процессом во время чтения
+    taken = f'{path}.taken'
+    try:
+        os.replace(path, taken)
+    except FileNotFoundError:
+        return None
+    with open(taken, 'rb') as pending_file:
+        args = pickle.load(pending_file)
+    os.remove(taken)
+    return args